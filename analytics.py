@@ -0,0 +1,495 @@
+"""
+trading-server is a multi-asset, multi-strategy, event-driven execution
+and backtesting platform (OEMS) for trading common markets.
+
+Copyright (C) 2020  Sam Breznikar <sam@sdbgroup.io>
+
+Licensed under GNU General Public License 3.0 or later.
+
+Some rights reserved. See LICENSE.md, AUTHORS.md.
+"""
+
+import numpy as np
+import math
+
+
+class RunningStats:
+    """
+    Running count, mean and variance of a series, updated one value at a
+    time with Welford's algorithm.
+    """
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2        # Sum of squared differences from the mean.
+
+    def update(self, value):
+        """
+        Add a new value to the series.
+        """
+
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def variance(self):
+        """
+        Return sample variance, or 0 if fewer than two values.
+        """
+
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2}
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(values['count'], values['mean'], values['m2'])
+
+
+class TradeStats:
+    """
+    Running post-trade statistics for a portfolio. Each closed trade updates
+    the statistics in constant time, so cost does not grow with the number
+    of trades taken.
+
+    Tracks R multiple mean and variance for all trades, winners and losers,
+    pnl mean and variance, win/loss streaks and peak-to-trough drawdown.
+    State is stored with the portfolio as a dict, see to_dict().
+    """
+
+    def __init__(self, balance=0):
+        self.r_all = RunningStats()
+        self.r_winners = RunningStats()
+        self.r_losers = RunningStats()
+        self.pnl = RunningStats()
+
+        # Streaks. Current streak is positive for wins, negative for losses.
+        self.last_pnl = None
+        self.streak = 0
+        self.max_win_streak = 0
+        self.max_loss_streak = 0
+        self.consecutive_wins = 0       # Wins following a win.
+        self.consecutive_losses = 0     # Losses following a loss.
+
+        # Drawdown, as a percentage of peak balance.
+        self.peak = balance
+        self.trough = balance           # Lowest balance since peak.
+        self.drawdown = 0
+        self.max_drawdown = 0
+        self.max_drawdown_peak = balance
+        self.max_drawdown_trough = balance
+
+    def update(self, pnl, r, balance):
+        """
+        Update statistics with a newly closed trade.
+
+        Args:
+            pnl: realised pnl of the trade.
+            r: R multiple of the trade, or None if unknown.
+            balance: portfolio balance after the trade.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        self.pnl.update(pnl)
+
+        if r is not None:
+            self.r_all.update(r)
+            if pnl > 0:
+                self.r_winners.update(r)
+            elif pnl < 0:
+                self.r_losers.update(r)
+
+        if self.last_pnl is not None:
+            if pnl > 0 and self.last_pnl > 0:
+                self.consecutive_wins += 1
+            elif pnl < 0 and self.last_pnl < 0:
+                self.consecutive_losses += 1
+        self.last_pnl = pnl
+
+        if pnl > 0:
+            self.streak = self.streak + 1 if self.streak > 0 else 1
+            self.max_win_streak = max(self.max_win_streak, self.streak)
+        elif pnl < 0:
+            self.streak = self.streak - 1 if self.streak < 0 else -1
+            self.max_loss_streak = max(self.max_loss_streak, -self.streak)
+
+        if balance > self.peak:
+            self.peak = balance
+            self.trough = balance
+        elif balance < self.trough:
+            self.trough = balance
+
+        self.drawdown = (
+            (self.peak - self.trough) / self.peak * 100 if self.peak > 0
+            else 0)
+        if self.drawdown > self.max_drawdown:
+            self.max_drawdown = self.drawdown
+            self.max_drawdown_peak = self.peak
+            self.max_drawdown_trough = self.trough
+
+    def to_dict(self):
+        """
+        Return statistics state as a dict for DB storage.
+        """
+
+        return {
+            'r_all': self.r_all.to_dict(),
+            'r_winners': self.r_winners.to_dict(),
+            'r_losers': self.r_losers.to_dict(),
+            'pnl': self.pnl.to_dict(),
+            'last_pnl': self.last_pnl,
+            'streak': self.streak,
+            'max_win_streak': self.max_win_streak,
+            'max_loss_streak': self.max_loss_streak,
+            'consecutive_wins': self.consecutive_wins,
+            'consecutive_losses': self.consecutive_losses,
+            'peak': self.peak,
+            'trough': self.trough,
+            'drawdown': self.drawdown,
+            'max_drawdown': self.max_drawdown,
+            'max_drawdown_peak': self.max_drawdown_peak,
+            'max_drawdown_trough': self.max_drawdown_trough}
+
+    @classmethod
+    def from_dict(cls, values):
+        """
+        Return TradeStats restored from a dict created by to_dict().
+        """
+
+        stats = cls()
+        for field in ['r_all', 'r_winners', 'r_losers', 'pnl']:
+            setattr(stats, field, RunningStats.from_dict(values[field]))
+        for field, value in values.items():
+            if not isinstance(value, dict):
+                setattr(stats, field, value)
+
+        return stats
+
+
+class Performance:
+    """
+    Vectorised performance statistics for a portfolio, computed from its
+    equity curve and closed trades held as NumPy arrays.
+
+    Equity is resampled to fixed periods (daily by default) for return based
+    ratios. Trade level statistics use one array element per closed trade.
+    """
+
+    DAY = 86400
+    PERIODS_PER_YEAR = 365      # Crypto markets trade every day.
+
+    def __init__(self, timestamps, equity, trade_ids=None, trade_pnl=None,
+                 trade_models=None, trade_open_ts=None, trade_close_ts=None,
+                 period=DAY):
+        """
+        Args:
+            timestamps: epoch timestamps of equity changes, ascending.
+            equity: portfolio balance after each change.
+            trade_ids: IDs of closed trades.
+            trade_pnl: realised pnl per closed trade.
+            trade_models: model name per closed trade.
+            trade_open_ts: position opening timestamp per closed trade.
+            trade_close_ts: closing timestamp per closed trade.
+            period: return period in seconds.
+        """
+
+        self.ts = np.asarray(timestamps, dtype=np.int64)
+        self.equity = np.asarray(equity, dtype=np.float64)
+        self.period = period
+
+        n = 0 if trade_pnl is None else len(trade_pnl)
+        self.trade_ids = np.asarray(
+            trade_ids if trade_ids is not None else np.arange(n))
+        self.trade_pnl = np.asarray(
+            trade_pnl if trade_pnl is not None else [], dtype=np.float64)
+        self.trade_models = np.asarray(
+            trade_models if trade_models is not None else [None] * n,
+            dtype=object)
+        self.trade_open_ts = np.asarray(
+            trade_open_ts if trade_open_ts is not None else [np.nan] * n,
+            dtype=np.float64)
+        self.trade_close_ts = np.asarray(
+            trade_close_ts if trade_close_ts is not None else [np.nan] * n,
+            dtype=np.float64)
+
+    @classmethod
+    def from_portfolio(cls, portfolio, trades, period=DAY):
+        """
+        Build Performance from a portfolio dict and its closed trades.
+
+        Args:
+            portfolio: portfolio dict.
+            trades: {trade_id: trade dict} for trades in balance history.
+            period: return period in seconds.
+
+        Returns:
+            Performance object.
+
+        Raises:
+            None.
+        """
+
+        history = cls.sorted_history(portfolio['balance_history'])
+
+        ts = np.fromiter((i[0] for i in history), np.int64, len(history))
+        amt = np.fromiter((i[1] for i in history), np.float64, len(history))
+
+        closed = [i for i in history if i[2] != "initial_deposit"]
+        trade_ids = [str(i[2]) for i in closed]
+        found = [trades.get(t_id) for t_id in trade_ids]
+
+        return cls(
+            ts, np.cumsum(amt),
+            trade_ids=trade_ids,
+            trade_pnl=[i[1] for i in closed],
+            trade_models=[t['model'] if t else None for t in found],
+            trade_open_ts=[
+                t['position']['opening_timestamp'] if t and t['position']
+                else np.nan for t in found],
+            trade_close_ts=[i[0] for i in closed],
+            period=period)
+
+    @staticmethod
+    def sorted_history(balance_history):
+        """
+        Return balance history as a list of (timestamp, amount, trade_id)
+        tuples in time order, deposits first.
+
+        Entries carry the timestamp of the trade close, entries without
+        one are keyed by epoch timestamp. Entries with equal timestamps
+        keep their recorded order. Deposits dated after the first trade
+        close (e.g a backtest of historic data) are dated at the first
+        close.
+
+        Args:
+            balance_history: portfolio balance history dict.
+
+        Returns:
+            list of (timestamp, amount, trade_id) tuples.
+
+        Raises:
+            None.
+        """
+
+        history = [
+            (i['trade_id'] != "initial_deposit",
+             int(i['timestamp']) if 'timestamp' in i else int(key),
+             count, i['amt'], i['trade_id']) for count, (key, i) in
+            enumerate(balance_history.items())]
+        history.sort()
+
+        closes = [i[1] for i in history if i[0]]
+        first_close = closes[0] if closes else None
+
+        return [
+            (ts if closed or first_close is None else min(ts, first_close),
+             amt, trade_id) for closed, ts, _, amt, trade_id in history]
+
+    def periodic_equity(self):
+        """
+        Return (timestamps, equity) sampled at the end of each period.
+        """
+
+        if not len(self.ts):
+            return self.ts, self.equity
+
+        start = self.ts[0] - self.ts[0] % self.period + self.period
+        grid = np.arange(start, self.ts[-1] + self.period, self.period)
+        grid = np.concatenate(([self.ts[0]], grid))
+        idx = np.searchsorted(self.ts, grid, side="right") - 1
+
+        return grid, self.equity[idx]
+
+    def returns(self):
+        """
+        Return periodic simple returns.
+        """
+
+        equity = self.periodic_equity()[1]
+        if len(equity) < 2:
+            return np.empty(0)
+
+        return np.diff(equity) / equity[:-1]
+
+    def rolling_returns(self, window):
+        """
+        Return compounded returns over each rolling window of periods.
+        """
+
+        equity = self.periodic_equity()[1]
+        if len(equity) <= window:
+            return np.empty(0)
+
+        return equity[window:] / equity[:-window] - 1
+
+    def annual_factor(self):
+        return self.PERIODS_PER_YEAR * self.DAY / self.period
+
+    def sharpe(self, risk_free=0):
+        """
+        Return annualised Sharpe ratio of periodic returns.
+        """
+
+        excess = self.returns() - risk_free / self.annual_factor()
+        if len(excess) < 2 or not excess.std(ddof=1):
+            return 0.0
+
+        return float(
+            excess.mean() / excess.std(ddof=1) * np.sqrt(self.annual_factor()))
+
+    def sortino(self, risk_free=0):
+        """
+        Return annualised Sortino ratio of periodic returns.
+        """
+
+        excess = self.returns() - risk_free / self.annual_factor()
+        if not len(excess):
+            return 0.0
+
+        downside = np.sqrt(np.mean(np.minimum(excess, 0) ** 2))
+        if not downside:
+            return 0.0
+
+        return float(excess.mean() / downside * np.sqrt(self.annual_factor()))
+
+    def annual_return(self):
+        """
+        Return compound annual growth rate of equity.
+        """
+
+        if len(self.ts) < 2 or self.ts[-1] == self.ts[0] or self.equity[0] <= 0:
+            return 0.0
+
+        years = (self.ts[-1] - self.ts[0]) / (self.PERIODS_PER_YEAR * self.DAY)
+
+        return float((self.equity[-1] / self.equity[0]) ** (1 / years) - 1)
+
+    def drawdowns(self):
+        """
+        Return drawdown from running peak at each equity change, as a
+        fraction of peak equity.
+        """
+
+        peak = np.maximum.accumulate(self.equity)
+
+        return np.where(peak > 0, (peak - self.equity) / peak, 0)
+
+    def max_drawdown(self):
+        """
+        Return (max drawdown fraction, peak timestamp, trough timestamp).
+        """
+
+        if not len(self.equity):
+            return 0.0, None, None
+
+        drawdowns = self.drawdowns()
+        trough = int(np.argmax(drawdowns))
+        peak = int(np.argmax(self.equity[:trough + 1]))
+
+        return float(drawdowns[trough]), int(self.ts[peak]), int(self.ts[trough])
+
+    def max_drawdown_duration(self):
+        """
+        Return longest time in seconds spent below a previous equity peak.
+        """
+
+        if not len(self.equity):
+            return 0
+
+        at_peak = self.equity >= np.maximum.accumulate(self.equity)
+        last_peak = np.maximum.accumulate(
+            np.where(at_peak, np.arange(len(self.equity)), 0))
+
+        return int(np.max(self.ts - self.ts[last_peak]))
+
+    def calmar(self):
+        """
+        Return annual return divided by max drawdown.
+        """
+
+        drawdown = self.max_drawdown()[0]
+
+        return self.annual_return() / drawdown if drawdown else 0.0
+
+    def exposure(self):
+        """
+        Return fraction of the equity curve's time span with at least one
+        position open.
+        """
+
+        known = ~(np.isnan(self.trade_open_ts) | np.isnan(self.trade_close_ts))
+        if not known.any() or len(self.ts) < 2 or self.ts[-1] == self.ts[0]:
+            return 0.0
+
+        order = np.argsort(self.trade_open_ts[known])
+        starts = self.trade_open_ts[known][order]
+        ends = np.maximum(self.trade_close_ts[known][order], starts)
+
+        # Merge overlapping intervals: a new interval starts wherever the
+        # start is after every earlier end.
+        prev_end = np.maximum.accumulate(ends)
+        new = np.concatenate(([True], starts[1:] > prev_end[:-1]))
+        group = np.cumsum(new) - 1
+        merged_start = starts[new]
+        merged_end = np.zeros(len(merged_start))
+        np.maximum.at(merged_end, group, ends)
+
+        return float(
+            np.sum(merged_end - merged_start) / (self.ts[-1] - self.ts[0]))
+
+    def model_attribution(self):
+        """
+        Return per-model trade count, total pnl, mean pnl and win rate as
+        {model: stats dict}.
+        """
+
+        if not len(self.trade_pnl):
+            return {}
+
+        models, idx = np.unique(
+            self.trade_models.astype(str), return_inverse=True)
+        count = np.bincount(idx)
+        pnl = np.bincount(idx, weights=self.trade_pnl)
+        wins = np.bincount(idx, weights=self.trade_pnl > 0)
+
+        return {
+            str(model): {
+                'trades': int(count[i]),
+                'pnl': float(pnl[i]),
+                'avg_pnl': float(pnl[i] / count[i]),
+                'win_rate': float(wins[i] / count[i])}
+            for i, model in enumerate(models)}
+
+    def summary(self):
+        """
+        Return all statistics as a dict.
+        """
+
+        drawdown, peak_ts, trough_ts = self.max_drawdown()
+        pnl = self.trade_pnl
+
+        return {
+            'total_trades': int(len(pnl)),
+            'win_rate': float(np.mean(pnl > 0)) if len(pnl) else 0.0,
+            'total_pnl': float(pnl.sum()),
+            'annual_return': self.annual_return(),
+            'sharpe': self.sharpe(),
+            'sortino': self.sortino(),
+            'calmar': self.calmar(),
+            'max_drawdown': drawdown,
+            'max_drawdown_peak': peak_ts,
+            'max_drawdown_trough': trough_ts,
+            'max_drawdown_duration': self.max_drawdown_duration(),
+            'exposure': self.exposure(),
+            'models': self.model_attribution()}
@@ -10,6 +10,7 @@ Some rights reserved. See LICENSE.md, AUTHORS.md.
 """
 
 from pymongo import MongoClient, errors
+from analytics import Performance
 from threading import Thread
 from flask import Flask, Response, request
 from time import sleep
@@ -46,6 +47,11 @@ def return_portfolio():
 
         portfolio = db_other['portfolio'].find_one({"id": 1}, {"_id": 0})
         if portfolio:
+            # Trades are stored separately from the portfolio document.
+            portfolio['trades'] = {
+                str(t['trade_id']): t for t in db_other['trades'].find(
+                    {"portfolio_id": 1}, {"_id": 0, "portfolio_id": 0})}
+
             return json.dumps(portfolio), 200, {'ContentType':'application/json'}
         else:
             return json.dumps({'success': False, 'message': 'Not found'}),
@@ -56,6 +62,34 @@ def return_portfolio():
         403, {'ContentType':'application/json'}
 
 
+# Portfolio performance statistics route
+@app.route("/portfolio/performance", methods=['GET'])
+def return_portfolio_performance():
+    if request.method == 'GET':
+
+        portfolio = db_other['portfolio'].find_one(
+            {"id": 1}, {"_id": 0, "balance_history": 1})
+        if portfolio:
+            trades = {
+                str(t['trade_id']): t for t in db_other['trades'].find(
+                    {"portfolio_id": 1, "complete": True},
+                    {"_id": 0, "trade_id": 1, "model": 1,
+                     "position.opening_timestamp": 1})}
+
+            period = int(request.args.get('period', Performance.DAY))
+            stats = Performance.from_portfolio(
+                portfolio, trades, period).summary()
+
+            return json.dumps(stats), 200, {'ContentType':'application/json'}
+        else:
+            return json.dumps({'success': False, 'message': 'Not found'}),
+            404, {'ContentType':'application/json'}
+
+    else:
+        return json.dumps({'success': False, 'message': 'Invalid method'}),
+        403, {'ContentType':'application/json'}
+
+
 # Portfolio settings route
 @app.route("/portfolio/settings/<new_state>", methods=['POST'])
 def change_portfolio_settings():
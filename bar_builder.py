@@ -0,0 +1,276 @@
+"""
+trading-server is a multi-asset, multi-strategy, event-driven execution
+and backtesting platform (OEMS) for trading common markets.
+
+Copyright (C) 2020  Sam Breznikar <sam@sdbgroup.io>
+
+Licensed under GNU General Public License 3.0 or later.
+
+Some rights reserved. See LICENSE.md, AUTHORS.md.
+"""
+
+from event_types import MarketEvent
+from threading import Lock
+import numpy as np
+import queue
+import time
+
+
+class BarBuilder:
+    """
+    Aggregates a venues live trade stream into alternative bar types and
+    emits a MarketEvent, tagged with the bar type, for each completed bar.
+
+    Bar type codes are a size and a unit:
+        "5S"        5 second time bars.
+        "500T"      500 tick bars.
+        "100000V"   Bars of 100,000 contracts traded.
+        "1000000D"  Bars of $1,000,000 traded (price * size per tick).
+
+    For inverse contracts like BitMEX XBTUSD, size is already quoted in
+    USD, use volume bars for dollar bars.
+
+    Ticks arrive as column arrays (see Exchange.TICK_DTYPES) and each batch
+    is aggregated with vectorised numpy ops, so per-tick cost stays low
+    enough for peak trade rates on one core.
+
+    Time bars close when the first tick of a later period arrives, or when
+    flush() is called after the period ends. Periods without ticks produce
+    no bar. Threshold bars close on the tick that reaches the threshold,
+    ticks are not split across bars and any excess counts toward the next.
+
+    As with 1 min bars, bar timestamps mark bar close, the period end for
+    time bars and the last tick for threshold bars. Bars also carry
+    start_ms and end_ms, first and last tick times.
+    """
+
+    UNITS = {
+        'S': "time",
+        'T': "tick",
+        'V': "volume",
+        'D': "dollar"}
+
+    # Allowance for late ticks and clock offset before flushing time bars.
+    FLUSH_DELAY_MS = 500
+
+    def __init__(self, logger, exchange, bar_types, events=None):
+        self.logger = logger
+        self.exchange = exchange
+        self.bar_types = {code: self.parse_bar_type(code) for code in bar_types}
+
+        # Completed bar MarketEvents.
+        self.events = events if events is not None else queue.Queue(0)
+
+        # Partial bars {symbol: {code: bar}} and threshold bar carry
+        # {symbol: {code: amount}}, amount traded toward the next close.
+        self.partial = {}
+        self.carry = {}
+
+        self.lock = Lock()
+
+    def parse_bar_type(self, code):
+        """
+        Return (kind, size) tuple for the given bar type code.
+
+        Raises:
+            Exception if code is not a valid bar type.
+        """
+
+        try:
+            kind = self.UNITS[code[-1].upper()]
+            size = float(code[:-1])
+            if size <= 0:
+                raise ValueError
+        except (KeyError, ValueError, IndexError):
+            raise Exception("Invalid bar type " + str(code) + ".")
+
+        return kind, size
+
+    def add_ticks(self, symbol, ticks):
+        """
+        Aggregate new ticks into all bar types, queue a MarketEvent for each
+        completed bar. Ticks must be in time order.
+
+        Args:
+            symbol: instrument ticker code (string).
+            ticks: dict of tick column arrays, millisecond timestamps.
+
+        Returns:
+            List of completed bars.
+
+        Raises:
+            None.
+        """
+
+        if not len(ticks['timestamp']):
+            return []
+
+        completed = []
+        with self.lock:
+            partial = self.partial.setdefault(symbol, {})
+            carry = self.carry.setdefault(symbol, {})
+
+            for code, (kind, size) in self.bar_types.items():
+                if kind == "time":
+                    bars = self.time_bars(
+                        symbol, code, size, ticks, partial.get(code))
+                else:
+                    bars = self.threshold_bars(
+                        symbol, code, kind, size, ticks, partial.get(code),
+                        carry.get(code, 0.0), carry)
+
+                partial[code] = bars.pop()
+                completed += bars
+
+        return self.complete(completed)
+
+    def time_bars(self, symbol, code, size, ticks, partial):
+        """
+        Return completed time bars followed by the new partial bar.
+        """
+
+        period = int(size * 1000)
+        ids = ticks['timestamp'] // period
+
+        bars = self.aggregate(symbol, code, ticks, ids, partial)
+        for bar in bars:
+            bar['timestamp'] = (int(bar['id']) + 1) * period // 1000
+
+        return bars
+
+    def threshold_bars(self, symbol, code, kind, size, ticks, partial,
+                       carry, carries):
+        """
+        Return completed tick, volume or dollar bars followed by the new
+        partial bar, update the carried amount.
+        """
+
+        if kind == "tick":
+            amount = np.ones(len(ticks['timestamp']))
+        elif kind == "volume":
+            amount = ticks['size']
+        else:
+            amount = ticks['price'] * ticks['size']
+
+        # Bar index of each tick is the number of thresholds reached before
+        # it. Its bar closes on it if it reaches the next threshold. Carry
+        # is below the threshold, so the first tick continues the partial.
+        if partial:
+            partial['id'] = 0
+        cum = carry + np.cumsum(amount)
+        ids = np.floor((cum - amount) / size)
+        bars = self.aggregate(symbol, code, ticks, ids, partial)
+
+        if np.floor(cum[-1] / size) > ids[-1]:
+            bars.append(None)
+
+        carries[code] = float(cum[-1] - np.floor(cum[-1] / size) * size)
+        return bars
+
+    def aggregate(self, symbol, code, ticks, ids, partial):
+        """
+        Build bars from ticks grouped by non-decreasing ids, merging the
+        first group into the partial bar if it shares its id. Returns all
+        bars, the last is incomplete.
+        """
+
+        n = len(ids)
+        price = ticks['price']
+        timestamps = ticks['timestamp']
+
+        # Common case for small batches, all ticks continue the partial.
+        if partial and ids[0] == ids[n - 1] == partial['id']:
+            partial['end_ms'] = int(timestamps[n - 1])
+            partial['high'] = max(partial['high'], float(price.max()))
+            partial['low'] = min(partial['low'], float(price.min()))
+            partial['close'] = float(price[n - 1])
+            partial['volume'] += float(ticks['size'].sum())
+            partial['ticks'] += n
+            return [partial]
+
+        starts = np.flatnonzero(ids[1:] != ids[:-1]) + 1
+        starts = np.concatenate(([0], starts)) if len(starts) else \
+            np.zeros(1, dtype=np.intp)
+
+        highs = np.maximum.reduceat(price, starts).tolist()
+        lows = np.minimum.reduceat(price, starts).tolist()
+        volumes = np.add.reduceat(ticks['size'], starts).tolist()
+        starts = starts.tolist()
+        ends = starts[1:] + [n]
+
+        bars = []
+        for i in range(len(starts)):
+            lo, hi = starts[i], ends[i]
+            bars.append({
+                'symbol': symbol,
+                'bar_type': code,
+                'id': ids[lo],
+                'timestamp': int(timestamps[lo]) // 1000,
+                'start_ms': int(timestamps[lo]),
+                'end_ms': int(timestamps[hi - 1]),
+                'open': float(price[lo]),
+                'high': highs[i],
+                'low': lows[i],
+                'close': float(price[hi - 1]),
+                'volume': volumes[i],
+                'ticks': hi - lo})
+
+        if partial:
+            if partial['id'] == bars[0]['id']:
+                first = bars[0]
+                partial['end_ms'] = first['end_ms']
+                partial['high'] = max(partial['high'], first['high'])
+                partial['low'] = min(partial['low'], first['low'])
+                partial['close'] = first['close']
+                partial['volume'] += first['volume']
+                partial['ticks'] += first['ticks']
+                bars[0] = partial
+            else:
+                bars.insert(0, partial)
+
+        return bars
+
+    def flush(self, now_ms=None):
+        """
+        Close time bars whose period has ended, for quiet markets where no
+        later tick has arrived to close them.
+
+        Args:
+            now_ms: epoch millisecond timestamp, None for now.
+
+        Returns:
+            List of completed bars.
+
+        Raises:
+            None.
+        """
+
+        if now_ms is None:
+            now_ms = int(time.time() * 1000)
+
+        completed = []
+        with self.lock:
+            for symbol, partial in self.partial.items():
+                for code, bar in partial.items():
+                    kind, size = self.bar_types[code]
+                    period = int(size * 1000)
+                    if bar and kind == "time" and (
+                            bar['id'] + 1) * period + \
+                            self.FLUSH_DELAY_MS <= now_ms:
+                        completed.append(bar)
+                        partial[code] = None
+
+        return self.complete(completed)
+
+    def complete(self, bars):
+        """
+        Queue a MarketEvent for each completed bar, return the bars.
+        """
+
+        for bar in bars:
+            if self.bar_types[bar['bar_type']][0] != "time":
+                bar['timestamp'] = bar['end_ms'] // 1000
+            del bar['id']
+            self.events.put(MarketEvent(self.exchange, bar, bar['bar_type']))
+
+        return bars
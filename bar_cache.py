@@ -0,0 +1,469 @@
+"""
+trading-server is a multi-asset, multi-strategy, event-driven execution
+and backtesting platform (OEMS) for trading common markets.
+
+Copyright (C) 2020  Sam Breznikar <sam@sdbgroup.io>
+
+Licensed under GNU General Public License 3.0 or later.
+
+Some rights reserved. See LICENSE.md, AUTHORS.md.
+"""
+
+import numpy as np
+import os
+
+
+class BarCache:
+    """
+    Local columnar cache of 1 min OHLCV bars, kept alongside MongoDB.
+
+    Each venue/symbol pair is stored in its own memory-mapped file holding
+    int64 epoch timestamps and float64 OHLCV columns. Bars are appended in
+    timestamp order from the live bar stream and from backfills. Reads are
+    binary searched by timestamp and returned as zero-copy column slices.
+
+    Null OHLC values are stored as NaN.
+    """
+
+    DEFAULT_DIR = "bar_cache"
+
+    def __init__(self, logger, path=DEFAULT_DIR):
+        self.logger = logger
+        self.path = path
+
+        # Open bar files {(venue, symbol): BarFile}.
+        self.files = {}
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def get_file(self, venue, symbol):
+        """
+        Return the BarFile for the given venue and symbol, creating it if
+        it doesnt exist.
+
+        Args:
+            venue: venue name (string).
+            symbol: instrument ticker code (string).
+
+        Returns:
+            BarFile object.
+
+        Raises:
+            None.
+        """
+
+        key = (venue, symbol)
+
+        if key not in self.files:
+            filename = os.path.join(
+                self.path, venue + "_" + symbol + BarFile.EXTENSION)
+            self.files[key] = BarFile(filename)
+
+        return self.files[key]
+
+    def append(self, venue, symbol, bars):
+        """
+        Store new bars for the given venue and symbol. Bars already present
+        in the cache are skipped.
+
+        Args:
+            venue: venue name (string).
+            symbol: instrument ticker code (string).
+            bars: list of bar dicts.
+
+        Returns:
+            Number of bars written (int).
+
+        Raises:
+            None.
+        """
+
+        return self.get_file(venue, symbol).append(bars)
+
+    def update(self, venue, symbol, bars):
+        """
+        Overwrite the OHLCV values of stored bars with matching timestamps,
+        e.g when null bars are replaced.
+
+        Args:
+            venue: venue name (string).
+            symbol: instrument ticker code (string).
+            bars: list of bar dicts.
+
+        Returns:
+            Number of bars updated (int).
+
+        Raises:
+            None.
+        """
+
+        return self.get_file(venue, symbol).update(bars)
+
+    def get_range(self, venue, symbol, start_ts=None, end_ts=None):
+        """
+        Return column views of all stored bars with start_ts <= timestamp
+        <= end_ts.
+
+        Args:
+            venue: venue name (string).
+            symbol: instrument ticker code (string).
+            start_ts: first epoch timestamp (int), None for oldest.
+            end_ts: last epoch timestamp (int), None for newest.
+
+        Returns:
+            {column name: np.ndarray} dict of read-only views.
+
+        Raises:
+            None.
+        """
+
+        return self.get_file(venue, symbol).get_range(start_ts, end_ts)
+
+    def get_last(self, venue, symbol, n, before_ts=None):
+        """
+        Return column views of the newest n stored bars, optionally limited
+        to bars with timestamp < before_ts.
+
+        Args:
+            venue: venue name (string).
+            symbol: instrument ticker code (string).
+            n: number of bars (int).
+            before_ts: exclusive upper epoch timestamp (int) or None.
+
+        Returns:
+            {column name: np.ndarray} dict of read-only views.
+
+        Raises:
+            None.
+        """
+
+        return self.get_file(venue, symbol).get_last(n, before_ts)
+
+    def newest_timestamp(self, venue, symbol):
+        """
+        Return newest stored epoch timestamp, or None if no bars stored.
+        """
+
+        return self.get_file(venue, symbol).newest_timestamp()
+
+    def oldest_timestamp(self, venue, symbol):
+        """
+        Return oldest stored epoch timestamp, or None if no bars stored.
+        """
+
+        return self.get_file(venue, symbol).oldest_timestamp()
+
+    def total_stored(self, venue, symbol):
+        """
+        Return number of bars stored for the given venue and symbol.
+        """
+
+        return len(self.get_file(venue, symbol))
+
+    def sync_from_db(self, venue, symbol, collection):
+        """
+        Copy bars newer than the newest cached bar from the given MongoDB
+        price collection into the cache. Pulls the full history on first use.
+
+        Args:
+            venue: venue name (string).
+            symbol: instrument ticker code (string).
+            collection: pymongo collection holding the venue's bars.
+
+        Returns:
+            Number of bars written (int).
+
+        Raises:
+            None.
+        """
+
+        newest = self.newest_timestamp(venue, symbol)
+        query = {"symbol": symbol}
+        if newest is not None:
+            query["timestamp"] = {"$gt": newest}
+
+        result = collection.find(
+            query, {"_id": 0}).sort([("timestamp", 1)])
+
+        total = 0
+        batch = []
+        for doc in result:
+            batch.append(doc)
+            if len(batch) == BarFile.WRITE_BATCH:
+                total += self.append(venue, symbol, batch)
+                batch = []
+        if batch:
+            total += self.append(venue, symbol, batch)
+
+        if total:
+            self.logger.info(
+                "Cached " + str(total) + " " + venue + " " + symbol +
+                " bars locally.")
+
+        return total
+
+    def close(self):
+        """
+        Flush and close all open bar files.
+        """
+
+        for bar_file in self.files.values():
+            bar_file.close()
+        self.files = {}
+
+
+class BarFile:
+    """
+    Single memory-mapped columnar bar file.
+
+    Layout: 64 byte header (magic, capacity, length) followed by one
+    contiguous block of 'capacity' values per column. The file is grown by
+    doubling capacity, which rewrites it once per doubling.
+    """
+
+    EXTENSION = ".bars"
+    MAGIC = b"TSBARS01"
+    HEADER_SIZE = 64
+    INITIAL_CAPACITY = 2 ** 16
+    WRITE_BATCH = 10000
+
+    COLUMNS = ["timestamp", "open", "high", "low", "close", "volume"]
+    DTYPES = [np.int64, np.float64, np.float64, np.float64, np.float64,
+              np.float64]
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.mm = None
+        self.meta = None
+        self.cols = {}
+
+        if not os.path.exists(self.filename):
+            self.create(self.filename, self.INITIAL_CAPACITY)
+
+        self.open()
+
+    def __len__(self):
+        return int(self.meta[1])
+
+    def create(self, filename, capacity):
+        """
+        Write an empty bar file with the given capacity.
+        """
+
+        with open(filename, "wb") as f:
+            f.write(self.MAGIC)
+            f.write(np.array([capacity, 0], dtype=np.int64).tobytes())
+            f.truncate(
+                self.HEADER_SIZE + capacity * 8 * len(self.COLUMNS))
+
+    def open(self):
+        """
+        Memory-map the bar file and create column views over it.
+        """
+
+        self.mm = np.memmap(self.filename, dtype=np.uint8, mode="r+")
+
+        if bytes(self.mm[:len(self.MAGIC)]) != self.MAGIC:
+            raise Exception("Not a bar cache file: " + self.filename)
+
+        self.meta = np.ndarray(
+            (2,), dtype=np.int64, buffer=self.mm, offset=len(self.MAGIC))
+        capacity = int(self.meta[0])
+
+        self.cols = {}
+        for i, (col, dtype) in enumerate(zip(self.COLUMNS, self.DTYPES)):
+            self.cols[col] = np.ndarray(
+                (capacity,), dtype=dtype, buffer=self.mm,
+                offset=self.HEADER_SIZE + i * capacity * 8)
+
+    def close(self):
+        """
+        Flush changes to disk and release the memory map. The map itself is
+        closed once any outstanding read views are released.
+        """
+
+        if self.mm is not None:
+            self.mm.flush()
+            self.cols = {}
+            self.meta = None
+            self.mm = None
+
+    def capacity(self):
+        return int(self.meta[0])
+
+    def newest_timestamp(self):
+        length = len(self)
+        return int(self.cols["timestamp"][length - 1]) if length else None
+
+    def oldest_timestamp(self):
+        return int(self.cols["timestamp"][0]) if len(self) else None
+
+    def append(self, bars):
+        """
+        Append bars to the file. Bars newer than the newest stored bar take
+        the fast path, older bars (backfills) are merged in timestamp order.
+        """
+
+        if not bars:
+            return 0
+
+        new = self.to_columns(bars)
+        newest = self.newest_timestamp()
+
+        if newest is not None and new["timestamp"][0] <= newest:
+            return self.merge(new)
+
+        # Drop duplicates within the incoming batch.
+        ts, idx = np.unique(new["timestamp"], return_index=True)
+        if len(idx) != len(new["timestamp"]):
+            new = {col: values[idx] for col, values in new.items()}
+
+        length = len(self)
+        total = length + len(ts)
+        if total > self.capacity():
+            self.resize(total)
+
+        for col in self.COLUMNS:
+            self.cols[col][length:total] = new[col]
+
+        # Only publish the new length once column data is written.
+        self.meta[1] = total
+
+        return total - length
+
+    def merge(self, new):
+        """
+        Merge out-of-order bars into stored bars, skipping bars which are
+        already stored. Rewrites the stored columns.
+        """
+
+        length = len(self)
+        stored_ts = self.cols["timestamp"][:length]
+
+        # Keep only bars not already stored.
+        pos = np.searchsorted(stored_ts, new["timestamp"])
+        pos[pos == length] = 0
+        fresh = stored_ts[pos] != new["timestamp"]
+        if not fresh.any():
+            return 0
+
+        merged = {
+            col: np.concatenate(
+                (self.cols[col][:length], new[col][fresh]))
+            for col in self.COLUMNS}
+
+        ts, idx = np.unique(merged["timestamp"], return_index=True)
+        total = len(ts)
+        if total > self.capacity():
+            self.resize(total)
+
+        for col in self.COLUMNS:
+            self.cols[col][:total] = merged[col][idx]
+        self.meta[1] = total
+
+        return total - length
+
+    def update(self, bars):
+        """
+        Overwrite OHLCV values for stored bars with matching timestamps.
+        """
+
+        if not bars or not len(self):
+            return 0
+
+        new = self.to_columns(bars)
+        length = len(self)
+        stored_ts = self.cols["timestamp"][:length]
+
+        pos = np.searchsorted(stored_ts, new["timestamp"])
+        pos[pos == length] = 0
+        found = stored_ts[pos] == new["timestamp"]
+
+        for col in self.COLUMNS[1:]:
+            self.cols[col][pos[found]] = new[col][found]
+
+        return int(found.sum())
+
+    def resize(self, required):
+        """
+        Grow the file to at least 'required' rows, doubling capacity.
+        """
+
+        capacity = self.capacity()
+        while capacity < required:
+            capacity *= 2
+
+        length = len(self)
+        data = {col: np.array(self.cols[col][:length]) for col in self.COLUMNS}
+
+        tmp = self.filename + ".tmp"
+        self.create(tmp, capacity)
+        self.close()
+        os.replace(tmp, self.filename)
+        self.open()
+
+        for col in self.COLUMNS:
+            self.cols[col][:length] = data[col]
+        self.meta[1] = length
+
+    def get_range(self, start_ts=None, end_ts=None):
+        """
+        Return read-only column views for start_ts <= timestamp <= end_ts.
+        """
+
+        length = len(self)
+        stored_ts = self.cols["timestamp"][:length]
+
+        lo = 0 if start_ts is None else int(
+            np.searchsorted(stored_ts, start_ts, side="left"))
+        hi = length if end_ts is None else int(
+            np.searchsorted(stored_ts, end_ts, side="right"))
+
+        return self.slice(lo, max(lo, hi))
+
+    def get_last(self, n, before_ts=None):
+        """
+        Return read-only column views of the newest n bars before before_ts.
+        """
+
+        length = len(self)
+        hi = length if before_ts is None else int(np.searchsorted(
+            self.cols["timestamp"][:length], before_ts, side="left"))
+
+        return self.slice(max(0, hi - n), hi)
+
+    def slice(self, lo, hi):
+        """
+        Return read-only views of rows lo to hi for all columns.
+        """
+
+        views = {}
+        for col in self.COLUMNS:
+            view = self.cols[col][lo:hi].view()
+            view.flags.writeable = False
+            views[col] = view
+
+        return views
+
+    def to_columns(self, bars):
+        """
+        Convert a list of bar dicts into a dict of column arrays, sorted by
+        timestamp.
+        """
+
+        cols = {
+            "timestamp": np.fromiter(
+                (b["timestamp"] for b in bars), dtype=np.int64,
+                count=len(bars))}
+
+        for col in self.COLUMNS[1:]:
+            cols[col] = np.array(
+                [np.nan if b[col] is None else b[col] for b in bars],
+                dtype=np.float64)
+
+        order = np.argsort(cols["timestamp"], kind="mergesort")
+        if (order != np.arange(len(order))).any():
+            cols = {col: values[order] for col, values in cols.items()}
+
+        return cols
@@ -9,21 +9,21 @@ Licensed under GNU General Public License 3.0 or later.
 Some rights reserved. See LICENSE.md, AUTHORS.md.
 """
 
-from requests.packages.urllib3.util.retry import Retry
 from datetime import timezone, datetime, timedelta
-from requests.adapters import HTTPAdapter
-from requests import Request, Session
+from requests import Request
 from requests.auth import AuthBase
 from urllib.parse import urlparse
 from bitmex_ws import Bitmex_WS
 from exchange import Exchange
 from dateutil import parser
+import numpy as np
 import traceback
-import requests
+import asyncio
 import hashlib
 import json
 import hmac
 import time
+import os
 
 
 class Bitmex(Exchange):
@@ -32,9 +32,17 @@ class Bitmex(Exchange):
     """
 
     MAX_BARS_PER_REQUEST = 750
+    TICKS_PER_REQUEST = 1000
     TIMESTAMP_FORMAT = '%Y-%m-%d%H:%M:%S.%f'
     REQUEST_TIMEOUT = 10
 
+    # REST requests per minute, keep some for order management.
+    RATE_LIMIT = 60
+    RATE_RESERVE = 10
+
+    # Concurrent sub-windows per tick download.
+    TICK_WINDOWS = 8
+
     BASE_URL = "https://www.bitmex.com/api/v1"
     BASE_URL_TESTNET = "https://testnet.bitmex.com/api/v1"
     WS_URL = "wss://www.bitmex.com/realtime"
@@ -45,10 +53,31 @@ class Bitmex(Exchange):
     BULK_ORDERS_URL = "/order/bulk"
     TRADE_HIST_URL = "/execution/tradeHistory"
 
-    def __init__(self, logger):
-        super()
+    # Execution types reported to the fill callback.
+    FILL_EXEC_TYPES = ["Trade", "Canceled"]
+
+    def __init__(self, logger, base_url=None, ws_url=None,
+                 tick_archive=None, ws_recorder=None):
+        super().__init__()
         self.logger = logger
         self.name = "BitMEX"
+
+        # Optional TickArchive, new websocket ticks are appended to it.
+        self.tick_archive = tick_archive
+
+        # Optional ws_capture.FrameRecorder, captures raw websocket frames.
+        self.ws_recorder = ws_recorder
+
+        # Endpoint overrides, e.g for a local stand-in venue. Use args, or
+        # BITMEX_BASE_URL and BITMEX_WS_URL environment variables.
+        base_url = base_url or os.environ.get('BITMEX_BASE_URL')
+        if base_url:
+            self.BASE_URL = self.BASE_URL_TESTNET = base_url
+        self.WS_URL = ws_url or os.environ.get('BITMEX_WS_URL') or self.WS_URL
+        if base_url or ws_url or os.environ.get('BITMEX_WS_URL'):
+            self.logger.info(
+                "Using BitMEX endpoints " + self.BASE_URL + ", " +
+                self.WS_URL + ".")
         self.symbols = ["XBTUSD"] # "ETHUSD", "XRPUSD", "BCHUSD", "LTCUSD", "LINKUSDT"]
 
         # Minimum price increment for each instrument.
@@ -60,8 +89,16 @@ class Bitmex(Exchange):
             'LTCUSD': 0.01,
             'LINKUSDT': 0.0005}
 
-        # Websocket subscription channels.
-        self.channels = ["trade"]
+        # Websocket subscription channels. Order and execution channels
+        # are private and require API keys.
+        self.channels = ["trade", "order", "execution"]
+
+        # Called with order confs as fills arrive, and with lists of
+        # executions as trades execute, see new_executions(). Trade
+        # callback gets tick columns as public trades arrive.
+        self.fill_callback = None
+        self.execution_callback = None
+        self.trade_callback = None
 
         # Not needed but saves a few rest polls/saves time.
         self.origin_tss = {
@@ -77,19 +114,11 @@ class Bitmex(Exchange):
         # Connect to websocket stream.
         self.ws = Bitmex_WS(
             self.logger, self.symbols, self.channels, self.WS_URL,
-            self.api_key, self.api_secret)
+            self.api_key, self.api_secret, self.new_executions,
+            self.new_trades, self.ws_recorder)
         if not self.ws.ws.sock.connected:
             self.logger.info("Failed to to connect to BitMEX websocket.")
 
-        # Set default https request retry behaviour.
-        retries = Retry(
-            total=5,
-            backoff_factor=0.25,
-            status_forcelist=[502, 503, 504],
-            method_whitelist=False)
-        self.session = Session()
-        self.session.mount('https://', HTTPAdapter(max_retries=retries))
-
         # Non persistent storage for ticks and new 1 min bars.
         self.bars = {}
         self.ticks = {}
@@ -157,7 +186,7 @@ class Bitmex(Exchange):
 
         # self.logger.info("API request string: " + payload)
 
-        bars_to_parse = requests.get(payload).json()
+        bars_to_parse = self.get(payload).json()
 
         # Store only required values (OHLCV) and convert timestamp to epoch.
         new_bars = []
@@ -182,7 +211,7 @@ class Bitmex(Exchange):
                 f"{self.BASE_URL}{self.BARS_URL}1m&symbol={symbol}&filter=&"
                 f"count=1&startTime=&reverse=false")
 
-            response = requests.get(payload).json()[0]['timestamp']
+            response = self.get(payload).json()[0]['timestamp']
             timestamp = int(parser.parse(response).timestamp())
 
             self.logger.info(
@@ -197,7 +226,7 @@ class Bitmex(Exchange):
             "&partial=false&symbol=" + symbol + "&count=" +
             str(n) + "&reverse=true")
 
-        result = requests.get(payload).json()
+        result = self.get(payload).json()
 
         bars = []
         for i in result:
@@ -213,59 +242,118 @@ class Bitmex(Exchange):
 
     def get_recent_ticks(self, symbol, n=1):
 
-        # Find difference between start and end of period.
-        delta = n * 60
+        end = self.previous_minute() + 60
+        return self.get_ticks_in_period(symbol, end - n * 60, end)
 
-        # Find start timestamp and convert to ISO1806.
-        start_epoch = self.previous_minute() + 60 - delta
-        start_iso = datetime.utcfromtimestamp(start_epoch).isoformat()
+    def get_ticks_in_period(self, symbol, start_time, end_time, windows=None):
+        """
+        Download all ticks for the given period. The period is split into
+        sub-windows fetched concurrently, each paged sequentially.
 
-        # find end timestamp and convert to ISO1806
-        end_epoch = self.previous_minute() + 60
-        end_iso = datetime.utcfromtimestamp(end_epoch).isoformat()
+        Args:
+            symbol: instrument ticker code (string).
+            start_time: epoch timestamp (int), inclusive.
+            end_time: epoch timestamp (int), exclusive.
+            windows: number of sub-windows, defaults to TICK_WINDOWS.
 
-        # Initial poll.
-        time.sleep(1)
-        payload = str(
-            self.BASE_URL + self.TICKS_URL + symbol + "&count=" +
-            "1000&reverse=false&startTime=" + start_iso + "&endTime" + end_iso)
+        Returns:
+            Ticks in time order as a dict of numpy arrays, see TICK_DTYPES.
 
-        ticks = []
-        initial_result = requests.get(payload).json()
-        for tick in initial_result:
-            ticks.append(tick)
+        Raises:
+            None.
+        """
+
+        return asyncio.run(self.get_ticks_in_period_async(
+            symbol, start_time, end_time, windows))
 
-        # If 1000 ticks in result (max size), keep polling until
-        # we get a response with length <1000.
-        if len(initial_result) == 1000:
+    async def get_ticks_in_period_async(self, symbol, start_time, end_time,
+                                        windows=None):
+        """
+        Coroutine variant of get_ticks_in_period.
+        """
 
-            maxed_out = True
-            while maxed_out:
+        windows = windows or self.TICK_WINDOWS
+        step = max(1, -(-(end_time - start_time) // windows))
+        bounds = [
+            (ts, min(ts + step, end_time)) for ts in
+            range(start_time, end_time, step)]
 
-                # Dont use endTime as it seems to cut off the final few ticks.
-                payload = str(
-                    self.BASE_URL + self.TICKS_URL + symbol + "&count=" +
-                    "1000&reverse=false&startTime=" + ticks[-1]['timestamp'])
+        pages = await asyncio.gather(*[
+            self.get_tick_window_async(symbol, lo, hi) for lo, hi in bounds])
 
-                interim_result = requests.get(payload).json()
-                for tick in interim_result:
-                    ticks.append(tick)
+        ticks = [page for window in pages for page in window]
+        if not ticks:
+            return self.empty_ticks()
 
-                if len(interim_result) != 1000:
-                    maxed_out = False
+        cols = {
+            col: np.concatenate([page[col] for page in ticks])
+            for col in self.TICK_DTYPES}
 
-        # Check median tick timestamp matches start_iso.
-        median_dt = parser.parse(ticks[int((len(ticks) / 2))]['timestamp'])
-        match_dt = parser.parse(start_iso)
-        if median_dt.minute != match_dt.minute:
-            raise Exception("Tick data timestamp error: timestamp mismatch.")
+        # Ticks on window boundaries are returned by both windows. Keep
+        # first occurence of each trade, pages are already in time order.
+        _, idx = np.unique(cols['trade_id'], return_index=True)
+        idx.sort()
 
-        # Populate list with matching-timestamped ticks only.
-        final_ticks = [
-            i for i in ticks if parser.parse(
-                i['timestamp']).minute == match_dt.minute]
+        # Window end times are inclusive, drop ticks at end_time.
+        idx = idx[cols['timestamp'][idx] < end_time * 1000]
 
-        return final_ticks
+        return {col: values[idx] for col, values in cols.items()}
+
+    async def get_tick_window_async(self, symbol, start_time, end_time):
+        """
+        Page through all ticks in the given sub-window. Requests are
+        throttled here rather than in the request threads.
+
+        Returns:
+            list of tick column dicts, one per page.
+        """
+
+        start = datetime.utcfromtimestamp(start_time).isoformat()
+        end = datetime.utcfromtimestamp(end_time).isoformat()
+
+        pages = []
+        offset = 0
+        while True:
+            payload = (
+                f"{self.BASE_URL}{self.TICKS_URL}{symbol}&"
+                f"count={self.TICKS_PER_REQUEST}&start={offset}&"
+                f"reverse=false&startTime={start}&endTime={end}")
+
+            await self.throttle_async(self.RATE_RESERVE)
+            result = (await self.run_async(
+                self.get, payload, throttled=True)).json()
+            if result:
+                pages.append(self.format_ticks(result))
+
+            if len(result) < self.TICKS_PER_REQUEST:
+                return pages
+
+            offset += len(result)
+
+    def format_ticks(self, ticks):
+        """
+        Convert a list of BitMEX ticks to tick columns, see TICK_DTYPES.
+        """
+
+        n = len(ticks)
+
+        # Timestamps are fixed width "YYYY-MM-DDTHH:MM:SS.fffZ".
+        timestamps = np.array(
+            [t['timestamp'][:23] for t in ticks],
+            dtype='datetime64[ms]').astype(np.int64)
+
+        return {
+            'timestamp': timestamps,
+            'price': np.fromiter(
+                (t['price'] for t in ticks), dtype=np.float64, count=n),
+            'size': np.fromiter(
+                (t['size'] for t in ticks), dtype=np.float64, count=n),
+            'side': np.fromiter(
+                (1 if t['side'] == "Buy" else -1 for t in ticks),
+                dtype=np.int8, count=n),
+            'trade_id': np.array(
+                [t['trdMatchID'] for t in ticks],
+                dtype=self.TICK_DTYPES['trade_id'])}
 
     def get_position(self, symbol):
         prepared_request = Request(
@@ -274,7 +362,7 @@ class Bitmex(Exchange):
             params='').prepare()
         request = self.generate_request_headers(prepared_request, self.api_key,
                                                 self.api_secret)
-        response = self.session.send(request).json()
+        response = self.send(request).json()
 
         for pos in response:
             if pos['symbol'] == symbol:
@@ -316,64 +404,68 @@ class Bitmex(Exchange):
             self.api_key,
             self.api_secret)
 
-        response = self.session.send(request).json()
+        response = self.send(request).json()
 
-        executions = []
-        for res in response:
+        return [self.format_execution(res) for res in response]
 
-            fee_type = "TAKER" if res['lastLiquidityInd'] == "RemovedLiquidity" else "MAKER"
-            direction = "LONG" if res['side'] == "Buy" else "SHORT"
-
-            if res['ordStatus'] == "Filled":
-                fill = "FILLED"
-            elif res['ordStatus'] == "Canceled":
-                fill = "CANCELLED"
-            elif res['ordStatus'] == "New":
-                fill = "NEW"
-            elif res['ordStatus'] == "PartiallyFilled":
-                fill = "PARTIAL"
-            else:
-                raise Exception(res['ordStatus'])
-
-            if res['ordType'] == "Limit":
-                order_type = "LIMIT"
-            elif res['ordType'] == "Market":
-                order_type = "MARKET"
-            elif res['ordType'] == "StopLimit":
-                order_type = "STOP_LIMIT"
-            elif res['ordType'] == "Stop":
-                order_type = "STOP"
-            else:
-                raise Exception(res['ordType'])
-
-            executions.append({
-                    'order_id': res['clOrdID'],
-                    'venue_id': res['orderID'],
-                    'timestamp': int(parser.parse(res['timestamp']).timestamp()),
-                    'avg_exc_price': res['avgPx'],
-                    'currency': res['currency'],
-                    'symbol': res['symbol'],
-                    'direction': direction,
-                    'size': res['lastQty'],
-                    'order_type': order_type,
-                    'fee_type': fee_type,
-                    'fee_amt': res['commission'],
-                    'total_fee': res['execComm'] / res['avgPx'],
-                    'status': fill})
+    def format_execution(self, res):
+        """
+        Return a normalised execution dict from a BitMEX execution row.
+        """
 
-        return executions
+        fee_type = "TAKER" if res['lastLiquidityInd'] == "RemovedLiquidity" else "MAKER"
+        direction = "LONG" if res['side'] == "Buy" else "SHORT"
+
+        if res['ordStatus'] == "Filled":
+            fill = "FILLED"
+        elif res['ordStatus'] == "Canceled":
+            fill = "CANCELLED"
+        elif res['ordStatus'] == "New":
+            fill = "NEW"
+        elif res['ordStatus'] == "PartiallyFilled":
+            fill = "PARTIAL"
+        else:
+            raise Exception(res['ordStatus'])
+
+        if res['ordType'] == "Limit":
+            order_type = "LIMIT"
+        elif res['ordType'] == "Market":
+            order_type = "MARKET"
+        elif res['ordType'] == "StopLimit":
+            order_type = "STOP_LIMIT"
+        elif res['ordType'] == "Stop":
+            order_type = "STOP"
+        else:
+            raise Exception(res['ordType'])
+
+        return {
+            'exec_id': res['execID'],
+            'order_id': res['clOrdID'],
+            'venue_id': res['orderID'],
+            'venue': self.name,
+            'timestamp': int(parser.parse(res['timestamp']).timestamp()),
+            'avg_exc_price': res['avgPx'],
+            'currency': res['currency'],
+            'symbol': res['symbol'],
+            'direction': direction,
+            'size': res['lastQty'],
+            'order_type': order_type,
+            'fee_type': fee_type,
+            'fee_amt': res['commission'],
+            'total_fee': res['execComm'] / res['avgPx'],
+            'status': fill}
 
     def close_position(self, symbol, qty=None, direction=None):
         position = self.get_position(symbol)
 
-        if direction == "LONG":
-            amt = -qty
-        elif direction == "SHORT":
-            amt = qty
-        else:
-            raise Exception(direction)
-
         if qty and direction:
+            if direction == "LONG":
+                amt = -qty
+            elif direction == "SHORT":
+                amt = qty
+            else:
+                raise Exception(direction)
+
             payload = {
                 'symbol': symbol,
                 'orderQty': amt,
@@ -381,11 +473,11 @@ class Bitmex(Exchange):
         else:
             payload = {
                 'symbol': symbol,
-                'orderQty': -position['currentQty'],
+                'orderQty': -position['size'],
                 'ordType': "Market"}
 
         # Don't do anything if closing size or position size is 0.
-        if payload['orderQty'] != 0 and position['currentQty'] != 0:
+        if payload['orderQty'] != 0 and position['size'] != 0:
             prepared_request = Request(
                 'POST',
                 self.BASE_URL_TESTNET + self.ORDERS_URL,
@@ -397,7 +489,7 @@ class Bitmex(Exchange):
                 self.api_key,
                 self.api_secret)
 
-            response = self.session.send(request).json()
+            response = self.send(request).json()
 
             if response['ordStatus'] == "Filled":
                 return True
@@ -424,67 +516,131 @@ class Bitmex(Exchange):
 
         request = self.generate_request_headers(prepared_request, self.api_key,
                                                 self.api_secret)
-        response = self.session.send(request).json()
+        response = self.send(request).json()
 
         orders = []
         for res in response:
             if res['clOrdID']:
-
-                direction = "LONG" if res['side'] == "Buy" else "SHORT"
-
-                if res['ordStatus'] == "Filled":
-                    fill = "FILLED"
-                elif res['ordStatus'] == "Canceled":
-                    fill = "CANCELLED"
-                elif res['ordStatus'] == "New":
-                    fill = "NEW"
-                elif res['ordStatus'] == "PartiallyFilled":
-                    fill = "PARTIAL"
-                else:
-                    raise Exception(res['ordStatus'])
-
-                if res['ordType'] == "Limit":
-                    order_type = "LIMIT"
-                elif res['ordType'] == "Market":
-                    order_type = "MARKET"
-                elif res['ordType'] == "StopLimit":
-                    order_type = "STOP_LIMIT"
-                elif res['ordType'] == "Stop":
-                    order_type = "STOP"
-                else:
-                    raise Exception(res['ordType'])
-
-                # If "\n" in response text field, use substring after "\n".
-                if "\n" in res['text']:
-                    text = res['text'].split("\n")
-                    metatype = text[1]
-                elif (
-                    res['text'] == "ENTRY" or res['text'] == "STOP" or
-                        res['text'] == "TAKE_PROFIT" or
-                        res['text'] == "FINAL_TAKE_PROFIT"):
-                    metatype = res['text']
-                else:
-                    # raise Exception("Order metatype error:", res['text'])
-                    metatype = None
-
-                orders.append({
-                    'order_id': res['clOrdID'],
-                    'venue_id': res['orderID'],
-                    'timestamp': int(parser.parse(res['timestamp']).timestamp()),
-                    'price': res['price'],
-                    'avg_fill_price': res['avgPx'],
-                    'currency': res['currency'],
-                    'venue': "BitMEX",
-                    'symbol': res['symbol'],
-                    'direction': direction,
-                    'size': res['orderQty'],
-                    'order_type': order_type,
-                    'metatype': metatype,
-                    'void_price': res['stopPx'],
-                    'status': fill})
+                orders.append(self.format_order_conf(res))
 
         return orders
 
+    def format_order_conf(self, res):
+        """
+        Return a normalised order confirmation dict from a BitMEX order or
+        execution row.
+        """
+
+        direction = "LONG" if res['side'] == "Buy" else "SHORT"
+
+        if res['ordStatus'] == "Filled":
+            fill = "FILLED"
+        elif res['ordStatus'] == "Canceled":
+            fill = "CANCELLED"
+        elif res['ordStatus'] == "New":
+            fill = "NEW"
+        elif res['ordStatus'] == "PartiallyFilled":
+            fill = "PARTIAL"
+        else:
+            raise Exception(res['ordStatus'])
+
+        if res['ordType'] == "Limit":
+            order_type = "LIMIT"
+        elif res['ordType'] == "Market":
+            order_type = "MARKET"
+        elif res['ordType'] == "StopLimit":
+            order_type = "STOP_LIMIT"
+        elif res['ordType'] == "Stop":
+            order_type = "STOP"
+        else:
+            raise Exception(res['ordType'])
+
+        # If "\n" in response text field, use substring after "\n".
+        if "\n" in res['text']:
+            text = res['text'].split("\n")
+            metatype = text[1]
+        elif (
+            res['text'] == "ENTRY" or res['text'] == "STOP" or
+                res['text'] == "TAKE_PROFIT" or
+                res['text'] == "FINAL_TAKE_PROFIT"):
+            metatype = res['text']
+        else:
+            # raise Exception("Order metatype error:", res['text'])
+            metatype = None
+
+        return {
+            'order_id': res['clOrdID'],
+            'venue_id': res['orderID'],
+            'timestamp': int(parser.parse(res['timestamp']).timestamp()),
+            'price': res['price'],
+            'avg_fill_price': res['avgPx'],
+            'currency': res['currency'],
+            'venue': self.name,
+            'symbol': res['symbol'],
+            'direction': direction,
+            'size': res['orderQty'],
+            'filled': res.get('cumQty'),
+            'order_type': order_type,
+            'metatype': metatype,
+            'void_price': res['stopPx'],
+            'status': fill}
+
+    def new_trades(self, ticks):
+        """
+        Queue new ticks, received via the websocket trade channel, for
+        writing to the tick archive, and pass them as tick columns per
+        symbol to the registered trade callback. Called from the websocket
+        thread.
+        """
+
+        if self.tick_archive:
+            self.tick_archive.add(self.name, ticks, self.format_ticks)
+
+        if self.trade_callback:
+            symbols = {}
+            for tick in ticks:
+                if tick['symbol'] not in symbols:
+                    symbols[tick['symbol']] = []
+                symbols[tick['symbol']].append(tick)
+
+            for symbol, rows in symbols.items():
+                try:
+                    self.trade_callback(symbol, self.format_ticks(rows))
+                except Exception:
+                    self.logger.info(traceback.format_exc())
+
+    def new_executions(self, executions):
+        """
+        Pass trade executions, received via the websocket execution channel,
+        to the registered execution callback, and fills and cancellations of
+        system-placed orders to the registered fill callback. Called from the
+        websocket thread.
+        """
+
+        if self.execution_callback:
+            trades = []
+            for res in executions:
+                if res.get('execType') == "Trade":
+                    try:
+                        trades.append(self.format_execution(res))
+                    except Exception:
+                        self.logger.info(traceback.format_exc())
+            if trades:
+                self.execution_callback(trades)
+
+        for res in executions:
+            if (
+                res.get('clOrdID') and
+                    res.get('execType') in self.FILL_EXEC_TYPES):
+                try:
+                    conf = self.format_order_conf(res)
+                except Exception:
+                    self.logger.info(traceback.format_exc())
+                    continue
+
+                if self.fill_callback:
+                    self.fill_callback(conf)
+
     def place_single_order(self, order):
 
         payload = self.format_orders([order])[0]
@@ -500,7 +656,7 @@ class Bitmex(Exchange):
             self.api_key,
             self.api_secret)
 
-        response = self.session.send(request)
+        response = self.send(request)
 
         return response
 
@@ -529,11 +685,11 @@ class Bitmex(Exchange):
                 self.api_key,
                 self.api_secret)
 
-            response = self.session.send(request)
+            response = self.send(request)
 
         # Unpack successful order confirmations and handle errors.
         order_confirmations = []
-        for r in responses + [response]:
+        for r in responses + ([response] if response else []):
             if r.status_code == 200:
 
                 res = r.json()
@@ -617,7 +773,7 @@ class Bitmex(Exchange):
                 self.api_key,
                 self.api_secret)
 
-            response = self.session.send(request).json()
+            response = self.send(request).json()
 
             response = [response] if not isinstance(response, list) else response
 
@@ -12,13 +12,21 @@ Some rights reserved. See LICENSE.md, AUTHORS.md.
 from time import sleep
 from threading import Thread
 import websocket
+import hashlib
 import json
+import hmac
+import time
 import traceback
 
 
 class Bitmex_WS:
 
-    def __init__(self, logger, symbols, channels, URL, api_key, api_secret):
+    # Seconds websocket authentication signatures remain valid.
+    AUTH_EXPIRY = 10
+
+    def __init__(self, logger, symbols, channels, URL, api_key, api_secret,
+                 on_execution=None, on_trade=None, recorder=None,
+                 connect=True):
         self.logger = logger
         self.symbols = symbols
         self.channels = channels
@@ -29,6 +37,16 @@ class Bitmex_WS:
             raise ValueError('Enter both public and secret API keys')
         self.api_key = api_key
         self.api_secret = api_secret
+
+        # Called with new rows from the private execution channel.
+        self.on_execution = on_execution
+
+        # Called with new rows from the public trade channel.
+        self.on_trade = on_trade
+
+        # Optional FrameRecorder, raw frames are captured before parsing.
+        self.recorder = recorder
+
         self.data = {}
         self.keys = {}
         # websocket.enableTrace(True)
@@ -37,7 +55,12 @@ class Bitmex_WS:
         self.MAX_SIZE = 15000 * len(symbols)
         self.RECONNECT_TIMEOUT = 10
 
-        self.connect()
+        # Skip connecting when frames are fed in directly, e.g replays.
+        self.ws = None
+        self.thread = None
+        self.exited = False
+        if connect:
+            self.connect()
 
     def connect(self):
         """
@@ -56,13 +79,13 @@ class Bitmex_WS:
             self.URL,
             on_message=lambda ws, msg: self.on_message(ws, msg),
             on_error=lambda ws, msg: self.on_error(ws, msg),
-            on_close=lambda ws: self.on_close(ws),
+            on_close=lambda ws, *args: self.on_close(ws),
             on_open=lambda ws: self.on_open(ws))
 
-        thread = Thread(
+        self.thread = Thread(
             target=lambda: self.ws.run_forever(),
             daemon=True)
-        thread.start()
+        self.thread.start()
         self.logger.info("Started websocket daemon.")
 
         timeout = self.RECONNECT_TIMEOUT
@@ -91,6 +114,9 @@ class Bitmex_WS:
             Exception("Unknown")
         """
 
+        if self.recorder:
+            self.recorder.record(msg)
+
         msg = json.loads(msg)
         # self.logger.info(json.dumps(msg))
         table = msg['table'] if 'table' in msg else None
@@ -101,6 +127,16 @@ class Bitmex_WS:
                 self.logger.info(
                     "Subscribed to " + msg['subscribe'] + ".")
 
+            elif 'request' in msg and msg['request'].get('op') == "authKeyExpires":
+                if msg.get('success'):
+                    self.logger.info("Authenticated BitMEX websocket.")
+                else:
+                    self.logger.info(
+                        "BitMEX websocket authentication failed: " + json.dumps(msg))
+
+            elif 'error' in msg:
+                self.logger.info("BitMEX websocket error: " + str(msg['error']))
+
             elif action:
                 if table not in self.data:
                     self.data[table] = []
@@ -112,6 +148,14 @@ class Bitmex_WS:
             elif action == 'insert':
                 self.data[table] += msg['data']
 
+                # Pass new executions (fills, cancellations) to callback.
+                if table == 'execution' and self.on_execution:
+                    self.on_execution(msg['data'])
+
+                # Pass new ticks to callback, e.g for archiving.
+                if table == 'trade' and self.on_trade:
+                    self.on_trade(msg['data'])
+
                 # Trim data table size when it exceeds MAX_SIZE.
                 if(table not in ['order', 'orderBookL2'] and
                         len(self.data[table]) > self.MAX_SIZE):
@@ -147,7 +191,8 @@ class Bitmex_WS:
 
     def on_open(self, ws):
         """
-        Invoked when websocket starts. Used to subscribe to channels.
+        Invoked when websocket starts. Used to authenticate, if API keys are
+        present, and subscribe to channels.
 
         Args:
             ws: WebSocketApp object
@@ -159,6 +204,9 @@ class Bitmex_WS:
             None.
         """
 
+        if self.api_key:
+            ws.send(self.get_auth_string())
+
         ws.send(self.get_channel_subscription_string())
 
     def on_error(self, ws, msg):
@@ -179,6 +227,9 @@ class Bitmex_WS:
 
         self.logger.info("BitMEX websocket error: " + str(msg))
 
+        if self.exited:
+            return
+
         # attempt to reconnect if  ws is not connected
         self.ws = None
         self.logger.info("Attempting to reconnect.")
@@ -201,6 +252,19 @@ class Bitmex_WS:
 
         ws.close()
 
+    def exit(self):
+        """
+        Close the websocket and stop reconnecting. Returns once the
+        websocket thread has stopped.
+        """
+
+        self.exited = True
+
+        if self.ws:
+            self.ws.close()
+        if self.thread:
+            self.thread.join(self.RECONNECT_TIMEOUT)
+
     def get_orderbook(self):
         """
         Returns the L2 orderbook.
@@ -257,6 +321,30 @@ class Bitmex_WS:
             if matched:
                 return item
 
+    def get_auth_string(self):
+        """
+        Returns websocket authentication payload.
+
+        Args:
+            None.
+
+        Returns:
+            authKeyExpires payload (string) signed with the API secret.
+
+        Raises:
+            None.
+        """
+
+        expires = int(time.time()) + self.AUTH_EXPIRY
+        signature = hmac.new(
+            bytes(self.api_secret, 'utf8'),
+            bytes("GET/realtime" + str(expires), 'utf8'),
+            digestmod=hashlib.sha256).hexdigest()
+
+        return json.dumps({
+            "op": "authKeyExpires",
+            "args": [self.api_key, expires, signature]})
+
     def get_channel_subscription_string(self):
         """
         Returns websocket channel subscription string.
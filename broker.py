@@ -9,9 +9,9 @@ Licensed under GNU General Public License 3.0 or later.
 Some rights reserved. See LICENSE.md, AUTHORS.md.
 """
 
-from messaging_clients import Telegram
+from messaging_clients import Telegram, TelegramUpdates
 from event_types import FillEvent
-from threading import Thread
+from threading import Thread, RLock, Lock
 from time import sleep
 import traceback
 import datetime
@@ -23,10 +23,16 @@ class Broker:
     """
     Broker consumes Order events, executes orders, then creates and places
     Fill events in the main event queue post-transaction.
+
+    Trades awaiting orders or user consent are held in an in-memory pending
+    trade table. A trades order batch is placed as soon as all its orders
+    have arrived and the user has accepted it, either when the last order
+    arrives or when the users decision is received. Consent changes are
+    written through to DB via the portfolio.
     """
 
     def __init__(self, exchanges, logger, portfolio, db_other, db_client,
-                 live_trading, telegram):
+                 live_trading, telegram, events):
         self.exchanges = {i.get_name(): i for i in exchanges}
         self.logger = logger
         self.pf = portfolio
@@ -34,16 +40,42 @@ class Broker:
         self.db_client = db_client
         self.live_trading = live_trading
         self.tg = telegram
-
-        # Container for order batches {trade_id: [order objects]}.
-        self.orders = {}
-
-        # Start FillAgent.
-        self.fill_agent = FillAgent(self.logger, self.pf, self.exchanges)
+        self.events = events
+
+        # Held while changing pending trades or placing orders, as consent
+        # decisions arrive from the telegram update consumer thread.
+        self.lock = RLock()
+
+        # Pending trades {trade_id: {orders, order_count, consent, ...}}.
+        self.pending = {}
+
+        # No user to review trades when backtesting.
+        self.tg_updates = None
+
+        # Order state changes already queued as fills, by open trade and
+        # cumulative filled size {trade_id: {(venue_id, filled)}}, or status
+        # for cancellations. Cleared when the trade is archived.
+        self.fills_seen = {}
+        self.fill_lock = Lock()
+
+        # Venues report fills as they happen, FillAgent reconciles. Simulated
+        # venues report every fill, no reconciliation needed.
+        for exchange in self.exchanges.values():
+            exchange.register_fill_callback(self.new_fill_conf)
+        if self.live_trading:
+            self.fill_agent = FillAgent(
+                self.logger, self.pf, self.exchanges, self.new_fill_conf)
+
+        # Start consuming decisions once new_decision can action them.
+        if self.live_trading:
+            self.tg_updates = TelegramUpdates(
+                self.logger, self.tg, self.db_other, self.new_decision)
+            self.tg_updates.start()
 
     def new_order(self, events, order_event):
         """
-        Process and store incoming order events.
+        Process and store incoming order events. Place the trades orders if
+        this completes an accepted trades order batch.
 
         Args:
             events: event queue object.
@@ -57,14 +89,53 @@ class Broker:
         """
 
         new_order = order_event.get_order_dict()
+        trade_id = new_order['trade_id']
+
+        with self.lock:
+
+            # Add new trades to pending trade table.
+            if trade_id not in self.pending:
+                trade = self.pf.get_trade(trade_id)
+
+                # No user to review trades when backtesting.
+                if not self.live_trading and trade['consent'] is None:
+                    trade['consent'] = True
+                    self.pf.update_trades_db(trade_id)
+
+                self.pending[trade_id] = {
+                    'orders': [],
+                    'order_count': trade['order_count'],
+                    'signal_timestamp': trade['signal_timestamp'],
+                    'venue': new_order['venue'],
+                    'consent': trade['consent']}
+
+                # Action user decision if it arrived before the orders.
+                self.register_telegram_responses(trade_id)
+
+            self.pending[trade_id]['orders'].append(new_order)
+            self.action_trade(trade_id, events)
+
+    def new_decision(self, trade_id, consent):
+        """
+        Action a users consent decision as soon as it is received. Called
+        from the telegram update consumer thread.
+        """
+
+        with self.lock:
+            try:
+                trade_id = int(trade_id)
+            except ValueError:
+                return
 
-        # Store incoming orders under trade ID {trade_id: [orders]}
-        try:
-            self.orders[new_order['trade_id']].append(new_order)
+            if trade_id in self.pending:
+                self.register_telegram_responses(trade_id)
+                if self.action_trade(trade_id, self.events):
+                    self.pf.flush_portfolio()
 
-        except KeyError:
-            self.orders[new_order['trade_id']] = [new_order]
-            # traceback.print_exc()
+            # Decisions for resolved or unknown trades will not be actioned.
+            # Decisions for open trades awaiting orders are kept.
+            elif str(trade_id) not in self.pf.pf['trades']:
+                self.tg_updates.clear_decision(trade_id)
 
     def check_consent(self, events):
         """
@@ -80,66 +151,92 @@ class Broker:
             None.
         """
 
-        if self.orders.keys():
-
-            to_remove = []
+        with self.lock:
+            if self.pending:
+                for trade_id in list(self.pending.keys()):
+                    self.register_telegram_responses(trade_id)
+                    self.action_trade(trade_id, events)
 
-            for trade_id in self.orders.keys():
+            else:
+                self.logger.info("No trades awaiting review.")
 
-                # Action user responses from telegram, if any
-                self.register_telegram_responses(trade_id)
+    def action_trade(self, trade_id, events):
+        """
+        Place orders for the given pending trade if its order batch is
+        complete and the user has accepted it, or close it if rejected.
 
-                # Get stored trade state from DB
-                trade = dict(self.db_other['trades'].find_one({"trade_id": trade_id}, {"_id": 0}))
+        Args:
+            trade_id: pending trade ID.
+            events: event queue object.
 
-                # Count received orders for that trade
-                order_count = len(self.orders[trade_id])
-                venue = self.orders[trade_id][0]['venue']
+        Returns:
+            True if the trade left the pending trade table, otherwise False.
 
-                # User has accepted the trade.
-                if trade['consent'] is True:
-                    if order_count == trade['order_count']:
-                        self.logger.info(
-                            "Trade " + str(trade_id) + " order batch ready.")
+        Raises:
+            None.
+        """
 
-                        # Place orders.
-                        order_confs = self.exchanges[venue].place_bulk_orders(
-                            self.orders[trade_id])
+        trade = self.pending[trade_id]
+        order_count = len(trade['orders'])
 
-                        # Update portfolio state with order placement details.
-                        if order_confs:
-                            self.pf.new_order_conf(order_confs, events)
-                            self.logger.info("Orders for trade " + str(trade_id) + " submitted to venue.")
+        # User has accepted the trade.
+        if trade['consent'] is True:
+            if order_count == trade['order_count']:
+                self.logger.info(
+                    "Trade " + str(trade_id) + " order batch ready.")
 
-                        else:
-                            self.logger.info("Order submission for " + str(trade_id) + " may have failed or only partially succeeded.")
-                            # raise Exception("Caution: manual order and position check required for trade " + str(trade_id) + ".")
+                # Place orders.
+                order_confs = self.exchanges[trade['venue']].place_bulk_orders(
+                    trade['orders'])
 
-                        to_remove.append(trade_id)
+                # Update portfolio state with order placement details.
+                if order_confs:
+                    self.pf.new_order_conf(order_confs, events)
+                    self.logger.info("Orders for trade " + str(trade_id) + " submitted to venue.")
 
-                    else:
-                        self.logger.info("Order batch for trade " + str(trade_id) + " not yet ready.")
+                else:
+                    self.logger.info("Order submission for " + str(trade_id) + " may have failed or only partially succeeded.")
+                    # raise Exception("Caution: manual order and position check required for trade " + str(trade_id) + ".")
 
-                # User has not yet made a decision.
-                elif trade['consent'] is None:
-                    self.logger.info("Trade " + str(trade_id) + " awaiting user review.")
+                self.remove_pending(trade_id)
+                return True
 
-                # User has rejected the trade.
-                elif trade['consent'] is False:
-                    self.pf.trade_complete(trade_id)
-                    to_remove.append(trade_id)
+            else:
+                self.logger.info("Order batch for trade " + str(trade_id) + " not yet ready.")
 
-                # Unkown consent case
-                else:
-                    raise Exception("Unknown case for trade consent:", trade['consent'])
+        # User has not yet made a decision.
+        elif trade['consent'] is None:
+            self.logger.info("Trade " + str(trade_id) + " awaiting user review.")
 
-            # Remove sent orders after iteration complete.
-            for t_id in to_remove:
-                del self.orders[t_id]
+        # User has rejected the trade.
+        elif trade['consent'] is False:
+            self.pf.trade_complete(trade_id)
+            self.remove_pending(trade_id)
+            return True
 
+        # Unkown consent case
         else:
-            pass
-            self.logger.info("No trades awaiting review.")
+            raise Exception("Unknown case for trade consent:", trade['consent'])
+
+        return False
+
+    def remove_pending(self, trade_id):
+        """
+        Remove trade from pending trade table.
+        """
+
+        with self.lock:
+            del self.pending[trade_id]
+            if self.tg_updates:
+                self.tg_updates.clear_decision(trade_id)
+
+    def clear_fills(self, trade_id):
+        """
+        Forget fills seen for the given trade, once it is archived.
+        """
+
+        with self.fill_lock:
+            self.fills_seen.pop(str(trade_id), None)
 
     def check_overdue_trades(self):
         """
@@ -159,9 +256,9 @@ class Broker:
 
     def register_telegram_responses(self, trade_id):
         """
-        Check telegram messages to determine acceptance/veto of trade.
+        Check telegram responses to determine acceptance/veto of trade.
 
-        Update DB to reflect users choice.
+        Update pending trade table and portfolio to reflect users choice.
 
         Args:
             trade_id: id of trade to check for
@@ -173,165 +270,129 @@ class Broker:
             None.
         """
 
-        for response in self.tg.get_updates():
+        if not self.tg_updates:
+            return
 
-            u_id = None
-            msg_type = None
-            t_id = str(trade_id)
+        trade = self.pending[trade_id]
 
-            # Message field may be 'message' or 'edited_message'
-            try:
-                u_id = str(response['message']['from']['id'])
-                msg_type = 'message'
-            except KeyError:
-                u_id = str(response['edited_message']['from']['id'])
-                msg_type = 'edited_message'
+        # Response timestamp must be greater than signal trigger time.
+        decision = self.tg_updates.get_decision(
+            trade_id, after=trade['signal_timestamp'])
 
-            # Response must have came from a whitelisted account.
-            try:
-                if u_id in self.tg.whitelist:
+        if decision is not None and trade['consent'] is not decision:
+            trade['consent'] = decision
+            self.pf.pf['trades'][str(trade_id)]['consent'] = decision
+            self.pf.update_trades_db(trade_id)
 
-                    # Response ID must match trade ID.
-                    if str(response[msg_type]['text'][:len(t_id)]) == t_id:
-
-                        # Response timestamp must be greater than signal trigger time.
-                        trade_ts = self.db_other['trades'].find_one({"trade_id": trade_id})['signal_timestamp']
-                        response_ts = response[msg_type]['date']
-                        if response_ts > trade_ts:
+    def new_fill_conf(self, conf):
+        """
+        Queue a fill event if the given order conf changes the state of an
+        order belonging to an open trade. Called from venue websocket threads
+        and FillAgent.
 
-                            try:
-                                decision = response[msg_type]['text'].split(" - ", 1)
-                                if decision[1] == "Accept":
-                                    self.db_other['trades'].update_one({"trade_id": trade_id}, {"$set": {"consent": True}})
-                                    self.pf.pf['trades'][t_id]['consent'] = True
+        Args:
+            conf: normalised order conf dict.
 
-                                elif decision[1] == "Veto":
-                                    self.db_other['trades'].update_one({"trade_id": trade_id}, {"$set": {"consent": False}})
-                                    self.pf.pf['trades'][t_id]['consent'] = False
+        Returns:
+            True if a fill event was queued, otherwise False.
 
-                                else:
-                                    self.logger.info("Unknown input received as response to trade " + t_id + " consent message: " + decision[1])
+        Raises:
+            None.
+        """
 
-                            except Exception:
-                                traceback.print_exc()
+        if conf['status'] not in ["FILLED", "PARTIAL", "CANCELLED"]:
+            return False
 
-            # Unexpected response format in updates
-            except Exception:
-                traceback.print_exc()
-                print(json.dumps(response))
+        trade, o_id = self.pf.get_trade_by_venue_id(conf['venue_id'])
+        if trade is None:
+            return False
 
-    def check_fills(self, events):
-        """
-        Check orders have been filled by comparing portfolio and venue order
-        states. Create fill events when orders have been filled.
-        """
+        # Each partial fill increases the orders cumulative filled size.
+        order = trade['orders'][o_id]
+        filled = conf.get('filled')
+        if conf['status'] == "CANCELLED" or filled is None:
+            key = (conf['venue_id'], conf['status'])
+        else:
+            key = (conf['venue_id'], filled)
 
-        if self.fill_agent.fills:
-            for fill_event in self.fill_agent.fills:
-                events.put(fill_event)
+        with self.fill_lock:
+            seen = self.fills_seen.setdefault(str(trade['trade_id']), set())
+            if key in seen or (
+                    order['status'] == conf['status'] and
+                    order.get('filled') == filled):
+                return False
+            seen.add(key)
 
-            self.fill_agent.fills = []
-            self.logger.info("Parsing order fill messages.")
+        # Derive the trade ID from order id.
+        conf['trade_id'] = o_id.partition("-")[0]
+        self.events.put(FillEvent(conf))
+        self.logger.info(
+            "Order " + o_id + " " + conf['status'].lower() + " at " +
+            conf['venue'] + ".")
 
-        return events
+        return True
 
 
 class FillAgent:
     """
-    Check for new fills in separate thread on specified intervals/conditions.
+    Reconciles local order state with venue order state via REST in a
+    separate thread, in case fills were missed by the venue websockets.
     """
 
-    # Check for fills on the (60 - CHECK_INTERVAL)th second of each minute.
-    CHECK_INTERVAL = 25
+    # Seconds between reconciliations.
+    RECONCILE_INTERVAL = 600
 
-    def __init__(self, logger, portfolio, exchanges):
+    def __init__(self, logger, portfolio, exchanges, on_order):
         self.logger = logger
-        self.pf = portfolio.load_portfolio()
+        self.pf = portfolio
         self.exchanges = exchanges
+        self.on_order = on_order
 
-        self.fills = []
-
-        thread = Thread(target=lambda: self.start(portfolio), daemon=True)
+        thread = Thread(target=self.start, daemon=True)
         thread.start()
 
         self.logger.info("Started FillAgent.")
 
-    def start(self, portfolio):
+    def start(self):
         """
+        Run reconciliation every RECONCILE_INTERVAL seconds.
         """
 
-        sleep(self.seconds_til_next_minute())
-
         while True:
-            sleep(60 - self.CHECK_INTERVAL)
-
-            self.pf = portfolio.load_portfolio()
-
-            # Get snapshot of orders saved locally.
-            active_venues = set()
-            portfolio_order_snapshot = []
-            for t_id in self.pf['trades'].keys():
-                if self.pf['trades'][t_id]['active']:
-
-                    active_venues.add(self.pf['trades'][t_id]['venue'])
-
-                    for o_id in self.pf['trades'][t_id]['orders'].keys():
-                        portfolio_order_snapshot.append((
-                            # (v_id, o_id, status, venue name)
-                            self.pf['trades'][t_id]['orders'][o_id][
-                                'venue_id'],
-                            o_id,
-                            self.pf['trades'][t_id]['orders'][o_id]['status'],
-                            self.pf['trades'][t_id]['orders'][o_id]['venue']))
-
-            # Get orders from all venues with active trades.
-            orders = []
-            for venue in list(active_venues):
-                orders = orders + self.exchanges[venue].get_orders()
-
-            # Snapshot actual order state.
-            actual_order_snapshot = []
-            for order in portfolio_order_snapshot:
-                for conf in orders:
-                    if conf['venue_id'] == order[0]:
-                        actual_order_snapshot.append((
-                            conf['venue_id'],
-                            conf['order_id'],
-                            conf['status'],
-                            conf))
-
-            # Compare actual order state to local portfolio state.
-            for port, actual in zip(
-                    portfolio_order_snapshot, actual_order_snapshot):
-                if port[0] == actual[0]:
-                    if port[2] != actual[2]:
-
-                        # Order has been filled or cancelled.
-                        if (
-                            actual[2] == "FILLED" or actual[2] == "PARTIAL"
-                                or actual[2] == "CANCELLED"):
-
-                            # Derive the trade ID from order id.
-                            fill_conf = actual[3]
-                            fill_conf['trade_id'] = actual[1].partition("-")[0]
-
-                            # Store the new fill event.
-                            self.fills.append(FillEvent(fill_conf))
-
-                        else:
-                            # Something wrong with code if status is wrong.
-                            raise Exception(
-                                "Order status code error:", actual[2])
+            sleep(self.RECONCILE_INTERVAL)
 
-                else:
-                    # Something critically wrong if theres a missing venue ID.
-                    raise Exception("Order ID mistmatch. \nPortfolio v_id:",
-                                    port[0], "Actual v_id:", actual[0])
+            try:
+                self.reconcile()
 
-            # Wait til next minute elapses.
-            sleep(self.seconds_til_next_minute())
+            except Exception:
+                self.logger.info("Order reconciliation failed.")
+                traceback.print_exc()
+
+    def reconcile(self):
+        """
+        Fetch orders from venues with open trade orders and pass them to
+        on_order, which queues fills for any order state changes. Then
+        fetch executions missing from the portfolio execution ledger.
+        """
 
-    def seconds_til_next_minute(self):
-        now = datetime.datetime.utcnow().second
-        delay = 60 - now
-        return delay
+        # Instruments of open trade orders, by venue order ID.
+        instruments = set()
+        for v_id in self.pf.trades_by_venue_id.copy():
+            trade, o_id = self.pf.get_trade_by_venue_id(v_id)
+            if trade is not None:
+                instruments.add((trade['venue'], trade['symbol']))
+
+        count = 0
+        for venue in set(i[0] for i in instruments):
+            for conf in self.exchanges[venue].get_orders():
+                if self.on_order(conf):
+                    count += 1
+
+        # Catch up execution ledger with any executions missed.
+        for venue, symbol in instruments:
+            self.pf.sync_executions(venue, symbol)
+
+        if count:
+            self.logger.info(
+                "Order reconciliation found " + str(count) +
+                " fills not reported by venue websockets.")
@@ -13,7 +13,8 @@ from event_types import MarketEvent
 from itertools import groupby, count
 from pymongo import MongoClient, errors
 from itertools import groupby, count
-from event_types import MarketEvent
+from event_types import MarketEvent, MarketBatchEvent
+import numpy as np
 import pymongo
 import queue
 import time
@@ -30,18 +31,24 @@ class Datahandler:
     Strategy object to consume.
     """
 
-    def __init__(self, exchanges, logger, db, db_client):
+    def __init__(self, exchanges, logger, db, db_client, bar_cache=None):
         self.exchanges = exchanges
         self.logger = logger
         self.db = db
         self.db_client = db_client
         self.db_collections = {
             i.get_name(): db[i.get_name()] for i in self.exchanges}
+        self.bar_cache = bar_cache
         self.live_trading = False
         self.ready = False
         self.total_instruments = self.get_total_instruments()
         self.bars_save_to_db = queue.Queue(0)
 
+        # Stored data replay state, used when backtesting.
+        self.replay_ts = None
+        self.replay_end = None
+        self.replay_complete = False
+
         # Data processing performance tracking variables.
         self.parse_count = 0
         self.total_parse_time = 0
@@ -74,9 +81,10 @@ class Datahandler:
 
     def get_new_data(self):
         """
-        Return a list of market events (new bars) for all symbols from
-        all exchanges for the just-elapsed time period. Add new bar data
-        to queue for storage in DB, after current minutes cycle completes.
+        Return a list of market batch events, one per exchange, holding new
+        bars for all symbols for the just-elapsed time period. Add new bar
+        data to queue for storage in DB, after current minutes cycle
+        completes.
 
         Logs parse time for tick processing.
 
@@ -101,22 +109,114 @@ class Datahandler:
             " instruments' ticks in " + str(duration) + " seconds.")
         self.track_tick_processing_performance(duration)
 
-        # Wrap new 1 min bars in market events.
+        # Wrap new 1 min bars in a market batch event per exchange.
         new_market_events = []
         for exchange in self.exchanges:
             bars = exchange.get_new_bars()
+            new_bars = [
+                bar for symbol in exchange.get_symbols()
+                for bar in bars[symbol]]
+
+            if new_bars:
+                event = MarketBatchEvent.from_bars(exchange, new_bars)
+                new_market_events.append(event)
+
+                # Add bars to save-to-db-later queue.
+                # TODO: store bars concurrently in a separate process.
+                self.bars_save_to_db.put(event)
+
+        return new_market_events
+
+    def get_historic_data(self):
+        """
+        Return a list of market batch events, one per exchange, for the
+        next 1 min period of locally cached bars. Each call advances the
+        replay by one minute.
+
+        Args:
+            None.
+        Returns:
+            market_events: list containing market events.
+        Raises:
+            None.
+        """
+
+        if self.bar_cache is None:
+            raise Exception("Stored data replay requires a bar cache.")
+
+        if self.replay_ts is None:
+            self.start_replay()
+
+        market_events = []
+        while not market_events and not self.replay_complete:
+            for exchange in self.exchanges:
+                event = self.next_replay_batch(exchange)
+                if event:
+                    market_events.append(event)
 
+            self.replay_ts += 60
+            if self.replay_ts > self.replay_end:
+                self.replay_complete = True
+
+        return market_events
+
+    def start_replay(self, start_ts=None):
+        """
+        Set replay cursors to the given timestamp, or the oldest cached bar.
+
+        Args:
+            start_ts: epoch timestamp (int) to start replay from.
+        Returns:
+            None.
+        Raises:
+            None.
+        """
+
+        oldest, newest = [], []
+        for exchange in self.exchanges:
             for symbol in exchange.get_symbols():
+                venue = exchange.get_name()
+                if self.bar_cache.total_stored(venue, symbol):
+                    oldest.append(
+                        self.bar_cache.oldest_timestamp(venue, symbol))
+                    newest.append(
+                        self.bar_cache.newest_timestamp(venue, symbol))
+
+        if not oldest:
+            self.logger.info("No locally cached bars to replay.")
+            self.replay_ts, self.replay_end = 0, -1
+            self.replay_complete = True
+            return
+
+        self.replay_ts = start_ts if start_ts else min(oldest)
+        self.replay_end = max(newest)
+        self.replay_complete = False
+
+    def next_replay_batch(self, exchange):
+        """
+        Return a market batch event of cached bars for the current replay
+        timestamp for all of the exchanges symbols, or None if there are no
+        bars for that minute.
+        """
 
-                for bar in bars[symbol]:
-                    event = MarketEvent(exchange, bar)
-                    new_market_events.append(event)
+        venue = exchange.get_name()
+        symbols, rows = [], []
+        for symbol in exchange.get_symbols():
+            bars = self.bar_cache.get_range(
+                venue, symbol, self.replay_ts, self.replay_ts)
+            if len(bars['timestamp']):
+                symbols.append(symbol)
+                rows.append(bars)
 
-                    # Add bars to save-to-db-later queue.
-                    # TODO: store bars concurrently in a separate process.
-                    self.bars_save_to_db.put(event)
+        if not rows:
+            return None
 
-        return new_market_events
+        columns = {'symbol': np.array(symbols, dtype=str)}
+        for col in ['timestamp'] + MarketBatchEvent.COLUMNS:
+            columns[col] = np.concatenate([bars[col][:1] for bars in rows])
+        columns['timestamp'] = columns['timestamp'].astype(np.int64)
+
+        return MarketBatchEvent(exchange, columns)
 
     def track_tick_processing_performance(self, duration):
         """
@@ -168,6 +268,14 @@ class Datahandler:
             self.backfill_gaps(report)
             self.replace_null_bars(report)
 
+        # Bring local bar cache up to date with stored data.
+        if self.bar_cache is not None:
+            for exchange in self.exchanges:
+                for symbol in exchange.get_symbols():
+                    self.bar_cache.sync_from_db(
+                        exchange.get_name(), symbol,
+                        self.db_collections[exchange.get_name()])
+
         if output:
             self.logger.info("Data diagnostics complete.")
         self.ready = True
@@ -185,10 +293,11 @@ class Datahandler:
         """
 
         count = 0
+        to_cache = {}
         while True:
 
             try:
-                bar = self.bars_save_to_db.get(False)
+                event = self.bars_save_to_db.get(False)
 
             except queue.Empty:
                 self.logger.info(
@@ -197,19 +306,42 @@ class Datahandler:
                 break
 
             else:
-                if bar is not None:
-                    count += 1
-                    # store bar in relevant db collection
-                    try:
-                        self.db_collections[
-                            bar.exchange.get_name()].insert_one(bar.get_bar())
+                if event is not None:
+                    venue = event.get_exchange().get_name()
+                    bars = [bar.to_dict() for bar in event.get_bars()] if (
+                        event.type == "MARKET_BATCH") else [event.get_bar()]
+                    count += len(bars)
 
-                    # Skip duplicates if they exist.
-                    except pymongo.errors.DuplicateKeyError:
-                        continue
+                    # Group bars for local cache storage.
+                    for bar in bars:
+                        key = (venue, bar['symbol'])
+                        try:
+                            to_cache[key].append(bar)
+                        except KeyError:
+                            to_cache[key] = [bar]
+
+                    # Store bars in relevant db collection.
+                    try:
+                        self.db_collections[venue].insert_many(
+                            bars, ordered=False)
+
+                    # Skip duplicates if they exist, report other errors.
+                    except pymongo.errors.BulkWriteError as e:
+                        errors = [
+                            i for i in e.details['writeErrors'] if
+                            i['code'] != 11000]
+                        if errors:
+                            self.logger.info(
+                                "Failed to write " + str(len(errors)) +
+                                " " + venue + " bars to database: " +
+                                errors[0]['errmsg'])
 
                 self.bars_save_to_db.task_done()
 
+        if self.bar_cache is not None:
+            for (venue, symbol), bars in to_cache.items():
+                self.bar_cache.append(venue, symbol, bars)
+
     def data_status_report(self, exchange, symbol, output=False):
         """
         Create a stored data completness report for the given instrment.
@@ -397,6 +529,11 @@ class Datahandler:
 
                 doc_count = doc_count_after - doc_count_before
 
+                if self.bar_cache is not None:
+                    self.bar_cache.append(
+                        report['exchange'].get_name(), report['symbol'],
+                        bars_to_store)
+
                 self.logger.info(
                     "Saved " + str(doc_count) + " missing " +
                     report['symbol'] + " bars.")
@@ -545,6 +682,12 @@ class Datahandler:
                         doc_count += 1
                     except pymongo.errors.DuplicateKeyError:
                         continue  # skip duplicates if they exist
+
+                if self.bar_cache is not None:
+                    self.bar_cache.update(
+                        report['exchange'].get_name(), report['symbol'],
+                        bars_to_store)
+
                 doc_count_after = (
                     self.db_collections[report[
                         'exchange'].get_name()].count_documents(
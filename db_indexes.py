@@ -0,0 +1,252 @@
+"""
+trading-server is a multi-asset, multi-strategy, event-driven execution
+and backtesting platform (OEMS) for trading common markets.
+
+Copyright (C) 2020  Sam Breznikar <sam@sdbgroup.io>
+
+Licensed under GNU General Public License 3.0 or later.
+
+Some rights reserved. See LICENSE.md, AUTHORS.md.
+"""
+
+from pymongo import ASCENDING, DESCENDING, errors
+
+
+class IndexManager:
+    """
+    Declares the indexes required by the servers hot queries. Creates or
+    migrates those indexes on start-up, then checks with explain() that none
+    of the hot queries fall back to a collection scan.
+
+    When adding a new recurring query, declare it in the relevant *_QUERIES
+    dict along with any index it needs, so regressions are caught at start-up.
+    """
+
+    # Indexes required by price collections (one collection per venue).
+    PRICE_INDEXES = [
+        {'keys': [('symbol', ASCENDING), ('timestamp', ASCENDING)],
+         'name': 'symbol_1_timestamp_1', 'unique': True}]
+
+    # Price indexes superceded by PRICE_INDEXES, dropped once replaced.
+    LEGACY_PRICE_INDEXES = ['timestamp_1_symbol_1']
+
+    # Indexes required by non-price collections {collection: [indexes]}.
+    OTHER_INDEXES = {
+        'trades': [
+            {'keys': [('trade_id', ASCENDING)],
+             'name': 'trade_id_1', 'unique': True},
+            {'keys': [('portfolio_id', ASCENDING), ('complete', ASCENDING)],
+             'name': 'portfolio_id_1_complete_1'}],
+        'portfolio': [
+            {'keys': [('id', ASCENDING)],
+             'name': 'id_1', 'unique': True}]}
+
+    # Non-price indexes superceded by OTHER_INDEXES {collection: [names]}.
+    LEGACY_OTHER_INDEXES = {
+        'trades': ['portfolio_id_1']}
+
+    # Hot price queries {name: (filter, sort)}. Values are placeholders.
+    PRICE_QUERIES = {
+        'recent_bars': (
+            {"symbol": ""}, [("timestamp", DESCENDING)]),
+        'stored_bars': (
+            {"symbol": ""}, [("timestamp", ASCENDING)]),
+        'null_bars': (
+            {"$and": [
+                {"symbol": ""}, {"high": None}, {"low": None},
+                {"open": None}, {"close": None}, {"volume": 0}]}, None),
+        'bar_by_timestamp': (
+            {"$and": [{"symbol": ""}, {"timestamp": 0}]}, None),
+        'new_bars': (
+            {"symbol": "", "timestamp": {"$gt": 0}},
+            [("timestamp", ASCENDING)])}
+
+    # Hot non-price queries {collection: {name: (filter, sort)}}.
+    OTHER_QUERIES = {
+        'trades': {
+            'trade_by_id': ({"trade_id": 0}, None),
+            'portfolio_trades': ({"portfolio_id": 1}, None),
+            'open_trades': (
+                {"portfolio_id": 1, "complete": {"$in": [False, None]}},
+                None),
+            'newest_trade_id': ({}, [("trade_id", DESCENDING)])},
+        'portfolio': {
+            'portfolio_by_id': ({"id": 1}, None)}}
+
+    def __init__(self, logger, db_prices, db_other, venues):
+        self.logger = logger
+        self.db_prices = db_prices
+        self.db_other = db_other
+        self.venues = venues
+
+    def ensure_indexes(self):
+        """
+        Create missing indexes, replace indexes whose definition has changed
+        and drop legacy indexes that have been superceded.
+
+        Args:
+            None.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        for venue in self.venues:
+            collection = self.db_prices[venue]
+            for index in self.PRICE_INDEXES:
+                self.ensure_index(collection, index)
+
+            existing = collection.index_information()
+            for name in self.LEGACY_PRICE_INDEXES:
+                if name in existing:
+                    collection.drop_index(name)
+                    self.logger.info(
+                        "Dropped legacy index " + name + " from " +
+                        self.db_prices.name + "." + venue + ".")
+
+        for coll_name, indexes in self.OTHER_INDEXES.items():
+            for index in indexes:
+                self.ensure_index(self.db_other[coll_name], index)
+
+        for coll_name, names in self.LEGACY_OTHER_INDEXES.items():
+            collection = self.db_other[coll_name]
+            existing = collection.index_information()
+            for name in names:
+                if name in existing:
+                    collection.drop_index(name)
+                    self.logger.info(
+                        "Dropped legacy index " + name + " from " +
+                        self.db_other.name + "." + coll_name + ".")
+
+    def ensure_index(self, collection, index):
+        """
+        Create the given index on collection, or migrate it if an index of
+        the same name exists with a different definition.
+
+        Args:
+            collection: pymongo collection object.
+            index: index definition dict (keys, name, unique).
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        existing = collection.index_information()
+        unique = index.get('unique', False)
+
+        if index['name'] in existing:
+            current = existing[index['name']]
+            if (list(current['key']) == index['keys'] and
+                    current.get('unique', False) == unique):
+                return
+
+            self.logger.info(
+                "Index " + index['name'] + " on " + collection.name +
+                " has changed, rebuilding.")
+            collection.drop_index(index['name'])
+
+        self.logger.info(
+            "Creating index " + index['name'] + " on " + collection.name + ".")
+
+        try:
+            collection.create_index(
+                index['keys'], name=index['name'], unique=unique)
+
+        # Existing documents may violate a new unique constraint.
+        except errors.OperationFailure as e:
+            if e.code != 11000:
+                raise
+            self.logger.warning(
+                "Duplicate values prevent unique index " + index['name'] +
+                " on " + collection.name + ". Creating non-unique index.")
+            collection.create_index(index['keys'], name=index['name'])
+
+    def verify(self):
+        """
+        Explain each hot query and warn if any would scan a whole collection.
+
+        Args:
+            None.
+
+        Returns:
+            regressions: list of (collection name, query name) tuples for
+            queries not served by an index.
+
+        Raises:
+            None.
+        """
+
+        queries = []
+        for venue in self.venues:
+            for name, query in self.PRICE_QUERIES.items():
+                queries.append((self.db_prices[venue], name, query))
+
+        for coll_name, coll_queries in self.OTHER_QUERIES.items():
+            for name, query in coll_queries.items():
+                queries.append((self.db_other[coll_name], name, query))
+
+        regressions = []
+        for collection, name, (query_filter, sort) in queries:
+            cursor = collection.find(query_filter).limit(1)
+            if sort:
+                cursor = cursor.sort(sort)
+
+            stages = self.plan_stages(
+                cursor.explain()['queryPlanner']['winningPlan'])
+
+            if "COLLSCAN" in stages:
+                regressions.append((collection.name, name))
+                self.logger.warning(
+                    "Query " + name + " on " + collection.name +
+                    " is not indexed and will scan the whole collection.")
+
+        if not regressions:
+            self.logger.info("All hot queries are served by indexes.")
+
+        return regressions
+
+    def plan_stages(self, plan):
+        """
+        Return a list of all stage names in the given query plan tree.
+        """
+
+        stages = []
+        if isinstance(plan, dict):
+            if 'stage' in plan:
+                stages.append(plan['stage'])
+            for key in ['inputStage', 'queryPlan']:
+                if key in plan:
+                    stages += self.plan_stages(plan[key])
+            for child in plan.get('inputStages', []):
+                stages += self.plan_stages(child)
+
+        return stages
+
+    def index_report(self):
+        """
+        Return index information for all managed collections as a list of
+        dicts.
+        """
+
+        collections = [
+            (self.db_prices, self.db_prices[venue]) for venue in self.venues]
+        collections += [
+            (self.db_other, self.db_other[name]) for name in
+            self.OTHER_INDEXES.keys()]
+
+        indices = []
+        for db, collection in collections:
+            for name, info in collection.index_information().items():
+                keys = info.pop('key')
+                info.pop('ns', None)
+                info.pop('v', None)
+                indices.append({'db': db.name, 'collection': collection.name,
+                                'keys': keys, 'info': info})
+
+        return indices
@@ -9,15 +9,95 @@ Licensed under GNU General Public License 3.0 or later.
 Some rights reserved. See LICENSE.md, AUTHORS.md.
 """
 
+from types import MappingProxyType
 from dateutil import parser
 from datetime import datetime
+import pandas as pd
+import numpy as np
 
 
 class Event(object):
     """
-    Base class for system events.
+    Base class for system events. Events are slotted, subclasses must list
+    their attributes in __slots__.
     """
 
+    __slots__ = ()
+
+
+class Bar:
+    """
+    OHLCV bar. Slotted to keep allocation cost and memory per bar low, and
+    readable like a bar dict (bar['close']) so dict consumers work
+    unchanged. Only bar fields are readable by key. Convert with to_dict()
+    at the persistence boundary.
+
+    Timestamps mark bar close, see Exchange.build_OHLCV.
+    """
+
+    FIELDS = (
+        'symbol', 'timestamp', 'open', 'high', 'low', 'close', 'volume')
+
+    __slots__ = FIELDS
+
+    def __init__(self, symbol, timestamp, open, high, low, close, volume):
+        self.symbol = symbol            # Instrument ticker code.
+        self.timestamp = timestamp      # Epoch timestamp of bar close.
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+
+    @classmethod
+    def from_dict(cls, bar):
+        """
+        Create a Bar from a bar dict, or any object readable like one.
+        """
+
+        return cls(
+            bar['symbol'], bar['timestamp'], bar['open'], bar['high'],
+            bar['low'], bar['close'], bar['volume'])
+
+    def to_dict(self, symbol=True):
+        """
+        Return bar as a dict for DB storage, optionally less symbol.
+        """
+
+        bar = {
+            'timestamp': self.timestamp,
+            'open': self.open,
+            'high': self.high,
+            'low': self.low,
+            'close': self.close,
+            'volume': self.volume}
+
+        if symbol:
+            bar['symbol'] = self.symbol
+
+        return bar
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.FIELDS else default
+
+    def __eq__(self, other):
+        if isinstance(other, (Bar, dict)):
+            try:
+                return all(
+                    getattr(self, f) == other[f] for f in self.FIELDS)
+            except KeyError:
+                return False
+        return NotImplemented
+
+    def __repr__(self):
+        return "Bar(" + ", ".join(
+            f + "=" + repr(getattr(self, f)) for f in self.FIELDS) + ")"
+
 
 class MarketEvent(Event):
     """
@@ -28,10 +108,16 @@ class MarketEvent(Event):
     # Datetime object format string
     DTFMT = '%Y-%m-%d %H:%M'
 
-    def __init__(self, exchange, bar):
+    # Bar type of regular 1 min bars, see BarBuilder for other types.
+    MINUTE = "1Min"
+
+    __slots__ = ('type', 'exchange', 'bar', 'bar_type')
+
+    def __init__(self, exchange, bar, bar_type=MINUTE):
         self.type = 'MARKET'
         self.exchange = exchange
         self.bar = bar
+        self.bar_type = bar_type
 
     def __str__(self):
         return str("MarketEvent - Exchange: " + self.exchange.get_name() +
@@ -44,16 +130,269 @@ class MarketEvent(Event):
     def get_exchange(self):
         return self.exchange
 
+    def get_bar_type(self):
+        return self.bar_type
+
     def get_datetime(self):
         return datetime.fromtimestamp(
             self.bar['timestamp']).strftime(self.DTFMT),
 
 
+class MarketBatchEvent(Event):
+    """
+    Wrapper for all new 1 min bars from one venue for a period, as column
+    arrays. Consumed by Strategy and Portfolio in one pass, to avoid per
+    symbol event overhead at high symbol counts.
+
+    Null bars (no trades) hold NaN prices and are returned as None values
+    by get_bar() and get_bars(), which return Bar objects.
+    """
+
+    COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+    __slots__ = ('type', 'exchange', 'bar_type', 'bars')
+
+    def __init__(self, exchange, bars):
+        self.type = 'MARKET_BATCH'
+        self.exchange = exchange
+        self.bar_type = MarketEvent.MINUTE
+
+        # {'symbol': str array, 'timestamp': int64 array, ...float64 arrays}
+        self.bars = bars
+
+    @classmethod
+    def from_bars(cls, exchange, bars):
+        """
+        Create a batch event from a list of bar dicts.
+        """
+
+        columns = {
+            'symbol': np.array([b['symbol'] for b in bars], dtype=str),
+            'timestamp': np.array(
+                [b['timestamp'] for b in bars], dtype=np.int64)}
+
+        for col in cls.COLUMNS:
+            columns[col] = np.array([
+                np.nan if b[col] is None else b[col] for b in bars],
+                dtype=np.float64)
+
+        return cls(exchange, columns)
+
+    def __len__(self):
+        return len(self.bars['timestamp'])
+
+    def __str__(self):
+        return str("MarketBatchEvent - Exchange: " +
+                   self.exchange.get_name() + " Bars: " + str(len(self)))
+
+    def get_exchange(self):
+        return self.exchange
+
+    def get_bar_type(self):
+        return self.bar_type
+
+    def get_columns(self):
+        return self.bars
+
+    def get_symbols(self):
+        return self.bars['symbol'].tolist()
+
+    def get_timestamps(self):
+        """
+        Return sorted list of distinct bar timestamps in the batch.
+        """
+
+        return np.unique(self.bars['timestamp']).tolist()
+
+    def get_bars(self, timestamp=None):
+        """
+        Return bars as a list of Bars, optionally only those with the
+        given timestamp.
+        """
+
+        rows = slice(None) if timestamp is None else (
+            self.bars['timestamp'] == timestamp)
+
+        columns = [
+            self.bars['symbol'][rows].tolist(),
+            self.bars['timestamp'][rows].tolist()] + [
+            [None if v != v else v for v in self.bars[col][rows].tolist()]
+            for col in self.COLUMNS]
+
+        return [Bar(*row) for row in zip(*columns)]
+
+    def get_bar(self, symbol):
+        """
+        Return the newest Bar for the given symbol, or None.
+        """
+
+        rows = np.flatnonzero(self.bars['symbol'] == symbol)
+        if not len(rows):
+            return None
+
+        i = rows[-1]
+        values = [float(self.bars[col][i]) for col in self.COLUMNS]
+
+        return Bar(symbol, int(self.bars['timestamp'][i]), *[
+            None if v != v else v for v in values])
+
+    def get_events(self):
+        """
+        Return the batch as a list of single bar MarketEvents.
+        """
+
+        return [MarketEvent(self.exchange, bar) for bar in self.get_bars()]
+
+
+class DatasetSnapshot:
+    """
+    Immutable snapshot of the newest rows of a dataset, bars plus feature
+    columns, as read-only numpy arrays. Cheap to pass between threads and
+    processes, and to serialise with to_dict().
+
+    Read-only source arrays, e.g BarCache views, are shared without
+    copying. Writeable arrays are copied, so later in-place writes to the
+    source, like pandas fillna(inplace=True), cant change the snapshot.
+    Only the snapshot rows are ever copied, never the whole dataset.
+    """
+
+    # Rows kept by default, enough for trade setup images.
+    DEFAULT_ROWS = 150
+
+    __slots__ = ('timestamp', 'columns')
+
+    def __init__(self, timestamp, columns):
+        self.timestamp = self.freeze(timestamp)     # Epoch seconds, int64.
+        self.columns = MappingProxyType({
+            col: self.freeze(values) for col, values in columns.items()})
+
+    def freeze(self, values):
+        """
+        Return a read-only array of values, copied only if writeable.
+        """
+
+        values = np.asarray(values)
+        if values.flags.writeable:
+            values = values.copy()
+        else:
+            values = values.view()
+        values.flags.writeable = False
+
+        return values
+
+    @classmethod
+    def from_columns(cls, timestamp, columns, rows=DEFAULT_ROWS):
+        """
+        Create a snapshot of the newest rows of column arrays.
+
+        Args:
+            timestamp: array of epoch second timestamps.
+            columns: {column name: array} dict, same length as timestamp.
+            rows: number of newest rows to keep, None for all.
+
+        Returns:
+            DatasetSnapshot.
+
+        Raises:
+            None.
+        """
+
+        start = 0 if rows is None else max(len(timestamp) - rows, 0)
+
+        return cls(
+            np.asarray(timestamp)[start:],
+            {col: np.asarray(values)[start:]
+             for col, values in columns.items()})
+
+    @classmethod
+    def from_frame(cls, df, rows=DEFAULT_ROWS):
+        """
+        Create a snapshot of the newest rows of a timestamp indexed
+        dataframe, e.g a Strategy dataset with its feature columns.
+        """
+
+        start = 0 if rows is None else max(len(df.index) - rows, 0)
+        timestamp = df.index.values[start:].astype(
+            'datetime64[s]').astype(np.int64)
+
+        # Numeric datasets convert as one 2D array of their common dtype,
+        # far cheaper than per-column access. Non-numeric columns fall back
+        # to per-column arrays.
+        values = df.values[start:]
+        if values.dtype.kind in "fiu":
+            columns = {
+                col: values[:, i] for i, col in enumerate(df.columns)}
+        else:
+            columns = {
+                col: df[col].to_numpy()[start:] for col in df.columns}
+
+        return cls.from_columns(timestamp, columns, None)
+
+    @classmethod
+    def from_dict(cls, snapshot):
+        """
+        Create a snapshot from a dict made by to_dict().
+        """
+
+        return cls(
+            np.array(snapshot['timestamp'], dtype=np.int64),
+            {col: np.array(
+                [np.nan if v is None else v for v in values], dtype=float)
+             for col, values in snapshot['columns'].items()})
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def __reduce__(self):
+        return (DatasetSnapshot, (self.timestamp, dict(self.columns)))
+
+    def get_columns(self):
+        return list(self.columns.keys())
+
+    def tail(self, rows):
+        """
+        Return a snapshot of the newest rows, sharing this snapshots arrays.
+        """
+
+        return DatasetSnapshot.from_columns(self.timestamp, self.columns, rows)
+
+    def to_frame(self):
+        """
+        Return a new (writeable) dataframe indexed by timestamp.
+        """
+
+        df = pd.DataFrame(
+            {col: values.copy() for col, values in self.columns.items()},
+            index=pd.to_datetime(self.timestamp.copy(), unit='s'))
+        df.index.name = "timestamp"
+
+        return df
+
+    def to_dict(self):
+        """
+        Return snapshot as a dict of lists for DB storage, NaN as None.
+        """
+
+        return {
+            'timestamp': self.timestamp.tolist(),
+            'columns': {
+                col: [None if v != v else v for v in values.tolist()]
+                for col, values in self.columns.items()}}
+
+
 class SignalEvent(Event):
     """
     Entry signal. Consumed by Portfolio to produce Order events.
     """
 
+    __slots__ = (
+        'type', 'entry_ts', 'timeframe', 'strategy', 'venue', 'symbol',
+        'direction', 'entry_price', 'entry_type', 'targets', 'stop_price',
+        'void_price', 'instrument_count', 'trail', 'op_data', 'note')
+
     def __init__(self, symbol: str, entry_ts, direction: str, timeframe: str,
                  strategy: str, venue, entry_price: float, entry_type: str,
                  targets: list, stop_price: float, void_price: float,
@@ -73,7 +412,7 @@ class SignalEvent(Event):
         self.void_price = void_price    # Invalidation price.
         self.instrument_count = ic      # # of instruments in use.
         self.trail = trail              # True or False for trailing stop.
-        self.op_data = dataset          # Dataset used to generate signal.
+        self.op_data = dataset          # DatasetSnapshot used by signal.
         self.note = note                # Signal notes.
 
     def __str__(self):
@@ -118,26 +457,20 @@ class OrderEvent(Event):
     Contains trade details to be sent to a broker/exchange.
     """
 
+    __slots__ = ('type', 'order_dict')
+
     def __init__(self, order_dict):
         self.type = 'ORDER'
         self.order_dict = order_dict
-        self.trade_id = order_dict['trade_id']
-        self.order_id = order_dict['order_id']
-        self.timestamp = order_dict['timestamp']
-        self.avg_fill_price = order_dict['avg_fill_price']
-        self.currency = order_dict['currency']
-        self.venue_id = order_dict['venue_id']
-        self.direction = order_dict['direction']
-        self.size = order_dict['size']
-        self.price = order_dict['price']
-        self.order_type = order_dict['order_type']
-        self.metatype = order_dict['metatype']
-        self.void_price = order_dict['void_price']
-        self.trail = order_dict['trail']
-        self.reduce_only = order_dict['reduce_only']
-        self.post_only = order_dict['post_only']
-        self.batch_size = order_dict['batch_size']
-        self.status = order_dict['status']
+
+    def __getattr__(self, name):
+        # Order fields (event.price, event.status etc) read from order dict.
+        if name == "order_dict":
+            raise AttributeError(name)
+        try:
+            return self.order_dict[name]
+        except KeyError:
+            raise AttributeError(name)
 
     def __str__(self):
         return str(" ")
@@ -152,6 +485,8 @@ class FillEvent(Event):
     actual fill price, timestamp, etc.
     """
 
+    __slots__ = ('type', 'order_conf', 'fees')
+
     def __init__(self, order_conf):
         self.type = 'FILL'
         self.order_conf = order_conf
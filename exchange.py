@@ -9,18 +9,289 @@ Licensed under GNU General Public License 3.0 or later.
 Some rights reserved. See LICENSE.md, AUTHORS.md.
 """
 
-from abc import ABC, abstractmethod
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
+from abc import ABC, abstractmethod
+from analytics import RunningStats
+from urllib.parse import urlparse
+from functools import partial
+from requests import Session
+from threading import Lock
+import numpy as np
+import asyncio
+import time
 import os
 
 
 class Exchange(ABC):
     """
     Exchange abstract class, concrete brokers/exchange classes to inherit this.
+
+    All venue REST requests should use get() or send(), which share a pooled
+    keep-alive session with retries and record per-endpoint request timing.
+
+    Coroutine variants of the request-bound methods (*_async) run the
+    blocking connector methods in a thread pool sized to the connection
+    pool, so callers can overlap requests with asyncio.gather().
     """
 
+    # Seconds before an unanswered request is abandoned.
+    REQUEST_TIMEOUT = 10
+
+    # Connection pools (one per host) and max open connections per host.
+    POOL_CONNECTIONS = 4
+    POOL_MAXSIZE = 8
+
+    # Retry behaviour for failed connections and overloaded venues.
+    # Only idempotent methods are retried by the session. A 502 or 504 may
+    # follow an order the venue accepted, so POST requests are retried by
+    # send() only on statuses returned before the request is processed.
+    RETRY_TOTAL = 5
+    RETRY_BACKOFF = 0.25
+    RETRY_STATUSES = [502, 503, 504]
+    POST_RETRY_STATUSES = [503]
+
+    # Max requests per RATE_PERIOD seconds, None for no client-side limit.
+    # Bulk data requests (get) leave RATE_RESERVE requests for orders (send).
+    RATE_LIMIT = None
+    RATE_PERIOD = 60
+    RATE_RESERVE = 0
+
+    # Tick columns, see get_recent_ticks.
+    TICK_DTYPES = {
+        'timestamp': np.int64,      # Epoch milliseconds.
+        'price': np.float64,
+        'size': np.float64,
+        'side': np.int8,            # 1 buy, -1 sell.
+        'trade_id': 'S40'}
+
     def __init__(self):
-        pass
+        self.session = self.create_session()
+        self.executor = ThreadPoolExecutor(max_workers=self.POOL_MAXSIZE)
+
+        # Timestamps of requests in the current rate period.
+        self.request_times = deque()
+        self.rate_lock = Lock()
+
+        # Request latency per endpoint {path: RunningStats}.
+        self.request_stats = {}
+        self.request_max = {}
+        self.request_errors = {}
+        self.stats_lock = Lock()
+
+    def create_session(self):
+        """
+        Args:
+            None.
+
+        Returns:
+            requests Session with pooled, keep-alive connections and retries
+            of idempotent requests for both http and https.
+
+        Raises:
+            None.
+        """
+
+        # Return the last response once retries run out, callers check it.
+        retries = Retry(
+            total=self.RETRY_TOTAL,
+            backoff_factor=self.RETRY_BACKOFF,
+            status_forcelist=self.RETRY_STATUSES,
+            raise_on_status=False)
+
+        adapter = HTTPAdapter(
+            pool_connections=self.POOL_CONNECTIONS,
+            pool_maxsize=self.POOL_MAXSIZE,
+            max_retries=retries)
+
+        session = Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        return session
+
+    def get(self, url, throttled=False, **kwargs):
+        """
+        Args:
+            url: request url (string).
+            throttled: True if the caller already throttled the request,
+                e.g with throttle_async().
+            kwargs: passed to requests Session.get().
+
+        Returns:
+            requests Response object.
+
+        Raises:
+            requests exceptions if the request fails after retries.
+        """
+
+        if not throttled:
+            self.throttle(self.RATE_RESERVE)
+
+        kwargs.setdefault('timeout', self.REQUEST_TIMEOUT)
+        start = time.time()
+        try:
+            response = self.session.get(url, **kwargs)
+        except Exception:
+            self.record_request(url, start, None)
+            raise
+
+        self.record_request(url, start, response.status_code)
+
+        return response
+
+    def send(self, request, **kwargs):
+        """
+        Args:
+            request: prepared request object.
+            kwargs: passed to requests Session.send().
+
+        Returns:
+            requests Response object. POST requests are retried while the
+            venue responds with POST_RETRY_STATUSES, the last response is
+            returned.
+
+        Raises:
+            requests exceptions if the request fails after retries.
+        """
+
+        kwargs.setdefault('timeout', self.REQUEST_TIMEOUT)
+
+        for attempt in range(self.RETRY_TOTAL + 1):
+            self.throttle()
+
+            start = time.time()
+            try:
+                response = self.session.send(request, **kwargs)
+            except Exception:
+                self.record_request(request.url, start, None)
+                raise
+
+            self.record_request(request.url, start, response.status_code)
+
+            if (
+                request.method != "POST" or attempt == self.RETRY_TOTAL or
+                    response.status_code not in self.POST_RETRY_STATUSES):
+                return response
+
+            time.sleep(self.RETRY_BACKOFF * 2 ** attempt)
+
+    def throttle(self, reserve=0):
+        """
+        Block until a request can be made without exceeding RATE_LIMIT
+        requests per RATE_PERIOD, keeping reserve requests in hand.
+
+        Args:
+            reserve: number of requests in the period to leave unused.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        while True:
+            wait = self.reserve_request(reserve)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def throttle_async(self, reserve=0):
+        """
+        Coroutine variant of throttle. Waits without holding a thread pool
+        worker, so concurrent requests are not queued behind each others
+        waits.
+        """
+
+        while True:
+            wait = self.reserve_request(reserve)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def reserve_request(self, reserve=0):
+        """
+        Record a request in the current rate period if one can be made
+        without exceeding RATE_LIMIT, keeping reserve requests in hand.
+
+        Returns:
+            0 if the request can be made, otherwise seconds until the oldest
+            request in the period expires.
+        """
+
+        if not self.RATE_LIMIT:
+            return 0
+
+        with self.rate_lock:
+            now = time.time()
+            while (
+                self.request_times and
+                    self.request_times[0] <= now - self.RATE_PERIOD):
+                self.request_times.popleft()
+
+            if len(self.request_times) < self.RATE_LIMIT - reserve:
+                self.request_times.append(now)
+                return 0
+
+            return max(
+                self.request_times[0] + self.RATE_PERIOD - now, 0.001)
+
+    def empty_ticks(self):
+        """
+        Return tick columns containing no ticks.
+        """
+
+        return {
+            col: np.empty(0, dtype=dtype) for col, dtype in
+            self.TICK_DTYPES.items()}
+
+    def record_request(self, url, start, status):
+        """
+        Record request duration and outcome against the urls endpoint.
+        """
+
+        duration = time.time() - start
+        path = urlparse(url).path
+
+        with self.stats_lock:
+            if path not in self.request_stats:
+                self.request_stats[path] = RunningStats()
+            self.request_stats[path].update(duration)
+            self.request_max[path] = max(
+                duration, self.request_max.get(path, 0))
+
+            if status is None or status >= 400:
+                key = path + " " + str(status)
+                self.request_errors[key] = self.request_errors.get(key, 0) + 1
+
+    def get_request_stats(self):
+        """
+        Args:
+            None.
+
+        Returns:
+            Dict of request count, mean and max duration (seconds) and error
+            counts per endpoint path.
+
+        Raises:
+            None.
+        """
+
+        with self.stats_lock:
+            stats = {
+                path: {
+                    'requests': i.count,
+                    'mean': i.mean,
+                    'std': i.std(),
+                    'max': self.request_max[path]}
+                for path, i in self.request_stats.items()}
+            stats['errors'] = dict(self.request_errors)
+
+        return stats
 
     def get_new_bars(self):
         """
@@ -207,6 +478,98 @@ class Exchange(ABC):
                    'volume': 0}
             return bar
 
+    def register_fill_callback(self, callback):
+        """
+        Set the function to be called with a normalised order confirmation
+        dict whenever the venue reports an order fill or cancellation.
+
+        Args:
+            callback: function taking one order conf dict.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        self.fill_callback = callback
+
+    def register_execution_callback(self, callback):
+        """
+        Set the function to be called with a list of normalised execution
+        dicts (see get_executions) whenever the venue reports executions.
+
+        Args:
+            callback: function taking a list of execution dicts.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        self.execution_callback = callback
+
+    def register_trade_callback(self, callback):
+        """
+        Set the function to be called with new public trades as they are
+        reported by the venue, e.g BarBuilder.add_ticks.
+
+        Args:
+            callback: function taking a symbol and a dict of tick columns
+                (see TICK_DTYPES), called once per symbol per update.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        self.trade_callback = callback
+
+    async def run_async(self, method, *args, **kwargs):
+        """
+        Args:
+            method: blocking connector method or function.
+            args, kwargs: passed to method.
+
+        Returns:
+            Result of method, awaited without blocking the event loop.
+
+        Raises:
+            Exceptions raised by method.
+        """
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, partial(method, *args, **kwargs))
+
+    async def get_bars_in_period_async(self, symbol, start_time, total):
+        return await self.run_async(
+            self.get_bars_in_period, symbol, start_time, total)
+
+    async def place_bulk_orders_async(self, orders):
+        return await self.run_async(self.place_bulk_orders, orders)
+
+    async def cancel_orders_async(self, order_ids):
+        return await self.run_async(self.cancel_orders, order_ids)
+
+    async def close_position_async(self, symbol, qty=None, direction=None):
+        return await self.run_async(
+            self.close_position, symbol, qty, direction)
+
+    async def get_orders_async(self, *args, **kwargs):
+        return await self.run_async(self.get_orders, *args, **kwargs)
+
+    async def get_executions_async(self, *args, **kwargs):
+        return await self.run_async(self.get_executions, *args, **kwargs)
+
+    async def get_position_async(self, symbol):
+        return await self.run_async(self.get_position, symbol)
+
     def finished_parsing_ticks(self):
         return self.finished_parsing_ticks
 
@@ -404,14 +767,15 @@ class Exchange(ABC):
     def get_recent_ticks(symbol: str, n: int):
         """
         Args:
-            symbol:
+            symbol: instrument ticker code (string)
             n: number of minutes worth of ticks (int)
 
         Returns:
-            Instrument ticker code (string).
+            Ticks for the last n complete minutes, in time order, as a dict
+            of numpy arrays with columns and dtypes per TICK_DTYPES.
 
         Raises:
-            Tick data timestamp mismatch error.
+            None.
 
         """
 
@@ -22,27 +22,32 @@ class Features:
     Model feature library.
     """
 
-    def trending(self, lookback_period: int, bars):
+    def trending(self, lookback_period: int, bars, window: int = 5):
         """
         Return True if price action (bars) forming successive higher or
         lower swings. Return direction = -1 for downtrend, 0 for no trend,
         1 for uptrend.
 
+        Swings are the fractal highs and lows (see fractals) of the last
+        lookback_period bars. Needs three of each to form a trend.
+
         Returns:
-            trending
+            trending, direction
         """
 
         self.check_bars_type(bars)
 
-        fractals = self.fractals(bars[lookback_period:], window=window)
-        highs = np.multiply(bars.high.values, fractals)
-        highs = highs[highs > 0]
-        lows = np.multiply(bars.low.values, fractals)
-        lows = lows[lows < 0]*(-1)
+        bars = bars.iloc[-lookback_period:]
+        fractals = self.fractals(bars, window=window)
+        highs = bars.high.values[fractals == 1]
+        lows = bars.low.values[fractals == -1]
 
         trending = False
         direction = 0
 
+        if len(highs) < 3 or len(lows) < 3:
+            return trending, direction
+
         if (highs[-1] > highs[-2] and highs[-2] > highs[-3]
                 and lows[-1] > lows[-2] and lows[-2] > lows[-3]):
             trending = True
@@ -334,46 +339,99 @@ class Features:
         fractal or a bottom fractal. Returns 1 for top fractals, 0 for
         non-fractals, -1 for bottom fractals.
 
-        The Formulas for Fractals Are:
-            Bearish Fractal (-1)=
+        The Formulas for Fractals Are (window = 5):
+            Top Fractal (1) =
             High(N)>High(N−2) and
             High(N)>High(N−1) and
             High(N)>High(N+1) and
             High(N)>High(N+2)
 
-            ﻿Bullish Fractal (1) =
+            Bottom Fractal (-1) =
             Low(N)<Low(N−2) and
             Low(N)<Low(N−1) and
             Low(N)<Low(N+1) and
             Low(N)<Low(N+2)
 
         where N is center bar in window and (N+-1) (N+-2) are bars on either
-        side of the center bar.
-​
+        side of the center bar. Wider odd windows compare (window - 1) / 2
+        bars either side, even windows are widened by one. The first and
+        last (window - 1) / 2 bars are unconfirmed and always 0.
+        """
+
+        self.check_bars_type(bars)
+
+        return self.fractal_signals(
+            bars['high'].values, bars['low'].values, window)
+
+    def fractals_incremental(self, bars, previous, window: int = 5):
+        """
+        Return fractals for bars (see fractals), given previous, the
+        fractals of the same bars before new bars were appended. Only the
+        bars whose window includes a new bar are re-evaluated, so a single
+        new bar costs O(window) rather than O(len(bars)).
+
+        Args:
+            bars: OHLCV dataframe.
+            previous: fractals array for bars[:len(previous)].
+            window: fractal window size.
+
+        Returns:
+            fractals: np.ndarray of size len(bars).
+
+        Raises:
+            None.
         """
+
         self.check_bars_type(bars)
+
+        highs = bars['high'].values
+        lows = bars['low'].values
+        n, m = len(highs), len(previous)
+        half = (window + 1 - window % 2) // 2
+
+        if m > n:
+            return self.fractal_signals(highs, lows, window)
+
+        # Re-evaluate centre bars from m - half, using half bars before them.
+        start = max(0, m - 2 * half)
+        segment = self.fractal_signals(highs[start:], lows[start:], window)
+
+        frac = np.zeros(n)
+        frac[:m] = previous
+        lo = start + half if start else 0
+        frac[lo:] = segment[lo - start:]
+
+        return frac
+
+    def fractal_signals(self, highs, lows, window: int = 5):
+        """
+        Return fractals (see fractals) for arrays of bar highs and lows.
+        Vectorised, compares each side offset for all bars at once.
+        """
+
         if (window % 2 != 1):
             window += 1
 
-        # df.shape[0] is more logical but has a slower runtime, so I went with
-        # len(df.index) instead:
-        bars_length = len(bars.index)
-        frac = np.zeros(bars_length).flatten()
+        half = (window - 1) // 2
+        n = len(highs)
+        frac = np.zeros(n)
 
-        for bar in range((window-1)/2, bars_length-(window-1)/2):
-            if (bars['high'][bar] > bars['high'][bar-2]
-                    and bars['high'][bar] > bars['high'][bar-1]
-                    and bars['high'][bar] > bars['high'][bar+1]
-                    and bars['high'][bar] > bars['high'][bar+2]):
+        if n < window:
+            return frac
 
-                frac[bar] = 1
+        centre_highs = highs[half:n - half]
+        centre_lows = lows[half:n - half]
+        top = np.ones(n - 2 * half, dtype=bool)
+        bottom = np.ones(n - 2 * half, dtype=bool)
 
-            elif (bars['low'][bar] < bars['low'][bar-2]
-                    and bars['low'][bar] < bars['low'][bar-1]
-                    and bars['low'][bar] < bars['low'][bar+1]
-                    and bars['low'][bar] < bars['low'][bar+2]):
+        for offset in range(1, half + 1):
+            top &= centre_highs > highs[half - offset:n - half - offset]
+            top &= centre_highs > highs[half + offset:n - half + offset]
+            bottom &= centre_lows < lows[half - offset:n - half - offset]
+            bottom &= centre_lows < lows[half + offset:n - half + offset]
 
-                frac[bar] = -1
+        # Top fractals take precedence where a bar is both.
+        frac[half:n - half] = np.where(top, 1, np.where(bottom, -1, 0))
 
         return frac
 
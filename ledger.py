@@ -0,0 +1,203 @@
+"""
+trading-server is a multi-asset, multi-strategy, event-driven execution
+and backtesting platform (OEMS) for trading common markets.
+
+Copyright (C) 2020  Sam Breznikar <sam@sdbgroup.io>
+
+Licensed under GNU General Public License 3.0 or later.
+
+Some rights reserved. See LICENSE.md, AUTHORS.md.
+"""
+
+from threading import Lock
+from bisect import bisect_left, bisect_right
+import time
+
+
+class ExecutionLedger:
+    """
+    Local record of order executions, populated incrementally from venue
+    execution streams and delta fetches of venue execution history.
+
+    Executions are indexed by order ID and, per venue and symbol, by
+    timestamp, so pnl and fee calculations need no venue requests.
+    Executions are normalised dicts as returned by Exchange.get_executions,
+    plus 'venue' and 'exec_id' fields. Duplicates are skipped by exec_id.
+
+    Executions no longer needed, e.g those of archived trades, are dropped
+    with prune() to bound memory use.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.lock = Lock()
+
+        # Seen execution ID's.
+        self.exec_ids = set()
+
+        # Executions by order ID {order_id: [executions]}.
+        self.by_order = {}
+
+        # Executions by instrument in time order
+        # {(venue, symbol): ([timestamps], [executions])}.
+        self.by_instrument = {}
+
+    def add(self, executions):
+        """
+        Add executions to the ledger, skipping any already recorded.
+
+        Args:
+            executions: list of execution dicts.
+
+        Returns:
+            Number of executions added (int).
+
+        Raises:
+            None.
+        """
+
+        count = 0
+
+        with self.lock:
+            for execution in executions:
+                if execution['exec_id'] in self.exec_ids:
+                    continue
+                self.exec_ids.add(execution['exec_id'])
+
+                self.by_order.setdefault(
+                    execution['order_id'], []).append(execution)
+
+                timestamps, execs = self.by_instrument.setdefault(
+                    (execution['venue'], execution['symbol']), ([], []))
+                i = bisect_right(timestamps, execution['timestamp'])
+                timestamps.insert(i, execution['timestamp'])
+                execs.insert(i, execution)
+
+                count += 1
+
+        return count
+
+    def get_by_order(self, order_id):
+        """
+        Return list of executions for the given order ID.
+        """
+
+        with self.lock:
+            return list(self.by_order.get(order_id, []))
+
+    def get_range(self, venue, symbol, start_ts=None, end_ts=None):
+        """
+        Return executions for the given instrument with start_ts <=
+        timestamp <= end_ts, oldest first.
+
+        Args:
+            venue: venue name (string).
+            symbol: instrument ticker code (string).
+            start_ts: first epoch timestamp (int), None for oldest.
+            end_ts: last epoch timestamp (int), None for newest.
+
+        Returns:
+            list of execution dicts.
+
+        Raises:
+            None.
+        """
+
+        with self.lock:
+            timestamps, execs = self.by_instrument.get(
+                (venue, symbol), ([], []))
+
+            lo = 0 if start_ts is None else bisect_left(timestamps, start_ts)
+            hi = len(timestamps) if end_ts is None else bisect_right(
+                timestamps, end_ts)
+
+            return execs[lo:hi]
+
+    def newest_timestamp(self, venue, symbol):
+        """
+        Return timestamp of newest recorded execution for the given
+        instrument, or None if none recorded.
+        """
+
+        with self.lock:
+            timestamps, _ = self.by_instrument.get((venue, symbol), ([], []))
+            return timestamps[-1] if timestamps else None
+
+    def sync(self, exchange, symbol, start_ts=None):
+        """
+        Fetch executions from start_ts, or if not given, executions newer
+        than the newest recorded execution, from the given venue. Executions
+        already recorded are skipped.
+
+        Args:
+            exchange: exchange object.
+            symbol: instrument ticker code (string).
+            start_ts: epoch timestamp to fetch from, None to fetch from the
+                newest recorded execution.
+
+        Returns:
+            Number of executions added (int).
+
+        Raises:
+            None.
+        """
+
+        # Older executions may have been missed, e.g while disconnected.
+        start = start_ts if start_ts is not None else self.newest_timestamp(
+            exchange.get_name(), symbol)
+
+        count = self.add(
+            exchange.get_executions(symbol, start, int(time.time())))
+
+        if count:
+            self.logger.info(
+                "Added " + str(count) + " " + exchange.get_name() + " " +
+                symbol + " executions to ledger.")
+
+        return count
+
+    def prune(self, venue, symbol, before_ts=None):
+        """
+        Drop executions for the given instrument older than before_ts.
+
+        Args:
+            venue: venue name (string).
+            symbol: instrument ticker code (string).
+            before_ts: epoch timestamp (int), None to drop all.
+
+        Returns:
+            Number of executions dropped (int).
+
+        Raises:
+            None.
+        """
+
+        with self.lock:
+            timestamps, execs = self.by_instrument.get(
+                (venue, symbol), ([], []))
+
+            hi = len(timestamps) if before_ts is None else bisect_left(
+                timestamps, before_ts)
+            dropped = execs[:hi]
+            if not dropped:
+                return 0
+
+            del timestamps[:hi]
+            del execs[:hi]
+            if not timestamps:
+                del self.by_instrument[(venue, symbol)]
+
+            ids = set()
+            for execution in dropped:
+                self.exec_ids.discard(execution['exec_id'])
+                ids.add(id(execution))
+
+            for order_id in set(i['order_id'] for i in dropped):
+                remaining = [
+                    i for i in self.by_order[order_id] if id(i) not in ids]
+                if remaining:
+                    self.by_order[order_id] = remaining
+                else:
+                    del self.by_order[order_id]
+
+        return len(dropped)
@@ -9,10 +9,16 @@ Licensed under GNU General Public License 3.0 or later.
 Some rights reserved. See LICENSE.md, AUTHORS.md.
 """
 
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock
+from time import sleep, time
 from abc import ABC
+import traceback
+import requests
+import queue
 import json
 import os
-import requests
 
 
 class MessagingClient(ABC):
@@ -24,68 +30,237 @@ class MessagingClient(ABC):
 
 
 class Telegram(MessagingClient):
+    """
+    Telegram bot client. Outgoing messages are queued in an outbox and sent
+    by a background worker, so send methods return immediately.
+
+    Each message is sent to all whitelisted users concurrently over a
+    pooled HTTP session, in the order messages were queued. Images are
+    uploaded once and resent by file_id. Failed requests are retried with
+    exponential backoff, honouring telegram's retry_after on 429.
+    """
 
     URL = "https://api.telegram.org/bot"
 
+    FANOUT_WORKERS = 8      # Concurrent requests per message.
+    RETRIES = 4             # Attempts per request.
+    BACKOFF = 0.5           # Initial retry delay in seconds, doubles.
+    TIMEOUT = 10            # Request timeout in seconds.
+
     def __init__(self, logger):
         super().__init__()
         self.logger = logger
         self.token = self.get_token()
         self.whitelist = self.get_whitelist()
+        self.recipients = json.loads(self.whitelist)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.FANOUT_WORKERS)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.fanout = ThreadPoolExecutor(max_workers=self.FANOUT_WORKERS)
+
+        # Queued messages (message type, args).
+        self.outbox = queue.Queue(0)
+
+        thread = Thread(target=self.process_outbox, daemon=True)
+        thread.start()
 
     def send_image(self, image_path, text):
+        """
+        Queue image with caption text for sending to whitelisted users.
+        """
+
+        self.outbox.put(("image", (image_path, text)))
+
+    def send_option_keyboard(self, keyboard):
+        """
+        Queue trade consent keyboard for sending to whitelisted users.
+        """
+
+        self.outbox.put(("keyboard", (keyboard,)))
+
+    def send_message(self, text):
+        """
+        Queue text message for sending to whitelisted users.
+        """
 
-        url = self.URL + self.token + "/sendPhoto"
-        files = {'photo': open(image_path, 'rb')}
+        self.outbox.put(("message", (text,)))
+
+    def flush(self):
+        """
+        Block until all queued messages have been sent.
+        """
+
+        self.outbox.join()
+
+    def process_outbox(self):
+        """
+        Send queued messages. Runs in its own thread.
+        """
 
-        # Send image only to whitelisted users
-        for user_id in json.loads(self.whitelist):
+        senders = {
+            "image": self.deliver_image,
+            "keyboard": self.deliver_option_keyboard,
+            "message": self.deliver_message}
 
-            data = {'chat_id': user_id, 'caption': text}
-            r = requests.post(url, files=files, data=data)
+        while True:
+            msg_type, args = self.outbox.get()
 
-            if int(r.status_code) == 200:
+            try:
+                senders[msg_type](*args)
+
+            except Exception:
+                self.logger.info("Failed to send " + msg_type + " via telegram.")
+                traceback.print_exc()
+
+            self.outbox.task_done()
+
+    def deliver_image(self, image_path, text):
+
+        with open(image_path, 'rb') as f:
+            image = f.read()
+
+        # Upload to the first user, then reuse the uploaded file for the rest.
+        file_id = None
+        remaining = list(self.recipients)
+        while remaining and file_id is None:
+            user_id = remaining.pop(0)
+            r = self.post(
+                "sendPhoto", data={'chat_id': user_id, 'caption': text},
+                files={'photo': (os.path.basename(image_path), image)})
+
+            if r is not None and r.status_code == 200:
                 self.logger.info("Setup snapshot sent to " + str(user_id) + ".")
+                file_id = r.json()['result']['photo'][-1]['file_id']
             else:
                 self.logger.info("Sending snapshot to " + str(user_id) + " failed.")
-                print(r.status_code)
 
-    def send_option_keyboard(self, keyboard):
+        self.fan_out(
+            "sendPhoto",
+            lambda user_id: {'data': {
+                'chat_id': user_id, 'caption': text, 'photo': file_id}},
+            "Setup snapshot", remaining)
 
-        url = self.URL + self.token + "/sendMessage"
+    def deliver_option_keyboard(self, keyboard):
         reply_markup = {"keyboard": keyboard, "one_time_keyboard": True}
 
-        # Send only to whitelisted users
-        for user_id in json.loads(self.whitelist):
-            text = {'text': "Accept or veto trade:", 'chat_id': user_id, 'reply_markup': reply_markup}
+        self.fan_out(
+            "sendMessage",
+            lambda user_id: {'json': {
+                'text': "Accept or veto trade:", 'chat_id': user_id,
+                'reply_markup': reply_markup}},
+            "Consent query")
+
+    def deliver_message(self, text):
+        self.fan_out(
+            "sendMessage",
+            lambda user_id: {'data': {'chat_id': user_id, 'text': text}},
+            "Text message")
+
+    def fan_out(self, method, request_args, description, recipients=None):
+        """
+        Send one request per recipient concurrently and wait for all to
+        complete.
+
+        Args:
+            method: telegram bot API method name.
+            request_args: function returning post() kwargs for a user ID.
+            description: message description for logging.
+            recipients: list of user ID's, all whitelisted users if None.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
 
-            r = requests.post(url, json=text)
+        if recipients is None:
+            recipients = self.recipients
 
-            if int(r.status_code) == 200:
-                self.logger.info("Consent query sent to " + str(user_id) + ".")
+        futures = {
+            user_id: self.fanout.submit(
+                self.post, method, **request_args(user_id))
+            for user_id in recipients}
+
+        for user_id, future in futures.items():
+            r = future.result()
+            if r is not None and r.status_code == 200:
+                self.logger.info(description + " sent to " + str(user_id) + ".")
             else:
-                self.logger.info("Sending consent query to " + str(user_id) + " failed.")
-                print(r.status_code)
-                print(r.json())
+                self.logger.info(
+                    "Sending " + description.lower() + " to " + str(user_id) +
+                    " failed.")
 
-    def send_message(self, text):
-        url = self.URL + self.token + "/sendMessage"
+    def post(self, method, **kwargs):
+        """
+        POST to the given bot API method, retrying with backoff on
+        connection errors, rate limiting and server errors.
 
-        # Send image only to whitelisted users
-        for user_id in json.loads(self.whitelist):
+        Returns:
+            requests.Response, or None if no response was received.
+        """
 
-            data = {'chat_id': user_id, 'text': text}
-            r = requests.post(url, data=data)
+        url = self.URL + self.token + "/" + method
+        delay = self.BACKOFF
+        r = None
+
+        for attempt in range(self.RETRIES):
+            try:
+                r = self.session.post(url, timeout=self.TIMEOUT, **kwargs)
+
+            except requests.exceptions.RequestException as ex:
+                self.logger.info("Telegram request failed: " + str(ex))
+                r = None
 
-            if int(r.status_code) == 200:
-                self.logger.info("Text message sent to " + str(user_id) + ".")
             else:
-                self.logger.info("Sending message to " + str(user_id) + " failed.")
-                print(r.json())
+                if r.status_code == 200:
+                    return r
+
+                elif r.status_code == 429:
+                    try:
+                        delay = max(delay, r.json()['parameters']['retry_after'])
+                    except (ValueError, KeyError):
+                        pass
+
+                # Other client errors wont succeed on retry.
+                elif r.status_code < 500:
+                    print(r.status_code, r.text)
+                    return r
+
+            if attempt < self.RETRIES - 1:
+                sleep(delay)
+                delay *= 2
+
+        return r
+
+    def get_updates(self, offset=None, timeout=0, session=None):
+        """
+        Return updates from the bot API. If timeout is given, long-poll for
+        up to timeout seconds until an update arrives.
+
+        Args:
+            offset: ID of the first update to return. Earlier updates are
+                confirmed and not returned again.
+            timeout: long-poll duration in seconds.
+            session: requests.Session to use, the outbox session if None.
+
+        Returns:
+            list of update dicts.
+
+        Raises:
+            None.
+        """
 
-    def get_updates(self):
         url = self.URL + self.token + "/getUpdates"
-        r = requests.get(url).json()
+        params = {'timeout': timeout}
+        if offset is not None:
+            params['offset'] = offset
+
+        r = (session or self.session).get(
+            url, params=params, timeout=self.TIMEOUT + timeout).json()
         return r['result']
 
     def get_token(self):
@@ -107,3 +282,160 @@ class Telegram(MessagingClient):
             return os.environ['TELEGRAM_BOT_WHITELIST']
         else:
             raise Exception("Telegram bot token missing.")
+
+
+class TelegramUpdates:
+    """
+    Consumes telegram bot updates in a background thread, started with
+    start(), by long-polling getUpdates, and keeps the latest trade consent
+    decision per trade.
+
+    The update offset is persisted in the counters collection, so updates
+    are downloaded once and not replayed after a restart.
+
+    Decisions are parsed from whitelisted users' replies of the form
+    "<trade_id> - Accept" or "<trade_id> - Veto". If given, on_decision is
+    called with (trade_id, consent) for each new decision, from the
+    consumer thread. Decisions not actioned within DECISION_TTL seconds
+    are dropped.
+    """
+
+    COUNTER = "telegram_offset"
+    LONG_POLL = 25          # getUpdates long-poll duration in seconds.
+    ERROR_DELAY = 5         # Seconds to wait after a failed poll.
+    DECISION_TTL = 86400    # Seconds to keep unactioned decisions.
+
+    DECISIONS = {"Accept": True, "Veto": False}
+
+    def __init__(self, logger, telegram, db=None, on_decision=None):
+        self.logger = logger
+        self.tg = telegram
+        self.db = db
+        self.on_decision = on_decision
+        self.session = requests.Session()
+        self.lock = Lock()
+        self.offset = self.load_offset()
+
+        # Latest decision per trade {trade_id: (consent, response ts)}.
+        self.decisions = {}
+
+    def start(self):
+        """
+        Start the consumer thread. Call once the on_decision owner is ready
+        to receive decisions.
+        """
+
+        thread = Thread(target=self.run, daemon=True)
+        thread.start()
+
+    def run(self):
+        """
+        Poll for and parse new updates. Runs in its own thread.
+        """
+
+        while True:
+            try:
+                updates = self.tg.get_updates(
+                    self.offset, self.LONG_POLL, self.session)
+
+            except Exception as ex:
+                self.logger.info("Telegram update poll failed: " + str(ex))
+                sleep(self.ERROR_DELAY)
+                continue
+
+            if updates:
+                self.parse_updates(updates)
+                self.offset = updates[-1]['update_id'] + 1
+                self.save_offset()
+
+            self.expire_decisions()
+
+    def parse_updates(self, updates):
+        """
+        Record trade consent decisions from the given updates.
+        """
+
+        for update in updates:
+
+            # Message field may be 'message' or 'edited_message'.
+            msg = update.get('message') or update.get('edited_message')
+            if not msg or 'text' not in msg:
+                continue
+
+            # Response must have came from a whitelisted account.
+            u_id = msg.get('from', {}).get('id')
+            if u_id not in self.tg.recipients and str(u_id) not in self.tg.recipients:
+                continue
+
+            trade_id, sep, decision = msg['text'].partition(" - ")
+            if not sep:
+                continue
+
+            if decision not in self.DECISIONS:
+                self.logger.info(
+                    "Unknown input received as response to trade " +
+                    trade_id + " consent message: " + decision)
+                continue
+
+            with self.lock:
+                current = self.decisions.get(trade_id)
+                if current is not None and msg['date'] < current[1]:
+                    continue
+                self.decisions[trade_id] = (
+                    self.DECISIONS[decision], msg['date'])
+
+            if self.on_decision:
+                try:
+                    self.on_decision(trade_id, self.DECISIONS[decision])
+                except Exception:
+                    traceback.print_exc()
+
+    def get_decision(self, trade_id, after=None):
+        """
+        Return users decision for the given trade (True for accept, False for
+        veto), or None if no decision has been made. Decisions made at or
+        before 'after' are ignored.
+        """
+
+        with self.lock:
+            decision = self.decisions.get(str(trade_id))
+
+        if decision is None or (after is not None and decision[1] <= after):
+            return None
+
+        return decision[0]
+
+    def clear_decision(self, trade_id):
+        """
+        Forget the decision for the given trade once actioned.
+        """
+
+        with self.lock:
+            self.decisions.pop(str(trade_id), None)
+
+    def expire_decisions(self, now=None):
+        """
+        Forget decisions made more than DECISION_TTL seconds before now,
+        e.g for trades that expired or were resolved without them.
+        """
+
+        cutoff = (time() if now is None else now) - self.DECISION_TTL
+
+        with self.lock:
+            for trade_id in [
+                    t_id for t_id, (_, ts) in self.decisions.items() if
+                    ts < cutoff]:
+                del self.decisions[trade_id]
+
+    def load_offset(self):
+        if self.db is None:
+            return None
+
+        counter = self.db['counters'].find_one({"_id": self.COUNTER})
+        return counter['seq'] if counter else None
+
+    def save_offset(self):
+        if self.db is not None:
+            self.db['counters'].update_one(
+                {"_id": self.COUNTER}, {"$set": {"seq": self.offset}},
+                upsert=True)
@@ -0,0 +1,125 @@
+"""
+Check BarBuilder bars against a tick-by-tick reference implementation,
+then measure throughput at and well beyond peak BitMEX trade rates.
+
+Run from repo root: python "misc testing/bar_builder_test.py"
+"""
+
+import logging
+import random
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from event_types import MarketEvent
+from bar_builder import BarBuilder
+
+
+BAR_TYPES = ["5S", "15S", "100T", "50000V", "500000000D"]
+TICKS = 1000000
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+
+def make_ticks(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return {
+        'timestamp': 1600000000000 + np.cumsum(rng.randint(0, 40, n)),
+        'price': 10000 + np.cumsum(rng.choice([-0.5, 0, 0, 0.5], n)),
+        'size': rng.choice([1, 10, 100, 1000, 5000, 25000], n).astype(float),
+        'side': rng.choice([1, -1], n).astype(np.int8),
+        'trade_id': np.array(["%032x" % i for i in range(n)], dtype='S40')}
+
+
+def reference_bars(ticks, code):
+    """
+    Tick by tick bars, completed bars only.
+    """
+
+    kind, size = builder.parse_bar_type(code)
+    bars, bar, amount = [], None, 0
+    for ts, price, qty in zip(ticks['timestamp'], ticks['price'],
+                              ticks['size']):
+        if kind == "time" and bar and ts // (size * 1000) != bar['period']:
+            bars.append(bar)
+            bar = None
+        if bar is None:
+            bar = {
+                'period': ts // (size * 1000), 'open': price, 'high': price,
+                'low': price, 'volume': 0, 'ticks': 0, 'start_ms': ts}
+        bar['high'] = max(bar['high'], price)
+        bar['low'] = min(bar['low'], price)
+        bar['close'] = price
+        bar['volume'] += qty
+        bar['ticks'] += 1
+        bar['end_ms'] = ts
+        if kind != "time":
+            amount += {"tick": 1, "volume": qty, "dollar": price * qty}[kind]
+            if amount >= size:
+                bars.append(bar)
+                bar = None
+                amount %= size
+    return bars
+
+
+# Bars match the reference, whatever the batching.
+ticks = make_ticks(50000)
+builder = BarBuilder(logger, None, BAR_TYPES)
+random.seed(0)
+i = 0
+bars = []
+while i < 50000:
+    n = random.randint(1, 200)
+    bars += builder.add_ticks(
+        "XBTUSD", {k: v[i:i + n] for k, v in ticks.items()})
+    i += n
+
+for code in BAR_TYPES:
+    built = [b for b in bars if b['bar_type'] == code]
+    expected = reference_bars(ticks, code)
+    assert len(built) == len(expected) > 10, (code, len(built), len(expected))
+    for b, e in zip(built, expected):
+        for key in ["open", "high", "low", "close", "volume", "ticks",
+                    "start_ms", "end_ms"]:
+            assert b[key] == e[key], (code, key, b, e)
+
+# Events are tagged with bar type, bars stamped at close, time bars at
+# period end and threshold bars at their last tick.
+event = builder.events.get(False)
+assert event.get_bar_type() in BAR_TYPES
+assert event.get_bar_type() != MarketEvent.MINUTE
+for b in bars:
+    if b['bar_type'] in ["5S", "15S"]:
+        period = int(b['bar_type'][:-1])
+        assert b['timestamp'] % period == 0
+        assert b['timestamp'] - period <= b['start_ms'] // 1000
+        assert b['end_ms'] // 1000 < b['timestamp']
+    else:
+        assert b['timestamp'] == b['end_ms'] // 1000
+
+# Quiet market, flush closes the last time bars once their period ends.
+last = int(ticks['timestamp'][-1])
+assert not builder.flush(last)
+flushed = builder.flush(last + 15000 + builder.FLUSH_DELAY_MS)
+assert sorted(b['bar_type'] for b in flushed) == ["15S", "5S"]
+
+# Throughput, batches sized like websocket trade messages.
+ticks = make_ticks(TICKS, seed=1)
+for batch in [10, 100]:
+    builder = BarBuilder(logger, None, BAR_TYPES)
+    start = time.time()
+    for i in range(0, TICKS, batch):
+        builder.add_ticks(
+            "XBTUSD", {k: v[i:i + batch] for k, v in ticks.items()})
+    duration = time.time() - start
+    print(
+        "Built", builder.events.qsize(), "bars of", len(BAR_TYPES),
+        "types from", TICKS, "ticks in batches of", batch, "in",
+        round(duration, 3), "s (" + str(int(TICKS / duration)), "ticks/s).")
+
+print("All bar builder tests passed.")
@@ -0,0 +1,881 @@
+"""
+Local stand-in for the subset of the BitMEX REST and realtime websocket APIs
+used by Bitmex and Bitmex_WS, for reproducible load and latency testing.
+Standard library only.
+
+REST (under /api/v1):
+    GET    /trade/bucketed      Synthetic 1m/5m/1h/1d bars.
+    GET    /trade               Recent synthetic ticks, paged with start.
+    GET    /order               Orders.
+    POST   /order               Place single order.
+    POST   /order/bulk          Place multiple orders.
+    DELETE /order               Cancel orders by orderID.
+    GET    /position            Positions.
+    GET    /execution/tradeHistory  Executions.
+
+Realtime websocket at /realtime, same port: subscribe and authKeyExpires
+ops, trade, order and execution tables.
+
+Configurable trade rate, per-client rate limit (with x-ratelimit-* headers
+and 429 responses), injected 503 errors and response latency and jitter.
+Stats at GET /standin/stats.
+
+Usage:
+    python "misc testing/bitmex_standin.py" --port 8080 --trade-rate 50
+
+Then point the server at it:
+    BITMEX_BASE_URL=http://127.0.0.1:8080/api/v1
+    BITMEX_WS_URL=ws://127.0.0.1:8080/realtime
+    BITMEX_API_KEY=standin-key
+    BITMEX_API_SECRET=standin-secret
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs
+from threading import Thread, Lock, Event
+from collections import deque
+import argparse
+import hashlib
+import base64
+import struct
+import random
+import queue
+import hmac
+import json
+import math
+import time
+import uuid
+import zlib
+
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+BIN_SIZES = {'1m': 60, '5m': 300, '1h': 3600, '1d': 86400}
+
+PRIVATE_TABLES = ["order", "execution", "position"]
+
+TABLE_KEYS = {
+    'trade': [],
+    'order': ["orderID"],
+    'execution': ["execID"],
+    'position': ["account", "symbol"]}
+
+
+def iso(ts):
+    """
+    Return BitMEX-format UTC timestamp string for epoch timestamp ts.
+    """
+
+    return datetime.utcfromtimestamp(ts).strftime(
+        '%Y-%m-%dT%H:%M:%S.%f')[:-3] + "Z"
+
+
+def epoch(string):
+    """
+    Return epoch timestamp for an ISO 8601 UTC timestamp string, or None.
+    """
+
+    if not string:
+        return None
+    string = string.replace("Z", "").replace(" ", "T")
+    return datetime.fromisoformat(string).replace(
+        tzinfo=timezone.utc).timestamp()
+
+
+class StandInBitmex:
+    """
+    Stand-in venue state: synthetic market, order book, positions and
+    executions. All public methods are thread safe.
+    """
+
+    SYMBOLS = {
+        'XBTUSD': 10000.0,
+        'ETHUSD': 350.0}
+
+    TICK_SIZE = {
+        'XBTUSD': 0.5,
+        'ETHUSD': 0.05}
+
+    MAKER_FEE = -0.00025
+    TAKER_FEE = 0.00075
+
+    # Ticks kept per symbol for /trade requests.
+    MAX_TICKS = 100000
+
+    # Days of synthetic history available before server start.
+    HISTORY_DAYS = 30
+
+    # Rate limit window, seconds.
+    RATE_WINDOW = 60
+
+    def __init__(self, api_key="standin-key", api_secret="standin-secret",
+                 trade_rate=10, rate_limit=60, error_rate=0, latency=0,
+                 jitter=0, seed=0):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.trade_rate = trade_rate
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+        self.lock = Lock()
+        self.stopped = Event()
+
+        now = int(time.time())
+        self.origin = (now - self.HISTORY_DAYS * 86400) // 86400 * 86400
+
+        self.prices = {s: self.synthetic_price(s, now) for s in self.SYMBOLS}
+        self.ticks = {s: deque(maxlen=self.MAX_TICKS) for s in self.SYMBOLS}
+        self.orders = {}
+        self.open_orders = {s: {} for s in self.SYMBOLS}
+        self.executions = []
+        self.positions = {s: {
+            'account': 1, 'symbol': s, 'currency': "XBt",
+            'quoteCurrency': "USD", 'currentQty': 0, 'avgEntryPrice': None,
+            'isOpen': False, 'openingTimestamp': None, 'openingQty': 0}
+            for s in self.SYMBOLS}
+
+        # Per-client request windows {client: [window start, count]}.
+        self.windows = {}
+
+        # Connected websocket clients.
+        self.clients = set()
+
+        self.stats = {
+            'connections': 0, 'requests': 0, 'rate_limited': 0, 'errors_injected': 0,
+            'ticks': 0, 'orders': 0, 'fills': 0, 'ws_messages': 0}
+
+    def synthetic_price(self, symbol, ts):
+        """
+        Deterministic synthetic price for symbol at epoch timestamp ts.
+        """
+
+        base = self.SYMBOLS[symbol]
+        minute = int(ts // 60)
+        noise = zlib.crc32((symbol + str(minute)).encode()) / 0xffffffff
+        price = base * (
+            1 + 0.05 * math.sin(minute / 1440 * 2 * math.pi) +
+            0.002 * math.sin(minute / 7) + 0.001 * (noise - 0.5))
+        return self.round_price(symbol, price)
+
+    def round_price(self, symbol, price):
+        inc = self.TICK_SIZE[symbol]
+        return round(round(price / inc) * inc, 8)
+
+    def get_bars(self, symbol, bin_size, count, start, reverse, partial):
+        """
+        Return count synthetic bars, BitMEX bucketed trade format.
+        Bar timestamps mark bar close.
+        """
+
+        step = BIN_SIZES[bin_size]
+        last = int(time.time() // step * step) + (step if partial else 0)
+
+        # First bar closing at or after start.
+        first = max(self.origin + step, -(-int(start or 0) // step) * step)
+
+        if reverse and not start:
+            stamps = [last - i * step for i in range(count)]
+        else:
+            stamps = [first + i * step for i in range(count)]
+            stamps = [ts for ts in stamps if ts <= last]
+            if reverse:
+                stamps.reverse()
+
+        bars = []
+        for ts in stamps:
+            o = self.synthetic_price(symbol, ts - step)
+            c = self.synthetic_price(symbol, ts)
+            spread = abs(o - c) + self.TICK_SIZE[symbol] * 4
+            bars.append({
+                'timestamp': iso(ts),
+                'symbol': symbol,
+                'open': o,
+                'high': self.round_price(symbol, max(o, c) + spread / 2),
+                'low': self.round_price(symbol, min(o, c) - spread / 2),
+                'close': c,
+                'trades': int(step * self.trade_rate),
+                'volume': int(step * self.trade_rate * 100),
+                'vwap': self.round_price(symbol, (o + c) / 2),
+                'lastSize': 100,
+                'turnover': 0,
+                'homeNotional': 0,
+                'foreignNotional': 0})
+
+        return bars
+
+    def get_ticks(self, symbol, count, start, end, reverse, offset=0):
+        with self.lock:
+            ticks = list(self.ticks[symbol])
+
+        ticks = [
+            t for t in ticks if (start is None or t['ts'] >= start) and
+            (end is None or t['ts'] <= end)]
+        if reverse:
+            ticks.reverse()
+
+        return [
+            {k: v for k, v in t.items() if k != 'ts'} for t in
+            ticks[offset:offset + count]]
+
+    def new_ticks(self, n):
+        """
+        Generate n trades per symbol, match resting orders and publish.
+        """
+
+        now = time.time()
+        for symbol in self.SYMBOLS:
+            ticks = []
+            with self.lock:
+                for i in range(n):
+                    # Drift toward synthetic price so bars and ticks agree.
+                    target = self.synthetic_price(symbol, now)
+                    price = self.prices[symbol]
+                    price += (target - price) * 0.01 + self.random.gauss(
+                        0, self.TICK_SIZE[symbol] * 2)
+                    price = self.round_price(symbol, price)
+                    self.prices[symbol] = price
+
+                    tick = {
+                        'timestamp': iso(now),
+                        'symbol': symbol,
+                        'side': "Buy" if self.random.random() > 0.5 else "Sell",
+                        'size': self.random.randint(1, 1000),
+                        'price': price,
+                        'tickDirection': "ZeroPlusTick",
+                        'trdMatchID': str(uuid.uuid4()),
+                        'grossValue': 0,
+                        'homeNotional': 0,
+                        'foreignNotional': 0,
+                        'ts': now}
+                    self.ticks[symbol].append(tick)
+                    ticks.append({k: v for k, v in tick.items() if k != 'ts'})
+
+                    self.match(symbol, price)
+
+                self.stats['ticks'] += n
+
+            self.publish('trade', symbol, 'insert', ticks)
+
+    def run_market(self):
+        """
+        Generate trades at trade_rate per second per symbol until stopped.
+        """
+
+        start = time.time()
+        generated = 0
+        while not self.stopped.wait(0.01):
+            due = int((time.time() - start) * self.trade_rate) - generated
+            if due > 0:
+                self.new_ticks(due)
+                generated += due
+
+    def place_order(self, payload):
+        """
+        Place an order from a BitMEX order payload, returns order row.
+        """
+
+        symbol = payload['symbol']
+        qty = payload.get('orderQty') or 0
+        side = payload.get('side') or ("Buy" if qty > 0 else "Sell")
+        now = time.time()
+
+        order = {
+            'orderID': str(uuid.uuid4()),
+            'clOrdID': payload.get('clOrdID') or "",
+            'account': 1,
+            'symbol': symbol,
+            'side': side,
+            'orderQty': abs(qty),
+            'price': payload.get('price'),
+            'stopPx': payload.get('stopPx'),
+            'ordType': payload.get('ordType') or "Limit",
+            'timeInForce': payload.get('timeInForce'),
+            'execInst': payload.get('execInst') or "",
+            'ordStatus': "New",
+            'text': payload.get('text') or "Submitted via API.",
+            'currency': "USD",
+            'settlCurrency': "XBt",
+            'leavesQty': abs(qty),
+            'cumQty': 0,
+            'avgPx': None,
+            'transactTime': iso(now),
+            'timestamp': iso(now)}
+
+        if symbol not in self.SYMBOLS:
+            raise KeyError(symbol)
+
+        with self.lock:
+            self.stats['orders'] += 1
+            self.orders[order['orderID']] = order
+            self.publish('order', symbol, 'insert', [dict(order)])
+            price = self.prices[symbol]
+            buy = side == "Buy"
+
+            if order['ordType'] == "Market":
+                self.fill(order, price, taker=True)
+            elif order['ordType'] == "Limit" and (
+                    (buy and order['price'] >= price) or
+                    (not buy and order['price'] <= price)):
+                self.fill(order, price, taker=True)
+            else:
+                self.open_orders[symbol][order['orderID']] = order
+
+            return dict(order)
+
+    def cancel_order(self, order_id):
+        with self.lock:
+            order = self.orders.get(order_id)
+            if order is None:
+                return {'orderID': order_id, 'error': "Not Found"}
+
+            if order['ordStatus'] in ["Filled", "Canceled"]:
+                row = dict(order)
+                row['error'] = (
+                    "Unable to cancel order due to existing state: " +
+                    order['ordStatus'])
+                return row
+
+            order['ordStatus'] = "Canceled"
+            order['leavesQty'] = 0
+            order['timestamp'] = iso(time.time())
+            self.open_orders[order['symbol']].pop(order_id, None)
+            execution = self.execution(order, "Canceled", 0, None, False)
+            self.publish('execution', order['symbol'], 'insert', [execution])
+            self.publish('order', order['symbol'], 'update', [dict(order)])
+
+            return dict(order)
+
+    def match(self, symbol, price):
+        """
+        Fill resting orders crossed by a trade at price. Hold lock.
+        """
+
+        for order in list(self.open_orders[symbol].values()):
+            buy = order['side'] == "Buy"
+            ord_type = order['ordType']
+
+            if ord_type == "Limit":
+                if (buy and price <= order['price']) or (
+                        not buy and price >= order['price']):
+                    self.fill(order, order['price'], taker=False)
+
+            elif ord_type in ["Stop", "StopLimit"]:
+                if (buy and price >= order['stopPx']) or (
+                        not buy and price <= order['stopPx']):
+                    if ord_type == "Stop":
+                        self.fill(order, price, taker=True)
+                    else:
+                        order['ordType'] = "Limit"
+
+    def fill(self, order, price, taker):
+        """
+        Fill order in full at price, update position and publish. Hold lock.
+        """
+
+        qty = order['leavesQty']
+        order['ordStatus'] = "Filled"
+        order['leavesQty'] = 0
+        order['cumQty'] = order['orderQty']
+        order['avgPx'] = price
+        order['timestamp'] = iso(time.time())
+        self.open_orders[order['symbol']].pop(order['orderID'], None)
+        self.stats['fills'] += 1
+
+        position = self.positions[order['symbol']]
+        signed = qty if order['side'] == "Buy" else -qty
+        current = position['currentQty']
+        new = current + signed
+        if current == 0 or (current > 0) != (new > 0) and new != 0:
+            position['avgEntryPrice'] = price
+            position['openingTimestamp'] = iso(time.time())
+            position['openingQty'] = new
+        elif abs(new) > abs(current):
+            position['avgEntryPrice'] = (
+                position['avgEntryPrice'] * abs(current) + price * qty
+            ) / abs(new)
+        elif new == 0:
+            position['avgEntryPrice'] = None
+        position['currentQty'] = new
+        position['isOpen'] = new != 0
+
+        execution = self.execution(order, "Trade", qty, price, taker)
+
+        self.publish('execution', order['symbol'], 'insert', [execution])
+        self.publish('order', order['symbol'], 'update', [dict(order)])
+        self.publish('position', order['symbol'], 'update', [dict(position)])
+
+    def execution(self, order, exec_type, qty, price, taker):
+        """
+        Record and return an execution row for order. Hold lock.
+        """
+
+        fee = self.TAKER_FEE if taker else self.MAKER_FEE
+        execution = dict(order)
+        execution.update({
+            'execID': str(uuid.uuid4()),
+            'execType': exec_type,
+            'lastQty': qty,
+            'lastPx': price,
+            'lastLiquidityInd': "RemovedLiquidity" if taker else "AddedLiquidity",
+            'commission': fee if exec_type == "Trade" else None,
+            'execComm': int(qty / price * fee * 1e8) if price else 0,
+            'avgPx': order['avgPx'] or 0})
+        execution['ts'] = time.time()
+        self.executions.append(execution)
+
+        return {k: v for k, v in execution.items() if k != 'ts'}
+
+    def get_orders(self, symbol, count, start, reverse):
+        with self.lock:
+            orders = [
+                dict(o) for o in self.orders.values() if
+                (symbol is None or o['symbol'] == symbol) and
+                (start is None or epoch(o['transactTime']) >= start)]
+        if reverse:
+            orders.reverse()
+        return orders[:count]
+
+    def get_executions(self, symbol, count, start, end, reverse):
+        with self.lock:
+            execs = [
+                {k: v for k, v in e.items() if k != 'ts'} for e in
+                self.executions if e['execType'] == "Trade" and
+                (symbol is None or e['symbol'] == symbol) and
+                (start is None or e['ts'] >= start) and
+                (end is None or e['ts'] <= end)]
+        if reverse:
+            execs.reverse()
+        return execs[:count]
+
+    def get_positions(self):
+        with self.lock:
+            return [dict(p) for p in self.positions.values()]
+
+    def check_rate_limit(self, client):
+        """
+        Count a request against the clients rate limit window.
+
+        Returns:
+            (allowed, remaining, reset epoch timestamp).
+        """
+
+        now = time.time()
+        with self.lock:
+            window = self.windows.get(client)
+            if window is None or now - window[0] >= self.RATE_WINDOW:
+                window = self.windows[client] = [now, 0]
+            window[1] += 1
+            remaining = max(0, self.rate_limit - window[1])
+            allowed = not self.rate_limit or window[1] <= self.rate_limit
+            return allowed, remaining, window[0] + self.RATE_WINDOW
+
+    def check_signature(self, verb, path, expires, data, signature):
+        message = verb + path + str(expires) + data
+        expected = hmac.new(
+            self.api_secret.encode(), message.encode(),
+            digestmod=hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature or "")
+
+    def delay(self):
+        """
+        Sleep for configured latency plus jitter.
+        """
+
+        if self.latency or self.jitter:
+            time.sleep(max(0, self.latency + self.random.uniform(
+                -self.jitter, self.jitter)))
+
+    def publish(self, table, symbol, action, data):
+        """
+        Send table data to clients subscribed to table:symbol.
+        """
+
+        if not data:
+            return
+
+        msg = json.dumps({'table': table, 'action': action, 'data': data})
+        for client in list(self.clients):
+            if client.subscribed(table, symbol):
+                client.send(msg)
+
+
+class WebsocketClient:
+    """
+    Server side of a realtime websocket connection. Outbound messages are
+    delayed by the stand-in latency on a sender thread.
+    """
+
+    def __init__(self, venue, sock):
+        self.venue = venue
+        self.sock = sock
+        self.subs = set()
+        self.authenticated = False
+        self.outbox = queue.Queue()
+        self.closed = False
+        self.send_lock = Lock()
+        Thread(target=self.sender, daemon=True).start()
+
+    def subscribed(self, table, symbol):
+        return (
+            table in self.subs or table + ":" + symbol in self.subs) and (
+            table not in PRIVATE_TABLES or self.authenticated)
+
+    def send(self, msg):
+        self.outbox.put((time.time(), msg))
+
+    def sender(self):
+        while not self.closed:
+            queued, msg = self.outbox.get()
+            if msg is None:
+                break
+            wait = queued + self.venue.latency - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self.send_frame(msg.encode(), 0x1)
+                self.venue.stats['ws_messages'] += 1
+            except OSError:
+                self.closed = True
+
+    def send_frame(self, payload, opcode):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        with self.send_lock:
+            self.sock.sendall(header + payload)
+
+    def recv_exact(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("Client disconnected.")
+            data += chunk
+        return data
+
+    def recv_frame(self):
+        b1, b2 = self.recv_exact(2)
+        opcode = b1 & 0x0f
+        length = b2 & 0x7f
+        if length == 126:
+            length = struct.unpack("!H", self.recv_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self.recv_exact(8))[0]
+        mask = self.recv_exact(4) if b2 & 0x80 else None
+        payload = self.recv_exact(length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return opcode, payload
+
+    def run(self):
+        self.send(json.dumps({
+            'info': "Welcome to the BitMEX Realtime API.",
+            'version': "standin",
+            'timestamp': iso(time.time())}))
+
+        self.venue.clients.add(self)
+        try:
+            while not self.closed:
+                opcode, payload = self.recv_frame()
+                if opcode == 0x8:
+                    self.send_frame(payload[:2], 0x8)
+                    break
+                elif opcode == 0x9:
+                    self.send_frame(payload, 0xA)
+                elif opcode == 0x1:
+                    self.on_message(json.loads(payload.decode()))
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            self.closed = True
+            self.outbox.put((0, None))
+            self.venue.clients.discard(self)
+
+    def on_message(self, msg):
+        op = msg.get('op')
+        args = msg.get('args') or []
+        args = args if isinstance(args, list) else [args]
+
+        if op == "authKeyExpires":
+            key, expires, signature = args
+            if (
+                key == self.venue.api_key and expires > time.time() and
+                    self.venue.check_signature(
+                        "GET", "/realtime", expires, "", signature)):
+                self.authenticated = True
+                self.send(json.dumps({'success': True, 'request': msg}))
+            else:
+                self.send(json.dumps({
+                    'status': 401, 'error': "Signature not valid.",
+                    'request': msg}))
+
+        elif op == "subscribe":
+            for arg in args:
+                table, _, symbol = arg.partition(":")
+                if table not in TABLE_KEYS:
+                    self.send(json.dumps({
+                        'status': 400,
+                        'error': "Unknown table: " + table,
+                        'request': msg}))
+                    continue
+                if table in PRIVATE_TABLES and not self.authenticated:
+                    self.send(json.dumps({
+                        'status': 401,
+                        'error': "User requested an account-locked "
+                                 "subscription but no authorization was "
+                                 "provided.",
+                        'request': msg}))
+                    continue
+
+                self.subs.add(arg)
+                self.send(json.dumps({
+                    'success': True, 'subscribe': arg, 'request': msg}))
+                self.send(json.dumps({
+                    'table': table,
+                    'action': "partial",
+                    'keys': TABLE_KEYS[table],
+                    'types': {},
+                    'filter': {'symbol': symbol} if symbol else {},
+                    'data': self.partial(table, symbol)}))
+
+        else:
+            self.send(json.dumps({
+                'status': 400, 'error': "Unknown or unsupported op.",
+                'request': msg}))
+
+    def partial(self, table, symbol):
+        symbol = symbol or None
+        if table == "trade":
+            return self.venue.get_ticks(symbol, 100, None, None, True)[::-1] \
+                if symbol else []
+        elif table == "order":
+            return [
+                o for o in self.venue.get_orders(symbol, 500, None, False)
+                if o['ordStatus'] in ["New", "PartiallyFilled"]]
+        elif table == "execution":
+            return self.venue.get_executions(symbol, 100, None, None, False)
+        elif table == "position":
+            return [
+                p for p in self.venue.get_positions() if
+                symbol is None or p['symbol'] == symbol]
+
+
+def make_handler(venue):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+        PREFIX = "/api/v1"
+
+        def setup(self):
+            super().setup()
+            venue.stats['connections'] += 1
+
+        def do_GET(self):
+            if self.headers.get('Upgrade', "").lower() == "websocket":
+                self.upgrade()
+            else:
+                self.route("GET")
+
+        def do_POST(self):
+            self.route("POST")
+
+        def do_DELETE(self):
+            self.route("DELETE")
+
+        def upgrade(self):
+            accept = base64.b64encode(hashlib.sha1(
+                (self.headers['Sec-WebSocket-Key'] + WS_GUID).encode()
+            ).digest()).decode()
+            self.send_response(101, "Switching Protocols")
+            self.send_header('Upgrade', "websocket")
+            self.send_header('Connection', "Upgrade")
+            self.send_header('Sec-WebSocket-Accept', accept)
+            self.end_headers()
+            self.wfile.flush()
+            WebsocketClient(venue, self.connection).run()
+            self.close_connection = True
+
+        def route(self, verb):
+            url = urlparse(self.path)
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length).decode() if length else ""
+            body = json.loads(raw) if raw else {}
+            params = dict(body)
+            params.update(query)
+            path = url.path[len(self.PREFIX):] if url.path.startswith(
+                self.PREFIX) else url.path
+
+            venue.stats['requests'] += 1
+            venue.delay()
+
+            if path == "/standin/stats":
+                return self.reply(200, dict(venue.stats))
+
+            client = self.headers.get('api-key') or self.client_address[0]
+            allowed, remaining, reset = venue.check_rate_limit(client)
+            headers = {
+                'x-ratelimit-limit': venue.rate_limit,
+                'x-ratelimit-remaining': remaining,
+                'x-ratelimit-reset': int(reset)}
+            if not allowed:
+                venue.stats['rate_limited'] += 1
+                headers['Retry-After'] = max(1, round(reset - time.time()))
+                return self.error(
+                    429, "Rate limit exceeded, retry in " +
+                    str(headers['Retry-After']) + " seconds.",
+                    "RateLimitError", headers)
+
+            if venue.error_rate and venue.random.random() < venue.error_rate:
+                venue.stats['errors_injected'] += 1
+                return self.error(
+                    503, "The system is currently overloaded. Please try "
+                    "again later.", "HTTPError", headers)
+
+            private = path in [
+                "/order", "/order/bulk", "/position",
+                "/execution/tradeHistory"]
+            if private and not self.authorised(verb, raw):
+                return self.error(
+                    401, "Signature not valid.", "HTTPError", headers)
+
+            try:
+                status, result = self.dispatch(verb, path, params)
+            except (KeyError, TypeError, ValueError) as e:
+                return self.error(
+                    400, "Invalid request: " + str(e), "ValidationError",
+                    headers)
+
+            self.reply(status, result, headers)
+
+        def dispatch(self, verb, path, params):
+            symbol = params.get('symbol') or None
+            count = min(int(params.get('count') or 100), 1000)
+            reverse = str(params.get('reverse')).lower() == "true"
+            start = epoch(params.get('startTime'))
+            end = epoch(params.get('endTime'))
+
+            if verb == "GET" and path == "/trade/bucketed":
+                partial = str(params.get('partial')).lower() == "true"
+                return 200, venue.get_bars(
+                    symbol, params['binSize'], count, start, reverse, partial)
+
+            elif verb == "GET" and path == "/trade":
+                return 200, venue.get_ticks(
+                    symbol, count, start, end, reverse,
+                    int(params.get('start') or 0))
+
+            elif verb == "GET" and path == "/order":
+                return 200, venue.get_orders(symbol, count, start, reverse)
+
+            elif verb == "POST" and path == "/order":
+                return 200, venue.place_order(params)
+
+            elif verb == "POST" and path == "/order/bulk":
+                return 200, [venue.place_order(o) for o in params['orders']]
+
+            elif verb == "DELETE" and path == "/order":
+                ids = params['orderID']
+                ids = ids if isinstance(ids, list) else [ids]
+                return 200, [venue.cancel_order(i) for i in ids]
+
+            elif verb == "GET" and path == "/position":
+                return 200, venue.get_positions()
+
+            elif verb == "GET" and path == "/execution/tradeHistory":
+                return 200, venue.get_executions(
+                    symbol, count, start, end, reverse)
+
+            return 404, {'error': {
+                'message': "Not Found", 'name': "HTTPError"}}
+
+        def authorised(self, verb, body):
+            if self.headers.get('api-key') != venue.api_key:
+                return False
+            expires = self.headers.get('api-expires') or "0"
+            if int(expires) < time.time():
+                return False
+            return venue.check_signature(
+                verb, self.path, expires, body,
+                self.headers.get('api-signature'))
+
+        def error(self, status, message, name, headers):
+            self.reply(status, {'error': {
+                'message': message, 'name': name}}, headers)
+
+        def reply(self, status, payload, headers={}):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', "application/json")
+            self.send_header('Content-Length', str(len(data)))
+            for k, v in headers.items():
+                self.send_header(k, str(v))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def start(port=0, **kwargs):
+    """
+    Start a stand-in venue and server in background threads.
+
+    Returns:
+        (venue, server), server.server_address[1] is the bound port.
+    """
+
+    venue = StandInBitmex(**kwargs)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(venue))
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    Thread(target=venue.run_market, daemon=True).start()
+
+    return venue, server
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--trade-rate", type=float, default=10,
+                        help="Trades per second per symbol.")
+    parser.add_argument("--rate-limit", type=int, default=60,
+                        help="REST requests per minute per client, 0 for none.")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Fraction of REST requests failed with 503.")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Seconds added to each response and message.")
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="Max seconds of random latency variation.")
+    parser.add_argument("--api-key", default="standin-key")
+    parser.add_argument("--api-secret", default="standin-secret")
+    args = parser.parse_args()
+
+    venue, server = start(
+        args.port, api_key=args.api_key, api_secret=args.api_secret,
+        trade_rate=args.trade_rate, rate_limit=args.rate_limit,
+        error_rate=args.error_rate, latency=args.latency, jitter=args.jitter)
+
+    print("BitMEX stand-in listening on port " + str(args.port) + ".")
+    print("BITMEX_BASE_URL=http://127.0.0.1:" + str(args.port) + "/api/v1")
+    print("BITMEX_WS_URL=ws://127.0.0.1:" + str(args.port) + "/realtime")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        venue.stopped.set()
+        server.shutdown()
@@ -0,0 +1,191 @@
+"""
+Exercise the Bitmex connector against the local BitMEX stand-in, then
+measure REST latency under load and rate limiting.
+
+Run from repo root: python "misc testing/bitmex_standin_test.py"
+"""
+
+import statistics
+import logging
+import asyncio
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bitmex_standin
+
+
+REQUESTS = 500
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+venue, server = bitmex_standin.start(trade_rate=200, rate_limit=0)
+port = str(server.server_address[1])
+
+os.environ['BITMEX_API_KEY'] = venue.api_key
+os.environ['BITMEX_API_SECRET'] = venue.api_secret
+
+from bitmex import Bitmex
+
+bitmex = Bitmex(
+    logger, base_url="http://127.0.0.1:" + port + "/api/v1",
+    ws_url="ws://127.0.0.1:" + port + "/realtime")
+
+# Stand-in is not rate limited unless asked.
+bitmex.RATE_LIMIT = None
+
+fills = []
+executions = []
+bitmex.register_fill_callback(fills.append)
+bitmex.register_execution_callback(executions.extend)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def order(o_id, direction, order_type, metatype, price, size=100):
+    return {
+        'trade_id': 1, 'order_id': o_id, 'venue': "BitMEX",
+        'symbol': "XBTUSD", 'direction': direction, 'size': size,
+        'price': price, 'order_type': order_type, 'metatype': metatype,
+        'void_price': None, 'trail': False, 'reduce_only': False,
+        'post_only': False, 'batch_size': 2}
+
+
+# Public data.
+start = int(time.time()) // 60 * 60 - 3600
+bars = bitmex.get_bars_in_period("XBTUSD", start, 60)
+assert len(bars) == 60 and bars[0]['timestamp'] == start
+assert all(b['low'] <= b['open'] <= b['high'] for b in bars)
+assert len(bitmex.get_recent_bars("1m", "XBTUSD", 5)) == 5
+assert wait_for(lambda: len(bitmex.ws.get_ticks()) > 100)
+
+# Concurrent paged tick download matches the venues tick record.
+time.sleep(2)
+end = int(time.time())
+bitmex.TICKS_PER_REQUEST = 50
+ticks = bitmex.get_ticks_in_period("XBTUSD", end - 2, end, windows=4)
+expected = [
+    t for t in venue.ticks['XBTUSD'] if end - 2 <= int(t['ts'] * 1000) / 1000 < end]
+assert len(ticks['trade_id']) == len(expected) > 200
+assert [t['trdMatchID'].encode() for t in expected] == list(ticks['trade_id'])
+assert (ticks['price'] == [t['price'] for t in expected]).all()
+assert (ticks['timestamp'][1:] >= ticks['timestamp'][:-1]).all()
+bitmex.TICKS_PER_REQUEST = 1000
+
+# Bulk data requests leave the rate reserve for orders.
+bitmex.RATE_LIMIT, bitmex.RATE_PERIOD, bitmex.RATE_RESERVE = 4, 0.5, 2
+t = time.time()
+for i in range(4):
+    bitmex.get_recent_bars("1m", "XBTUSD", 1)
+assert time.time() - t >= 0.5
+t = time.time()
+bitmex.get_position("XBTUSD")
+assert time.time() - t < 0.5
+
+# Throttled tick windows wait in the event loop, not in request threads,
+# so order requests are not queued behind them.
+async def download_and_order():
+    download = asyncio.ensure_future(bitmex.get_ticks_in_period_async(
+        "XBTUSD", end - 16, end, windows=16))
+    await asyncio.sleep(0.1)
+    t = time.time()
+    await bitmex.get_position_async("XBTUSD")
+    order_time = time.time() - t
+    await download
+    return order_time
+
+bitmex.RATE_LIMIT, bitmex.RATE_PERIOD, bitmex.RATE_RESERVE = 6, 1, 2
+time.sleep(1)
+assert asyncio.run(download_and_order()) < 0.5
+bitmex.RATE_LIMIT = None
+
+# Resting orders, then cancel.
+price = venue.prices['XBTUSD']
+confs = bitmex.place_bulk_orders([
+    order("1-1", "LONG", "LIMIT", "ENTRY", price * 0.9),
+    order("1-2", "SHORT", "STOP", "STOP", price * 0.8)])
+assert [c['status'] for c in confs] == ["NEW", "NEW"]
+assert len(bitmex.get_orders("XBTUSD")) == 2
+cancels = bitmex.cancel_orders([c['venue_id'] for c in confs])
+assert all(c['status'] == "CANCELLED" for c in cancels.values())
+assert wait_for(lambda: len(fills) == 2)
+
+# Market order fills immediately, reported via websocket.
+confs = bitmex.place_bulk_orders([
+    order("2-1", "LONG", "MARKET", "ENTRY", price)])
+assert confs[0]['status'] == "FILLED"
+assert wait_for(lambda: any(f['order_id'] == "2-1" for f in fills))
+assert wait_for(lambda: any(e['order_id'] == "2-1" for e in executions))
+assert bitmex.get_position("XBTUSD")['size'] == 100
+assert bitmex.get_executions("XBTUSD", start)[0]['order_id'] == "2-1"
+assert bitmex.close_position("XBTUSD") is True
+assert bitmex.get_position("XBTUSD")['status'] == "CLOSED"
+
+# Sequential REST latency, connections are reused.
+connections = venue.stats['connections']
+latencies = []
+for i in range(REQUESTS):
+    t = time.time()
+    bitmex.get_recent_bars("1m", "XBTUSD", 100)
+    latencies.append(time.time() - t)
+latencies.sort()
+print(
+    str(REQUESTS), "bar requests, mean",
+    round(statistics.mean(latencies) * 1000, 3), "ms, p50",
+    round(latencies[len(latencies) // 2] * 1000, 3), "ms, p99",
+    round(latencies[int(len(latencies) * 0.99)] * 1000, 3), "ms.")
+assert venue.stats['connections'] - connections <= 1
+
+# Rate limited requests are retried after the venues Retry-After delay.
+venue.rate_limit, venue.RATE_WINDOW = 5, 1
+venue.windows.clear()
+statuses = [
+    bitmex.get(bitmex.BASE_URL + "/position").status_code for i in range(8)]
+assert statuses == [401] * 8 and venue.stats['rate_limited'] >= 1
+
+# Overloaded responses are retried, the last response is returned.
+bitmex.RETRY_BACKOFF = 0
+bitmex.session = bitmex.create_session()
+venue.rate_limit, venue.error_rate = 0, 1
+response = bitmex.get(bitmex.BASE_URL + "/position")
+assert response.status_code == 503
+assert venue.stats['errors_injected'] == bitmex.RETRY_TOTAL + 1
+
+# Orders are retried only on 503, the last response is returned.
+response = bitmex.place_single_order(
+    order("3-1", "LONG", "LIMIT", "ENTRY", price * 0.9))
+assert response.status_code == 503
+assert venue.stats['errors_injected'] == 2 * (bitmex.RETRY_TOTAL + 1)
+venue.error_rate = 0
+
+# Coroutine variants overlap requests.
+async def concurrent():
+    return await asyncio.gather(
+        bitmex.get_orders_async("XBTUSD"),
+        bitmex.get_position_async("XBTUSD"),
+        bitmex.get_executions_async("XBTUSD", start),
+        bitmex.get_bars_in_period_async("XBTUSD", start, 10))
+
+venue.latency = 0.2
+t = time.time()
+orders, position, execs, bars = asyncio.run(concurrent())
+duration = time.time() - t
+venue.latency = 0
+assert len(bars) == 10 and position['status'] == "CLOSED"
+assert duration < 0.4, duration
+print("4 concurrent requests at 200 ms latency in", round(duration, 3), "s.")
+
+print("Stand-in stats:", venue.stats)
+print("Client stats:", bitmex.get_request_stats())
+print("All BitMEX stand-in tests passed.")
@@ -0,0 +1,96 @@
+"""
+Check DatasetSnapshot immutability, sharing and serialisation, and compare
+snapshot cost against deep-copying the live dataset.
+
+Run from repo root: python "misc testing/dataset_snapshot_test.py"
+"""
+
+import pickle
+import copy
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+import numpy as np
+
+from event_types import DatasetSnapshot
+
+
+ROWS = 5000
+REPEATS = 2000
+
+# Live dataset, 1 min bars plus feature columns, as built by Strategy.
+rng = np.random.RandomState(0)
+close = 10000 + np.cumsum(rng.normal(0, 5, ROWS))
+df = pd.DataFrame({
+    'open': close - 1, 'high': close + 5, 'low': close - 5, 'close': close,
+    'volume': rng.randint(1, 1000, ROWS).astype(float)},
+    index=pd.date_range("2020-09-01", periods=ROWS, freq="min"))
+df.index.name = "timestamp"
+df['EMA10'] = df['close'].ewm(span=10).mean().round(6)
+df.iloc[-1, df.columns.get_loc('close')] = np.nan
+
+snap = DatasetSnapshot.from_frame(df)
+n = DatasetSnapshot.DEFAULT_ROWS
+assert len(snap) == n
+assert snap.get_columns() == list(df.columns)
+assert snap.timestamp[-1] == int(df.index[-1].timestamp())
+assert np.allclose(snap['EMA10'], df['EMA10'].values[-n:])
+
+# Read only, and unaffected by in-place writes to the live dataset.
+try:
+    snap['close'][0] = 0
+    assert False
+except ValueError:
+    pass
+try:
+    snap.columns['close'] = None
+    assert False
+except TypeError:
+    pass
+df.ffill(inplace=True)
+assert np.isnan(snap['close'][-1])
+
+# Read-only sources are shared, tails share the snapshots arrays.
+cols = {'close': df['close'].to_numpy().copy()}
+cols['close'].flags.writeable = False
+shared = DatasetSnapshot.from_columns(
+    df.index.values.astype('datetime64[s]').astype(np.int64), cols, 100)
+assert np.shares_memory(shared['close'], cols['close'])
+assert np.shares_memory(snap.tail(10)['close'], snap['close'])
+assert len(snap.tail(10)) == 10
+
+# Round trips.
+frame = snap.to_frame()
+assert list(frame.columns) == snap.get_columns()
+assert (frame.index == df.index[-n:]).all()
+frame.iloc[0, 0] = 0
+
+restored = DatasetSnapshot.from_dict(snap.to_dict())
+assert snap.to_dict()['columns']['close'][-1] is None
+assert np.array_equal(restored['close'], snap['close'], equal_nan=True)
+assert (restored.timestamp == snap.timestamp).all()
+
+unpickled = pickle.loads(pickle.dumps(snap))
+assert not unpickled['close'].flags.writeable
+assert np.array_equal(unpickled['EMA10'], snap['EMA10'])
+
+# Cost per signal against a deep copy of the whole live dataset.
+start = time.time()
+for i in range(REPEATS):
+    DatasetSnapshot.from_frame(df)
+snapshot_time = (time.time() - start) / REPEATS
+
+start = time.time()
+for i in range(REPEATS):
+    copy.deepcopy(df)
+deepcopy_time = (time.time() - start) / REPEATS
+
+print(
+    "Per signal: snapshot", round(snapshot_time * 1e6, 1), "us,",
+    len(pickle.dumps(snap)), "bytes pickled; deep copy",
+    round(deepcopy_time * 1e6, 1), "us,", len(pickle.dumps(df)), "bytes.")
+print("All dataset snapshot tests passed.")
@@ -0,0 +1,140 @@
+"""
+Micro-benchmark allocation cost and memory per object for the slotted
+event, bar and order types, against the dict based and unslotted forms
+they replaced.
+
+Run from repo root: python "misc testing/event_types_benchmark.py"
+"""
+
+import tracemalloc
+import logging
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from event_types import Bar, MarketEvent, OrderEvent, FillEvent
+from trade_types import Order
+
+
+N = 200000
+
+logger = logging.getLogger()
+
+
+class LegacyMarketEvent:
+
+    def __init__(self, exchange, bar, bar_type="1Min"):
+        self.type = 'MARKET'
+        self.exchange = exchange
+        self.bar = bar
+        self.bar_type = bar_type
+
+
+class LegacyOrderEvent:
+
+    FIELDS = [
+        'trade_id', 'order_id', 'timestamp', 'avg_fill_price', 'currency',
+        'venue_id', 'direction', 'size', 'price', 'order_type', 'metatype',
+        'void_price', 'trail', 'reduce_only', 'post_only', 'batch_size',
+        'status']
+
+    def __init__(self, order_dict):
+        self.type = 'ORDER'
+        self.order_dict = order_dict
+        for field in self.FIELDS:
+            setattr(self, field, order_dict[field])
+
+
+class LegacyFillEvent:
+
+    def __init__(self, order_conf):
+        self.type = 'FILL'
+        self.order_conf = order_conf
+        self.fees = None
+
+
+def measure(name, make):
+    """
+    Return (ns per object, bytes per object) for N objects from make(i).
+    """
+
+    start = time.perf_counter_ns()
+    objects = [make(i) for i in range(N)]
+    ns = (time.perf_counter_ns() - start) / N
+    del objects
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [make(i) for i in range(N)]
+    size = (tracemalloc.get_traced_memory()[0] - before) / N
+    tracemalloc.stop()
+    del objects
+
+    print("{:<28}{:>10.0f} ns{:>10.0f} bytes".format(name, ns, size))
+    return ns, size
+
+
+def bar_dict(i):
+    return {
+        'symbol': "XBTUSD", 'timestamp': i * 60, 'open': 100.0,
+        'high': 101.0, 'low': 99.0, 'close': 100.5, 'volume': 10.0}
+
+
+order = Order(
+    logger, 1, "1-1", "XBTUSD", "BitMEX", "LONG", 100, 10000.0, "LIMIT",
+    "ENTRY", None, False, False, False)
+order_dict = order.get_order_dict()
+
+print("{:<28}{:>13}{:>16}".format("Object, " + str(N) + " each", "alloc",
+                                  "memory"))
+
+results = {}
+results['bar dict'] = measure("Bar as dict", bar_dict)
+results['bar'] = measure("Bar (slotted)", lambda i: Bar(
+    "XBTUSD", i * 60, 100.0, 101.0, 99.0, 100.5, 10.0))
+measure("Bar.from_dict", lambda i: Bar.from_dict(bar_dict(i)))
+
+bar = Bar("XBTUSD", 60, 100.0, 101.0, 99.0, 100.5, 10.0)
+results['legacy market'] = measure(
+    "MarketEvent (unslotted)", lambda i: LegacyMarketEvent(None, bar))
+results['market'] = measure(
+    "MarketEvent (slotted)", lambda i: MarketEvent(None, bar))
+
+results['legacy order'] = measure(
+    "OrderEvent (field copies)", lambda i: LegacyOrderEvent(order_dict))
+results['order'] = measure(
+    "OrderEvent (slotted)", lambda i: OrderEvent(order_dict))
+
+results['legacy fill'] = measure(
+    "FillEvent (unslotted)", lambda i: LegacyFillEvent(order_dict))
+results['fill'] = measure(
+    "FillEvent (slotted)", lambda i: FillEvent(order_dict))
+
+measure("Order (slotted)", lambda i: Order(
+    logger, i, "1-1", "XBTUSD", "BitMEX", "LONG", 100, 10000.0, "LIMIT",
+    "ENTRY", None, False, False, False))
+
+# Conversions at the persistence boundary round trip.
+assert Bar.from_dict(bar.to_dict()) == bar
+assert bar['close'] == bar.get('close') == 100.5
+for key in ["to_dict", "FIELDS", "__class__", 0]:
+    try:
+        bar[key]
+        raise AssertionError(key)
+    except KeyError:
+        pass
+    assert bar.get(key) is None
+assert "symbol" not in bar.to_dict(symbol=False)
+assert Order.from_dict(logger, order_dict).get_order_dict() == order_dict
+assert OrderEvent(order_dict).price == order_dict['price']
+
+# Slotted objects carry no per-instance dict.
+for obj in [bar, MarketEvent(None, bar), OrderEvent(order_dict), order]:
+    assert not hasattr(obj, "__dict__"), type(obj)
+
+assert results['bar'][1] < results['bar dict'][1]
+assert results['market'][1] < results['legacy market'][1]
+assert results['order'][1] < results['legacy order'][1]
+print("All event type checks passed.")
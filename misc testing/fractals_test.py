@@ -0,0 +1,106 @@
+"""
+Check vectorised Features.fractals and fractals_incremental against a bar
+by bar reference implementation, then benchmark both at 100k bars.
+
+Run from repo root: python "misc testing/fractals_test.py"
+"""
+
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+import numpy as np
+
+from features import Features
+
+
+BARS = 100000
+WINDOWS = [3, 5, 7, 9, 4]
+
+
+def make_bars(n, seed=0):
+    # Half point prices so equal highs and lows (no fractal) are common.
+    rng = np.random.RandomState(seed)
+    close = 10000 + np.cumsum(rng.choice([-1, -0.5, 0, 0.5, 1], n))
+    return pd.DataFrame({
+        'open': close, 'high': close + rng.choice([0, 0.5, 1], n),
+        'low': close - rng.choice([0, 0.5, 1], n), 'close': close,
+        'volume': rng.randint(1, 1000, n).astype(float)},
+        index=pd.date_range("2020-09-01", periods=n, freq="min"))
+
+
+def reference_fractals(bars, window):
+    """
+    Bar by bar, compare centre bar to each bar either side.
+    """
+
+    if window % 2 != 1:
+        window += 1
+    half = (window - 1) // 2
+    highs, lows = bars.high.tolist(), bars.low.tolist()
+    frac = [0] * len(highs)
+    for i in range(half, len(highs) - half):
+        sides = [j for j in range(i - half, i + half + 1) if j != i]
+        if all(highs[i] > highs[j] for j in sides):
+            frac[i] = 1
+        elif all(lows[i] < lows[j] for j in sides):
+            frac[i] = -1
+    return np.array(frac)
+
+
+features = Features()
+
+# Matches the reference for odd, even and degenerate lengths.
+bars = make_bars(3000)
+for window in WINDOWS:
+    expected = reference_fractals(bars, window)
+    assert (features.fractals(bars, window) == expected).all(), window
+    assert (expected != 0).sum() > 50, window
+for n in [0, 1, 4, 5, 6]:
+    assert (features.fractals(bars.iloc[:n]) ==
+            reference_fractals(bars.iloc[:n], 5)).all(), n
+
+# Incremental, one and several new bars at a time.
+for window in WINDOWS:
+    frac = features.fractals(bars.iloc[:10], window)
+    n = 10
+    while n < 600:
+        n += 1 + n % 3
+        frac = features.fractals_incremental(bars.iloc[:n], frac, window)
+        assert (frac == features.fractals(bars.iloc[:n], window)).all(), (
+            window, n)
+
+# Successive higher swings trend up, lower swings down.
+wave = np.tile([0, 1, 2, 3, 2, 1], 20) + np.arange(120) * 0.5
+up = pd.DataFrame({
+    'open': wave, 'high': wave + 0.25, 'low': wave - 0.25, 'close': wave,
+    'volume': 1.0}, index=pd.date_range("2020-09-01", periods=120, freq="min"))
+down = up.iloc[::-1].set_index(up.index)
+assert features.trending(100, up) == (True, 1)
+assert features.trending(100, down) == (True, -1)
+assert features.trending(100, up.iloc[:5]) == (False, 0)
+
+# Benchmark.
+bars = make_bars(BARS, seed=1)
+start = time.time()
+expected = reference_fractals(bars, 5)
+reference_time = time.time() - start
+
+start = time.time()
+frac = features.fractals(bars, 5)
+vectorised_time = time.time() - start
+assert (frac == expected).all()
+
+start = time.time()
+for i in range(1000):
+    features.fractals_incremental(bars, frac[:-1], 5)
+incremental_time = (time.time() - start) / 1000
+
+print(
+    BARS, "bars: reference", round(reference_time, 3), "s, vectorised",
+    round(vectorised_time * 1000, 2), "ms, incremental new bar",
+    round(incremental_time * 1e6, 1), "us.")
+print("All fractal tests passed.")
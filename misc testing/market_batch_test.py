@@ -0,0 +1,196 @@
+"""
+Check MarketBatchEvent conversions and batched stored data replay. Then run
+Strategy and Portfolio over the same minutes, once as per-symbol market
+events and once as one batch per venue-minute, check both give the same
+datasets, signals and unrealised pnl, and compare their timings.
+
+Run from repo root: python "misc testing/market_batch_test.py"
+"""
+
+import tempfile
+import logging
+import shutil
+import queue
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from event_types import MarketEvent, MarketBatchEvent
+from model import EMACrossTestingOnly
+from portfolio import Portfolio
+from data import Datahandler
+from bar_cache import BarCache
+from strategy import Strategy
+
+import numpy as np
+
+
+SYMBOLS = 100
+
+# Stored minutes before START, enough for 30Min datasets.
+HISTORY = 6100
+
+# New minutes until all 1-30Min datasets are built, then timed minutes.
+WARMUP = 30
+MINUTES = 28
+
+# 2020-09-01 00:00 UTC, new bars from 00:02 to avoid hourly timeframes.
+START = 1598918400
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+
+class Venue:
+
+    def __init__(self, symbols):
+        self.symbols = symbols
+
+    def get_name(self):
+        return "BitMEX"
+
+    def get_symbols(self):
+        return self.symbols
+
+
+def bar(symbol, ts, price):
+    return {
+        'symbol': symbol, 'timestamp': ts, 'open': price, 'high': price + 1,
+        'low': price - 1, 'close': price + 0.5, 'volume': 10.0}
+
+
+# Round trip, null bars keep None values.
+venue = Venue(["XBTUSD", "ETHUSD", "XRPUSD"])
+bars = [bar("XBTUSD", 60, 100.0), bar("ETHUSD", 60, 10.0)]
+bars.append({
+    'symbol': "XRPUSD", 'timestamp': 60, 'open': None, 'high': None,
+    'low': None, 'close': None, 'volume': 0})
+event = MarketBatchEvent.from_bars(venue, bars)
+assert len(event) == 3 and event.type == "MARKET_BATCH"
+assert event.get_bar_type() == MarketEvent.MINUTE
+assert event.get_bars() == [dict(b, volume=float(b['volume'])) for b in bars]
+assert event.get_bar("ETHUSD") == bars[1]
+assert event.get_bar("XRPUSD")['close'] is None
+assert event.get_bar("LTCUSD") is None
+assert event.get_timestamps() == [60]
+assert [e.get_bar()['symbol'] for e in event.get_events()] == venue.symbols
+
+# Stored data replay yields one batch per venue-minute.
+path = tempfile.mkdtemp()
+cache = BarCache(logger, path=path)
+cache.append("BitMEX", "XBTUSD", [bar("XBTUSD", 60 * i, 100.0 + i)
+                                  for i in range(1, 4)])
+cache.append("BitMEX", "ETHUSD", [bar("ETHUSD", 60 * i, 10.0 + i)
+                                  for i in range(2, 4)])
+data = Datahandler([venue], logger, {"BitMEX": None}, None, cache)
+batches = []
+while not data.replay_complete:
+    batches += data.get_historic_data()
+assert [b.get_symbols() for b in batches] == [
+    ["XBTUSD"], ["XBTUSD", "ETHUSD"], ["XBTUSD", "ETHUSD"]]
+assert batches[1].get_bar("ETHUSD")['close'] == 12.5
+cache.close()
+shutil.rmtree(path)
+
+# Strategy and Portfolio consumer path, per-symbol events against batches.
+venue = Venue(["SYM" + str(i) for i in range(SYMBOLS)])
+rng = np.random.RandomState(0)
+prices = 10000 + np.cumsum(rng.normal(0, 5, (HISTORY + 60, SYMBOLS)), axis=0)
+minutes = [
+    [bar(s, START + 60 * (m - HISTORY), prices[m, i])
+     for i, s in enumerate(venue.symbols)]
+    for m in range(HISTORY + 60)]
+
+# Store all bars up front, datasets only read bars before each new bar.
+path = tempfile.mkdtemp()
+cache = BarCache(logger, path=path)
+for i, s in enumerate(venue.symbols):
+    cache.append("BitMEX", s, [new_bars[i] for new_bars in minutes])
+new_minutes = minutes[HISTORY + 2:HISTORY + 2 + WARMUP + MINUTES]
+
+# Model trading every symbol.
+model = EMACrossTestingOnly(logger)
+model.instruments = {"BitMEX": {s: s for s in venue.symbols}}
+
+logger.setLevel(logging.WARNING)
+
+
+def consumers():
+    strategy = Strategy([venue], logger, {"BitMEX": None}, None, None, cache)
+    strategy.models = [model]
+
+    # Portfolio price update state only, no DB or render pool.
+    portfolio = Portfolio.__new__(Portfolio)
+    portfolio.logger = logger
+    portfolio.pf = {'trades': {}}
+    portfolio.trades_by_instrument = {}
+    for i, s in enumerate(venue.symbols[::10]):
+        portfolio.pf['trades'][str(i)] = {
+            'trade_id': i, 'venue': "BitMEX", 'symbol': s, 'orders': {},
+            'direction': "LONG" if i % 2 else "SHORT", 'u_pnl': 0,
+            'position': {
+                'status': "OPEN", 'size': 1000, 'avg_entry_price': 10000.0}}
+        portfolio.index_trade(portfolio.pf['trades'][str(i)])
+
+    return strategy, portfolio
+
+
+def consume(strategy, portfolio, new_minutes, batched):
+    events = queue.Queue(0)
+    start = time.time()
+    for new_bars in new_minutes:
+        if batched:
+            event = MarketBatchEvent.from_bars(venue, new_bars)
+            strategy.new_batch(events, event, 1)
+            portfolio.update_price(events, event)
+        else:
+            for b in new_bars:
+                event = MarketEvent(venue, b)
+                strategy.new_data(events, event, 1)
+                portfolio.update_price(events, event)
+    duration = time.time() - start
+
+    signals = []
+    while not events.empty():
+        e = events.get(False)
+        signals.append((e.symbol, e.entry_ts, e.direction, e.timeframe))
+
+    return duration, sorted(signals)
+
+
+results = []
+for batched in [False, True]:
+    strategy, portfolio = consumers()
+    consume(strategy, portfolio, new_minutes[:WARMUP], batched)
+    duration, signals = consume(
+        strategy, portfolio, new_minutes[WARMUP:], batched)
+    results.append((strategy, portfolio, duration, signals))
+
+(single, single_pf, single_time, single_signals), (
+    batch, batch_pf, batch_time, batch_signals) = results
+
+# Same datasets, signals and unrealised pnl either way.
+for s in venue.symbols:
+    for tf in ["1Min", "3Min", "5Min", "15Min", "30Min"]:
+        a, b = single.data["BitMEX"][s][tf], batch.data["BitMEX"][s][tf]
+        assert list(a.columns) == list(b.columns), (s, tf)
+        assert (a.index == b.index).all(), (s, tf)
+        assert np.allclose(a.values, b.values, equal_nan=True), (s, tf)
+assert single_signals and single_signals == batch_signals
+u_pnl = [t['u_pnl'] for t in batch_pf.pf['trades'].values()]
+assert all(u_pnl) and u_pnl == [
+    t['u_pnl'] for t in single_pf.pf['trades'].values()]
+last = minutes[HISTORY + 1 + WARMUP + MINUTES][0]['close']
+assert np.isclose(batch_pf.pf['trades']['0']['u_pnl'], -(
+    1000 / 100) * (last - 10000) / 10000 * 100)
+
+cache.close()
+shutil.rmtree(path)
+
+print(
+    SYMBOLS, "symbols x", MINUTES, "minutes, Strategy and Portfolio: "
+    "per-symbol events", round(single_time, 3), "s, batched",
+    round(batch_time, 3), "s.")
+print("All market batch tests passed.")
@@ -0,0 +1,135 @@
+"""
+Exercise SimulatedExchange fill model and measure bar throughput.
+
+Run from repo root: python "misc testing/simulated_exchange_test.py"
+"""
+
+import logging
+import random
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulated_exchange import SimulatedExchange
+from ledger import ExecutionLedger
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+
+def order(o_id, direction, order_type, metatype, price, size=100,
+          reduce_only=False):
+    return {
+        'trade_id': 1, 'order_id': o_id, 'venue': "BitMEX",
+        'symbol': "XBTUSD", 'direction': direction, 'size': size,
+        'price': price, 'order_type': order_type, 'metatype': metatype,
+        'void_price': None, 'trail': False, 'reduce_only': reduce_only,
+        'post_only': False, 'batch_size': 2}
+
+
+def bar(ts, o, h, l, c):
+    return {
+        'symbol': "XBTUSD", 'timestamp': ts, 'open': o, 'high': h, 'low': l,
+        'close': c, 'volume': 1}
+
+
+fills = []
+ledger = ExecutionLedger(logger)
+sim = SimulatedExchange(logger, slippage=0.001, latency=0)
+sim.register_fill_callback(fills.append)
+sim.register_execution_callback(ledger.add)
+
+sim.new_bar(bar(60, 100, 101, 99, 100))
+
+# Limit entry below market with a protective stop.
+confs = sim.place_bulk_orders([
+    order("1-1", "LONG", "LIMIT", "ENTRY", 98),
+    order("1-2", "SHORT", "STOP", "STOP", 95, reduce_only=True)])
+assert [c['status'] for c in confs] == ["NEW", "NEW"]
+
+# Untouched, nothing fills. Reduce-only stop not touched either.
+sim.new_bar(bar(120, 100, 100.5, 98.5, 99))
+assert not fills
+
+# Limit touched, fills at limit price as maker.
+sim.new_bar(bar(180, 99, 99, 97, 97.5))
+assert fills[-1]['order_id'] == "1-1" and fills[-1]['status'] == "FILLED"
+assert fills[-1]['avg_fill_price'] == 98
+assert sim.get_position("XBTUSD")['size'] == 100
+entry = ledger.get_by_order("1-1")[0]
+assert entry['fee_type'] == "MAKER" and entry['total_fee'] < 0
+
+# Fees in Bitmex.format_execution units, execComm (XBt) / avgPx.
+exec_comm = 100 / 98 * sim.maker_fee * 10 ** 8
+assert abs(entry['total_fee'] - exec_comm / 98) < 1e-9
+
+# Gap through stop, filled at open less slippage.
+sim.new_bar(bar(240, 94, 94.5, 93, 93.5))
+assert fills[-1]['order_id'] == "1-2"
+assert abs(fills[-1]['avg_fill_price'] - 94 * 0.999) < 1e-9
+assert sim.get_position("XBTUSD")['status'] == "CLOSED"
+assert len(sim.get_executions("XBTUSD", 0, 240)) == 2
+
+# Ledger syncs executions missed before its newest from start_ts, prunes.
+synced = ExecutionLedger(logger)
+synced.add(sim.get_executions("XBTUSD", 240, 240))
+assert synced.sync(sim, "XBTUSD", 0) == 1
+assert synced.get_by_order("1-1") == ledger.get_by_order("1-1")
+assert synced.prune("BitMEX", "XBTUSD", 240) == 1
+assert not synced.get_by_order("1-1") and synced.get_by_order("1-2")
+assert synced.prune("BitMEX", "XBTUSD") == 1
+assert not synced.by_order and not synced.exec_ids
+
+# Orders wait out venue latency before they can fill.
+sim = SimulatedExchange(logger, slippage=0, latency=90)
+sim.register_fill_callback(fills.append)
+sim.new_bar(bar(60, 100, 100, 100, 100))
+sim.place_single_order(order("2-1", "LONG", "MARKET", "ENTRY", None))
+count = len(fills)
+sim.new_bar(bar(120, 100, 100, 100, 100))
+assert len(fills) == count
+sim.new_bar(bar(180, 101, 101, 101, 101))
+assert len(fills) == count
+sim.new_bar(bar(240, 102, 102, 102, 102))
+assert fills[-1]['avg_fill_price'] == 102
+
+# Cancels report state, close_position fills at last price.
+sim.place_single_order(order("2-2", "SHORT", "LIMIT", "TAKE_PROFIT", 200))
+confs = sim.cancel_orders([sim.get_orders()[-1]['venue_id']])
+assert list(confs.values())[0]['status'] == "CANCELLED"
+assert sim.close_position("XBTUSD") is True
+assert sim.get_position("XBTUSD")['size'] == 0
+assert sim.cancel_orders([]) is None
+
+# Throughput, bars with a few resting orders.
+sim = SimulatedExchange(logger)
+random.seed(0)
+n = 1000000
+price = 10000.0
+bars = []
+for i in range(n):
+    o = price
+    price += random.gauss(0, 5)
+    bars.append(bar(
+        (i + 1) * 60, o, max(o, price) + 2, min(o, price) - 2, price))
+
+start = time.time()
+confs = []
+for i, b in enumerate(bars):
+    sim.new_bar(b)
+    if i % 1000 == 0:
+        c = b['close']
+        if confs:
+            sim.cancel_orders([conf['venue_id'] for conf in confs])
+        confs = sim.place_bulk_orders([
+            order(str(i) + "-1", "LONG", "LIMIT", "ENTRY", c - 10),
+            order(str(i) + "-2", "SHORT", "STOP", "STOP", c - 60,
+                  reduce_only=True)])
+duration = time.time() - start
+
+print("Processed", n, "bars in", round(duration, 3), "seconds (" +
+      str(int(n / duration)), "bars/s).")
+print("All simulated exchange tests passed.")
@@ -0,0 +1,175 @@
+"""
+Exercise Telegram outbox and TelegramUpdates against a local stand-in
+telegram bot API server. No bot token or network access required.
+
+Run from repo root or misc testing: python "misc testing/telegram_updates_test.py"
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from threading import Thread, Condition
+import logging
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+WHITELIST = [111, 222]
+TOKEN = "test-token"
+
+
+class StandInTelegram:
+    """
+    Minimal bot API: getUpdates with offset and long-poll timeout,
+    sendMessage and sendPhoto.
+    """
+
+    def __init__(self):
+        self.updates = []
+        self.sent = []
+        self.polls = []
+        self.cond = Condition()
+        self.next_id = 1000
+
+    def push_message(self, user_id, text, date, edited=False):
+        with self.cond:
+            self.updates.append({
+                'update_id': self.next_id,
+                'edited_message' if edited else 'message': {
+                    'from': {'id': user_id}, 'date': date, 'text': text}})
+            self.next_id += 1
+            self.cond.notify_all()
+
+    def get_updates(self, offset, timeout):
+        self.polls.append(offset)
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                pending = [
+                    u for u in self.updates if
+                    offset is None or u['update_id'] >= offset]
+                remaining = deadline - time.time()
+                if pending or remaining <= 0:
+                    return pending
+                self.cond.wait(remaining)
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(api):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            offset = int(query['offset'][0]) if 'offset' in query else None
+            timeout = int(query.get('timeout', ['0'])[0])
+            self.reply({'ok': True, 'result': api.get_updates(offset, timeout)})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            api.sent.append((self.path.rsplit("/", 1)[-1], len(body)))
+            self.reply({'ok': True, 'result': {
+                'photo': [{'file_id': 'small'}, {'file_id': 'large'}]}})
+
+        def reply(self, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+api = StandInTelegram()
+server = ThreadingServer(('127.0.0.1', 0), make_handler(api))
+Thread(target=server.serve_forever, daemon=True).start()
+
+os.environ['TELEGRAM_BOT_TOKEN'] = TOKEN
+os.environ['TELEGRAM_BOT_WHITELIST'] = json.dumps(WHITELIST)
+
+from messaging_clients import Telegram, TelegramUpdates
+
+Telegram.URL = "http://127.0.0.1:" + str(server.server_address[1]) + "/bot"
+TelegramUpdates.LONG_POLL = 1
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+tg = Telegram(logger)
+updates = TelegramUpdates(logger, tg)
+updates.start()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+# Decisions are parsed once, keyed by trade ID.
+NOW = int(time.time())
+api.push_message(111, "5 - Accept", NOW)
+api.push_message(222, "6 - Veto", NOW)
+api.push_message(999, "7 - Accept", NOW)         # Not whitelisted.
+api.push_message(111, "8 - Maybe", NOW)          # Unknown decision.
+assert wait_for(lambda: updates.get_decision(6) is False)
+assert updates.get_decision(5) is True
+assert updates.get_decision(7) is None
+assert updates.get_decision(8) is None
+
+# Responses older than the signal are ignored.
+assert updates.get_decision(5, after=NOW) is None
+
+# Edited responses supersede earlier ones.
+api.push_message(111, "5 - Veto", NOW + 1, edited=True)
+assert wait_for(lambda: updates.get_decision(5) is False)
+
+# Confirmed updates are not downloaded again.
+polled = list(api.polls)
+assert polled[0] is None
+assert all(i is not None for i in polled[1:])
+assert updates.offset == api.next_id
+
+updates.clear_decision(5)
+assert updates.get_decision(5) is None
+
+# Unactioned decisions expire.
+updates.expire_decisions(now=NOW + updates.DECISION_TTL)
+assert updates.get_decision(6) is False
+updates.expire_decisions(now=NOW + 1 + updates.DECISION_TTL)
+assert updates.get_decision(6) is None and not updates.decisions
+
+# Outbox: send methods return immediately, images upload once.
+with open("telegram_test_image.png", "wb") as f:
+    f.write(b"\x89PNG" + b"\x00" * 100000)
+
+start = time.time()
+tg.send_image("telegram_test_image.png", "caption")
+tg.send_option_keyboard([["5 - Accept", "5 - Veto"]])
+queued = time.time() - start
+tg.flush()
+os.remove("telegram_test_image.png")
+
+photos = [size for method, size in api.sent if method == "sendPhoto"]
+assert len(photos) == len(WHITELIST)
+assert photos[0] > 100000 and all(size < 1000 for size in photos[1:])
+assert len([m for m, _ in api.sent if m == "sendMessage"]) == len(WHITELIST)
+
+print("Queued messages in", round(queued * 1000, 3), "ms.")
+print("All telegram update consumer tests passed.")
@@ -0,0 +1,154 @@
+"""
+Exercise TickArchive writes, range scans and compaction, then report disk
+usage per million ticks.
+
+Run from repo root: python "misc testing/tick_archive_test.py"
+"""
+
+import tempfile
+import logging
+import random
+import shutil
+import time
+import uuid
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from tick_archive import TickArchive
+from exchange import Exchange
+
+
+TICKS = 1000000
+PER_MESSAGE = 50
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+
+def format_ticks(rows):
+    """
+    Stand-in for Bitmex.format_ticks, rows already hold epoch ms.
+    """
+
+    cols = {
+        col: np.empty(len(rows), dtype=dtype) for col, dtype in
+        Exchange.TICK_DTYPES.items()}
+    for i, row in enumerate(rows):
+        cols['timestamp'][i] = row['ts']
+        cols['price'][i] = row['price']
+        cols['size'][i] = row['size']
+        cols['side'][i] = 1 if row['side'] == "Buy" else -1
+        cols['trade_id'][i] = row['trdMatchID']
+    return cols
+
+
+# Synthetic ticks, ~12 per second, spanning two UTC days.
+random.seed(0)
+start_ms = 1600041600000 - 6 * 3600 * 1000
+ts = start_ms
+price = 10000.0
+rows = []
+for i in range(TICKS):
+    ts += random.randint(0, 160)
+    price = round(price + random.choice([-0.5, 0, 0, 0.5]), 1)
+    rows.append({
+        'symbol': "XBTUSD", 'ts': ts, 'price': price,
+        'size': random.choice([1, 10, 100, 500, 1000, 2500]),
+        'side': random.choice(["Buy", "Sell"]),
+        'trdMatchID': str(uuid.UUID(int=random.getrandbits(128)))})
+
+path = tempfile.mkdtemp()
+# Test days are long closed, keep them uncompressed until asked.
+KEEP = 10 ** 6
+archive = TickArchive(
+    logger, path=path, flush_interval=0.05, compress_after_days=KEEP)
+
+# Queue from a producer, as the websocket thread would.
+t = time.time()
+for i in range(0, TICKS, PER_MESSAGE):
+    archive.add("BitMEX", rows[i:i + PER_MESSAGE], format_ticks)
+queued = time.time() - t
+archive.close()
+print(
+    "Queued", TICKS, "ticks in", round(queued, 3), "s,",
+    round(queued / TICKS * 1e9), "ns per tick on the producer thread.")
+
+archive = TickArchive(logger, path=path, compress_after_days=KEEP)
+days = archive.stored_days("BitMEX", "XBTUSD")
+assert days == ["2020-09-13", "2020-09-14"], days
+
+# Full read matches input, timestamps in ns.
+ticks = archive.get_range("BitMEX", "XBTUSD")
+assert len(ticks['timestamp']) == TICKS
+assert ticks['timestamp'][0] == rows[0]['ts'] * 10 ** 6
+assert ticks['trade_id'][-1] == rows[-1]['trdMatchID'].encode()
+assert (ticks['price'] == [r['price'] for r in rows]).all()
+
+# Range scans on the memory-mapped log.
+lo_ns, hi_ns = rows[100000]['ts'] * 10 ** 6, rows[110000]['ts'] * 10 ** 6
+expected = [r for r in rows if lo_ns <= r['ts'] * 10 ** 6 < hi_ns]
+scan = archive.get_range("BitMEX", "XBTUSD", lo_ns, hi_ns)
+assert len(scan['timestamp']) == len(expected)
+assert scan['trade_id'][0] == expected[0]['trdMatchID'].encode()
+assert not scan['price'].flags.writeable
+
+t = time.time()
+for i in range(1000):
+    lo = random.randint(0, 300000)
+    archive.get_range(
+        "BitMEX", "XBTUSD", rows[lo]['ts'] * 10 ** 6,
+        rows[lo + 1000]['ts'] * 10 ** 6)
+print(
+    "1000 range scans of 1000 ticks in", round(time.time() - t, 3), "s.")
+
+raw = archive.disk_usage()['BitMEX']['XBTUSD']['raw']
+
+# Close out both days, contents unchanged.
+archive.close()
+archive.compress_after_days = 1
+assert archive.compress_old_days(now=1600041600 + 2 * 86400) == 2
+compressed = archive.disk_usage()['BitMEX']['XBTUSD']['compressed']
+assert compressed['ticks'] == TICKS
+ticks = archive.get_range("BitMEX", "XBTUSD", lo_ns, hi_ns)
+assert (ticks['timestamp'] == scan['timestamp']).all()
+assert (ticks['trade_id'] == scan['trade_id']).all()
+
+# Compressed days are read only, late ticks dropped.
+assert archive.write("BitMEX", "XBTUSD", format_ticks(rows[:1])) == 0
+
+# Counts of compressed days are read without decompressing them.
+archive.close()
+assert archive.disk_usage()['BitMEX']['XBTUSD']['compressed']['ticks'] == TICKS
+assert not archive.days
+
+print(
+    "Disk per million ticks: raw",
+    round(raw['bytes_per_million_ticks'] / 2 ** 20, 2), "MiB, compressed",
+    round(compressed['bytes_per_million_ticks'] / 2 ** 20, 2), "MiB.")
+
+shutil.rmtree(path)
+
+# Bad rows and failed batches only lose their own ticks.
+path = tempfile.mkdtemp()
+archive = TickArchive(logger, path=path, compress_after_days=KEEP)
+eth = [dict(r, symbol="ETHUSD") for r in rows[:10]]
+eth[3]['trdMatchID'] = "not-a-uuid"
+archive.add("BitMEX", eth, format_ticks)
+archive.add("BitMEX", [dict(rows[0], symbol="XRPUSD")], lambda rows: 1 / 0)
+archive.add("BitMEX", rows[:10], format_ticks)
+assert archive.flush() == 19
+assert len(archive.get_range("BitMEX", "ETHUSD")['timestamp']) == 9
+assert len(archive.get_range("BitMEX", "XBTUSD")['timestamp']) == 10
+try:
+    archive.encode_trade_ids(np.array(["not-a-uuid"]))
+    raise AssertionError("Invalid trade ID encoded.")
+except Exception as e:
+    assert "UUID" in str(e)
+archive.close()
+shutil.rmtree(path)
+
+print("All tick archive tests passed.")
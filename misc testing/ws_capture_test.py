@@ -0,0 +1,121 @@
+"""
+Record BitMEX stand-in websocket frames, then replay them into an offline
+Bitmex_WS at original speed, 10x and max speed, reporting throughput and
+latency. Finishes with a synthetic busy minute at max speed.
+
+Run from repo root: python "misc testing/ws_capture_test.py"
+"""
+
+import tempfile
+import logging
+import random
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bitmex_standin
+
+from ws_capture import FrameRecorder, FrameReplayer, read_frames, main
+from bitmex_ws import Bitmex_WS
+
+
+CAPTURE_SECONDS = 3
+BUSY_TICKS = 200000
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+venue, server = bitmex_standin.start(trade_rate=300)
+port = str(server.server_address[1])
+path = os.path.join(tempfile.mkdtemp(), "capture.wscap")
+
+
+def offline_ws():
+    return Bitmex_WS(
+        logger, ["XBTUSD"], ["trade"], None, None, None, connect=False)
+
+
+# Record live frames from the stand-in.
+recorder = FrameRecorder(path)
+live = Bitmex_WS(
+    logger, ["XBTUSD"], ["trade"], "ws://127.0.0.1:" + port + "/realtime",
+    None, None, recorder=recorder)
+time.sleep(CAPTURE_SECONDS)
+live.exit()
+assert not live.thread.is_alive()
+recorder.close()
+
+frames = list(read_frames(path))
+assert len(frames) == recorder.frames > 10
+assert all(a[0] <= b[0] for a, b in zip(frames, frames[1:]))
+print(
+    "Captured", recorder.frames, "frames,", recorder.bytes, "bytes, to",
+    os.path.getsize(path), "bytes on disk.")
+
+# Command line capture stops the websocket before closing the file.
+cli_path = os.path.join(os.path.dirname(path), "cli.wscap")
+main(["record", cli_path, "--seconds", "1",
+      "--url", "ws://127.0.0.1:" + port + "/realtime"])
+assert len(list(read_frames(cli_path))) > 1
+
+replayer = FrameReplayer(logger, path)
+capture_seconds = (frames[-1][0] - frames[0][0]) / 10 ** 9
+
+# Original speed keeps capture timing, replayed state matches live state.
+ws = offline_ws()
+report = replayer.replay(ws, speed=1)
+assert abs(report['replay_seconds'] - capture_seconds) < 0.25
+assert ws.get_ticks() == live.get_ticks()[:len(ws.get_ticks())]
+assert len(ws.get_ticks()) > 100
+
+ws = offline_ws()
+report = replayer.replay(ws, speed=10)
+assert report['replay_seconds'] < capture_seconds / 5
+
+ws = offline_ws()
+report = replayer.replay(ws, speed=None)
+assert report['replay_seconds'] < capture_seconds / 10
+
+# Synthetic busy minute, drives a per minute handler from capture time.
+random.seed(0)
+start_ns = 1600000020 * 10 ** 9
+recorder = FrameRecorder(path)
+recorder.record(json.dumps({
+    'table': "trade", 'action': "partial", 'keys': [], 'data': []}),
+    start_ns)
+ts = start_ns
+price = 10000.0
+for i in range(0, BUSY_TICKS, 10):
+    ts += random.randint(0, 20 * 10 ** 6)
+    ticks = []
+    for j in range(10):
+        price += random.choice([-0.5, 0, 0.5])
+        ticks.append({
+            'timestamp': time.strftime(
+                "%Y-%m-%dT%H:%M:%S", time.gmtime(ts // 10 ** 9)) +
+            ".%03dZ" % (ts // 10 ** 6 % 1000),
+            'symbol': "XBTUSD", 'side': random.choice(["Buy", "Sell"]),
+            'size': random.randint(1, 1000), 'price': price,
+            'trdMatchID': "%032x" % random.getrandbits(128)})
+    recorder.record(json.dumps({
+        'table': "trade", 'action': "insert", 'data': ticks}), ts)
+recorder.close()
+
+minutes = []
+ws = offline_ws()
+ws.MAX_SIZE = BUSY_TICKS * 2
+report = FrameReplayer(logger, path).replay(
+    ws, speed=None, on_minute=lambda m: minutes.append(
+        (m, len(ws.get_ticks()))))
+assert len(ws.get_ticks()) == BUSY_TICKS
+assert minutes and minutes[0][0] == 1600000080
+print(
+    "Busy replay:", BUSY_TICKS, "ticks in", round(report['replay_seconds'], 3),
+    "s,", int(BUSY_TICKS / report['replay_seconds']), "ticks/s, over",
+    len(minutes) + 1, "capture minutes.")
+
+print("All websocket capture tests passed.")
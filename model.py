@@ -11,7 +11,7 @@ Some rights reserved. See LICENSE.md, AUTHORS.md.
 
 from abc import ABC, abstractmethod
 from features import Features as f
-from event_types import SignalEvent
+from event_types import SignalEvent, DatasetSnapshot
 import traceback
 import sys
 
@@ -21,6 +21,10 @@ class Model(ABC):
     Base class for strategy models.
     """
 
+    # Alternative bar types the model subscribes to, see BarBuilder, e.g
+    # ["15S", "500T"]. Run with the bar type code in place of a timeframe.
+    bar_types = []
+
     def __init__(self):
         super().__init__()
 
@@ -39,6 +43,13 @@ class Model(ABC):
 
         return self.lookback
 
+    def get_bar_types(self):
+        """
+        Return list of subscribed alternative bar types.
+        """
+
+        return self.bar_types
+
     def get_features(self):
         """
         Return list of features in use by the model.
@@ -160,7 +171,7 @@ class EMACrossTestingOnly(Model):
         self.logger.info(
             "Running " + str(timeframe) + " " + self.get_name() + ".")
 
-        if timeframe in self.operating_timeframes:
+        if timeframe in self.operating_timeframes + self.bar_types:
 
             features = list(zip(
                 op_data[timeframe].index, op_data[timeframe]['open'],
@@ -223,7 +234,8 @@ class EMACrossTestingOnly(Model):
                                            direction, timeframe, self.name,
                                            exchange, entry_price, "Market", None,
                                            None, None, False, None,
-                                           op_data[timeframe])
+                                           DatasetSnapshot.from_frame(
+                                               op_data[timeframe]))
                     else:
                         return None
 
@@ -11,21 +11,18 @@ Some rights reserved. See LICENSE.md, AUTHORS.md.
 
 from trade_types import SingleInstrumentTrade, Order, Position, TradeID
 from event_types import OrderEvent, FillEvent
+from portfolio_store import PortfolioStore
+from analytics import TradeStats, Performance
+from render_pool import RenderPool
+from ledger import ExecutionLedger
 
 from datetime import datetime
-import numpy as np
+from threading import Lock
 import traceback
-
-import matplotlib
-matplotlib.use('qt5agg')
-
-import mplfinance as mpl
-import pymongo
-import queue
+import asyncio
 import time
 import json
 import sys
-import os
 
 
 class Portfolio:
@@ -55,10 +52,34 @@ class Portfolio:
         self.models = models
         self.telegram = telegram
         self.broker = None
+        self.renderer = RenderPool(self.logger, self.telegram)
+
+        # Event loop for sync callers of venue coroutines, reused across
+        # calls. Trades may complete on the telegram consumer thread too.
+        self.loop = None
+        self.loop_lock = Lock()
+
+        # Local record of venue executions for pnl and fee calculation.
+        self.ledger = ExecutionLedger(self.logger)
+        for exchange in self.exchanges.values():
+            exchange.register_execution_callback(self.ledger.add)
 
-        self.trades_save_to_db = queue.Queue(0)
         self.id_gen = TradeID(db_other)
-        self.pf = self.load_portfolio()
+        self.store = PortfolioStore(self.logger, db_other)
+        self.pf = self.store.load(self.default_portfolio())
+
+        # Open trade indexes {(venue, symbol): {trade_id}} and
+        # {venue order ID: (trade_id, order_id)}.
+        self.trades_by_instrument = {}
+        self.trades_by_venue_id = {}
+        self.index_open_trades()
+
+        # Running post-trade statistics, rebuilt if not yet stored.
+        if 'stats' in self.pf:
+            self.stats = TradeStats.from_dict(self.pf['stats'])
+        else:
+            self.rebuild_stats()
+
         self.verify_portfolio_state(self.pf)
 
     def new_signal(self, events, event):
@@ -170,31 +191,30 @@ class Portfolio:
             # Finalise trade object. Must be called to set ID + order count
             trade.set_batch_size_and_id(trade_id)
 
-            # Queue the trade for storage.
-            self.trades_save_to_db.put(trade.get_trade_dict())
-
-            # Store trade immediately
-            self.save_new_trades_to_db()
-
             # Set order batch size and queue orders for execution.
             batch_size = len(orders)
             for order in orders:
                 order.batch_size = batch_size
 
             within_risk_limits, msg = self.within_risk_limits(signal)
-
-            # Generate static image of trade setup.
             t_dict = trade.get_trade_dict()
-            self.generate_trade_setup_image(
-                t_dict, signal['op_data'], within_risk_limits, msg)
 
             # Only raise orders and add to portfilio if within risk limits.
             if within_risk_limits:
                 self.pf['trades'][str(trade_id)] = t_dict
+                self.index_trade(t_dict)
                 self.save_portfolio(self.pf)
                 for order in orders:
                     events.put(OrderEvent(order.get_order_dict()))
 
+            # Trades outside risk limits are stored but not tracked.
+            else:
+                self.store.archive_trade(t_dict)
+
+            # Render and send trade setup image in the background.
+            self.generate_trade_setup_image(
+                t_dict, signal['op_data'], within_risk_limits, msg)
+
         # TODO: handle multi-instrument, multi-venue trades.
         elif signal['instrument_count'] == 2:
             pass
@@ -209,9 +229,12 @@ class Portfolio:
         Process incoming fill event, update position, trade and order state
         accordingly.
 
+        Partial fills change position size only. An order is complete, and
+        may complete its trade, only once FILLED. Cancellations change order
+        state only. Fills for unknown or archived trades are ignored.
+
         Args:
-            events: event queue object.
-            event: new market event.
+            fill_event: fill event.
 
         Returns:
            None.
@@ -221,69 +244,111 @@ class Portfolio:
         """
 
         fill_conf = fill_event.get_order_conf()
-        position = Position(fill_conf).get_pos_dict()
-        trade_id = str(position['trade_id'])
+        trade_id = str(fill_conf['trade_id'])
+        o_id = fill_conf['order_id']
+
+        trade = self.pf['trades'].get(trade_id)
+        if trade is None or o_id not in trade['orders']:
+            self.logger.info(
+                "Order " + str(o_id) + " " + fill_conf['status'].lower() +
+                " for unknown or completed trade " + trade_id + ".")
+            return
+
+        # Size filled by this conf, from the orders cumulative filled size.
+        order = trade['orders'][o_id]
+        prev_filled = order.get('filled') or 0
+        filled = fill_conf.get('filled')
+        if filled is None:
+            filled = fill_conf['size'] if fill_conf['status'] == "FILLED" \
+                else prev_filled
+
+        # Already processed.
+        if order['status'] == fill_conf['status'] and filled == prev_filled:
+            return
+
+        # Record new order state.
+        order['status'] = fill_conf['status']
+        order['filled'] = filled
+        fill_size = filled - prev_filled
+        complete = fill_conf['status'] == "FILLED"
+
+        if fill_conf['status'] == "CANCELLED" or not fill_size and not \
+                complete:
+            pass
+
+        elif fill_conf['metatype'] == "ENTRY":
 
-        if fill_conf['metatype'] == "ENTRY":
+            # Create a position record and set trade to active on first fill.
+            if trade['position'] is None:
+                position = Position(fill_conf).get_pos_dict()
+                position['size'] = filled
+                position['opening_size'] = filled
+                trade['position'] = position
+                trade['active'] = True
+                trade['exposure'] = 100
+                self.pf['total_active_trades'] += 1
+
+            else:
+                trade['position']['size'] += fill_size
+                trade['position']['opening_size'] += fill_size
 
-            # Create a position record and set trade to active.
-            self.pf['trades'][trade_id]['position'] = position
-            self.pf['trades'][trade_id]['active'] = True
-            self.pf['trades'][trade_id]['exposure'] = 100
-            self.pf['trades'][trade_id]['entry_price'] = position['avg_entry_price']
-            self.pf['total_active_trades'] += 1
+            # Venue average fill price covers all fills of the order.
+            if fill_conf['avg_fill_price'] is not None:
+                trade['position']['avg_entry_price'] = \
+                    fill_conf['avg_fill_price']
+            trade['entry_price'] = trade['position']['avg_entry_price']
 
         elif fill_conf['metatype'] == "STOP":
 
-            # Update the now closed postiion, trade is done.
-            size = self.pf['trades'][trade_id]['position']['size']
-            new_size = size - fill_conf['size']
+            # Update the position, trade is done once the stop fills.
+            size = trade['position']['size']
+            new_size = size - fill_size
 
-            # Should be 0
-            if new_size > 0:
+            # Should be 0 once filled.
+            if complete and new_size > 0:
                 raise Exception(new_size)
             # Can be negative if user modifies positions manually
             elif new_size < 0:
                 new_size = 0
 
-            self.pf['trades'][trade_id]['position']['size'] = new_size
-            self.pf['trades'][trade_id]['position']['status'] = "CLOSED"
-            self.pf['trades'][trade_id]['exposure'] = 0
-
-            # If ther order was cancelled there will not be 
+            trade['position']['size'] = new_size
 
-            self.trade_complete(trade_id)
+            if complete:
+                trade['position']['status'] = "CLOSED"
+                trade['exposure'] = 0
+                self.trade_complete(trade_id)
 
         elif fill_conf['metatype'] == "TAKE_PROFIT":
 
             # Update the modified position.
-            size = self.pf['trades'][trade_id]['position']['size']
-            new_size = size - fill_conf['size']
-            self.pf['trades'][trade_id]['position']['size'] = new_size
+            new_size = trade['position']['size'] - fill_size
+            trade['position']['size'] = new_size
 
             # TODO: Find adjusted exposure
             # what % of the position has been closed vs starting size
             # self.pf['trades'][trade_id]['exposure'] = ?
 
-            if new_size == 0:
-                self.trade_complete(trade_id)
-            else:
-                self.calculate_pnl_by_trade(trade_id, take_profit=True)
+            if complete:
+                if new_size == 0:
+                    self.trade_complete(trade_id)
+                else:
+                    self.calculate_pnl_by_trade(trade_id, take_profit=True)
 
         elif fill_conf['metatype'] == "FINAL_TAKE_PROFIT":
 
-            # Update the now closed postiion, trade is done.
-            size = self.pf['trades'][trade_id]['position']['size']
-            new_size = size - fill_conf['size']
-            self.pf['trades'][trade_id]['position']['size'] = new_size
-            self.pf['trades'][trade_id]['position']['status'] = "CLOSED"
-            self.pf['trades'][trade_id]['exposure'] = 0
+            # Update the position, trade is done once the final TP fills.
+            new_size = trade['position']['size'] - fill_size
+            trade['position']['size'] = new_size
 
-            if new_size != 0:
-                raise Exception(
-                    "Position close size error:", new_size)
+            if complete:
+                trade['position']['status'] = "CLOSED"
+                trade['exposure'] = 0
 
-            self.trade_complete(trade_id)
+                if new_size != 0:
+                    raise Exception(
+                        "Position close size error:", new_size)
+
+                self.trade_complete(trade_id)
 
         else:
             raise Exception("Order metatype error:", fill_conf['metatype'])
@@ -308,7 +373,12 @@ class Portfolio:
         for conf in order_confs:
             trade_id = str(conf['trade_id'])
             o_id = str(conf['order_id'])
-            self.pf['trades'][trade_id]['orders'][o_id] = conf
+
+            # Filled size is recorded when the fill is processed.
+            order = dict(conf, filled=self.pf['trades'][trade_id][
+                'orders'].get(o_id, {}).get('filled') or 0)
+            self.pf['trades'][trade_id]['orders'][o_id] = order
+            self.index_trade(self.pf['trades'][trade_id])
 
             # Create a fill event if order already filled (e.g. market orders).
             if conf['status'] == "FILLED":
@@ -319,17 +389,43 @@ class Portfolio:
     def trade_complete(self, trade_id):
         """
         Check all orders and positions are closed, calculate pnl, run post
-        trade checks/analytics.
+        trade checks/analytics. Archive the trade once complete.
         """
 
-        self.cancel_orders_by_trade_id(trade_id)
+        trade_id = str(trade_id)
 
-        # Close positions if still open.
-        if self.check_position_open(trade_id):
-            self.close_position_by_trade_id(trade_id)
+        # Cancel orders, close positions if still open and fetch executions
+        # for pnl calculation, concurrently.
+        accepted = self.trade_accepted(trade_id)
+        self.run_coroutine(self.close_trade(trade_id, accepted))
+        self.finish_trade(trade_id, accepted)
+
+    async def trade_complete_async(self, trade_id):
+        """
+        Coroutine variant of trade_complete, for callers already running an
+        event loop.
+        """
+
+        trade_id = str(trade_id)
+
+        accepted = self.trade_accepted(trade_id)
+        await self.close_trade(trade_id, accepted)
+        self.finish_trade(trade_id, accepted)
+
+    def trade_accepted(self, trade_id):
+        """
+        Return true if the given trade was accepted by the user.
+        """
+
+        return self.pf['trades'][trade_id]['consent'] != "SUPERCEEDED" and self.pf['trades'][trade_id]['consent'] is not None
+
+    def finish_trade(self, trade_id, accepted):
+        """
+        Update portfolio metrics for a closed trade and archive it.
+        """
 
         # Only update portfolio metrics if trade was accepted by user.
-        if self.pf['trades'][trade_id]['consent'] != "SUPERCEEDED" and self.pf['trades'][trade_id]['consent'] is not None:
+        if accepted:
             self.calculate_pnl_by_trade(trade_id)
             self.post_trade_analysis(trade_id)
 
@@ -340,11 +436,57 @@ class Portfolio:
         # Mark trade as inactive
         self.pf['trades'][trade_id]['active'] = False
 
+        # Move trade from open trades to trade archive.
+        self.archive_trade(trade_id)
+
         # Save updated portfolio state to DB.
         self.save_portfolio(self.pf, output=False)
 
-        # Update trades DB to reflect portfolio state.
-        self.update_trades_db(trade_id)
+    def run_coroutine(self, coro):
+        """
+        Run the given coroutine to completion on the portfolios event loop,
+        for sync callers. Code already running an event loop must await the
+        coroutine variants instead.
+
+        Raises:
+            Exception if called from a running event loop.
+        """
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            coro.close()
+            raise Exception(
+                "Event loop already running, await the coroutine variant.")
+
+        with self.loop_lock:
+            if self.loop is None or self.loop.is_closed():
+                self.loop = asyncio.new_event_loop()
+
+            return self.loop.run_until_complete(coro)
+
+    async def close_trade(self, trade_id, sync_executions=True):
+        """
+        Cancel the given trades orders, close its position if still open and
+        optionally fetch executions missing from the ledger, with venue
+        requests overlapped.
+        """
+
+        trade = self.pf['trades'][trade_id]
+
+        jobs = [self.cancel_orders_by_trade_id_async(trade_id)]
+
+        if self.check_position_open(trade_id):
+            jobs.append(self.close_position_by_trade_id_async(trade_id))
+
+        if sync_executions:
+            jobs.append(self.exchanges[trade['venue']].run_async(
+                self.sync_executions, trade['venue'], trade['symbol'],
+                trade['signal_timestamp']))
+
+        await asyncio.gather(*jobs)
 
     def cancel_orders_by_trade_id(self, trade_id):
         """
@@ -352,6 +494,13 @@ class Portfolio:
         local portfolio state.
         """
 
+        self.run_coroutine(self.cancel_orders_by_trade_id_async(trade_id))
+
+    async def cancel_orders_by_trade_id_async(self, trade_id):
+        """
+        Coroutine variant of cancel_orders_by_trade_id.
+        """
+
         t_id = str(trade_id)
 
         o_ids = list(self.pf['trades'][t_id]['orders'].keys())
@@ -359,9 +508,13 @@ class Portfolio:
             self.pf['trades'][t_id]['orders'][o]['venue_id'] for o in o_ids if
             self.pf['trades'][t_id]['orders'][o]['status'] != "FILLED"]
 
+        # Nothing to cancel.
+        if not v_ids:
+            return
+
         venue = self.pf['trades'][t_id]['venue']
 
-        cancel_confs = self.exchanges[venue].cancel_orders(v_ids)
+        cancel_confs = await self.exchanges[venue].cancel_orders_async(v_ids)
 
         if cancel_confs:
             for v_id in v_ids:
@@ -369,8 +522,8 @@ class Portfolio:
                     if cancel_confs[v_id]['status'] == "CANCELLED" or cancel_confs[v_id]['status'] == "FILLED":
                         self.pf['trades'][t_id]['active'] = False
                         for o in o_ids:
-                            # print("Setting new order status:", o, cancel_confs[v_id]['status'])
-                            self.pf['trades'][t_id]['orders'][o]['status'] == cancel_confs[v_id]['status']
+                            if self.pf['trades'][t_id]['orders'][o]['venue_id'] == v_id:
+                                self.pf['trades'][t_id]['orders'][o]['status'] = cancel_confs[v_id]['status']
 
                         if cancel_confs[v_id]['order_type'] == 'Stop':
                             self.pf['trades'][t_id]['exit_price'] = cancel_confs[v_id]['price']
@@ -420,8 +573,15 @@ class Portfolio:
         for specifc instrument at a specific venue.
         """
 
-        close = self.exchanges[
-            self.pf['trades'][trade_id]['venue']].close_position(
+        self.run_coroutine(self.close_position_by_trade_id_async(trade_id))
+
+    async def close_position_by_trade_id_async(self, trade_id):
+        """
+        Coroutine variant of close_position_by_trade_id.
+        """
+
+        close = await self.exchanges[
+            self.pf['trades'][trade_id]['venue']].close_position_async(
                 self.pf['trades'][trade_id]['symbol'],
                 self.pf['trades'][trade_id]['position']['size'],
                 self.pf['trades'][trade_id]['direction'])
@@ -444,10 +604,6 @@ class Portfolio:
 
         trade = self.pf['trades'][trade_id]
 
-        # Get order executions for trade in period from trade signal to current time.
-        execs = self.exchanges[trade['venue']].get_executions(
-            trade['symbol'], trade['signal_timestamp'], int(datetime.now().timestamp()))
-
         # Handle two-order trades (single exit, single entry).
         total_orders = len(trade['orders'])
         if total_orders == 2:
@@ -460,19 +616,15 @@ class Portfolio:
             exit_oid = None
             # tp_oids = []
 
-        # Entry executions will match direction of trade and bear the entry order id.
-        entries = [i for i in execs if i['direction'] == trade['direction'] and i['order_id'] == entry_oid]
-
-        # API-submitted exit executions should be the reverse
-        exits = [i for i in execs if i['direction'] != trade['direction'] and i['order_id'] == exit_oid]
-        manual_exit = False
-
-        # Exit orders placed manually wont bear the order id and cant be evaluated with certainty
-        # if there were multiple trades with executions in the same period as the current trade.
-        # If manual exit, notify user if the exit total is differnt to entry total.
-        if not exits:
-            exits = [i for i in execs if i['direction'] != trade['direction']]
-            manual_exit = True if exits else None
+        # Fetch executions missing from the ledger, e.g if the venue stream
+        # was disconnected, only if the ledger cant account for the trade.
+        entries, exits, manual_exit = self.find_trade_executions(
+            trade, entry_oid, exit_oid)
+        if not entries or not exits or manual_exit:
+            self.sync_executions(
+                trade['venue'], trade['symbol'], trade['signal_timestamp'])
+            entries, exits, manual_exit = self.find_trade_executions(
+                trade, entry_oid, exit_oid)
 
         # Find final pnl figures
         if entries and exits:
@@ -490,9 +642,8 @@ class Portfolio:
 
             # Log trade stats
             self.pf['current_balance'] += final_pnl
-            self.pf['balance_history'][str(int(time.time()))] = {
-                'amt': final_pnl,
-                'trade_id': trade_id}
+            self.add_balance_history(
+                final_pnl, trade_id, max(i['timestamp'] for i in exits))
             self.pf['trades'][trade_id]['u_pnl'] = 0
             self.pf['trades'][trade_id]['r_pnl'] = final_pnl
             self.pf['trades'][trade_id]['fees'] = fees
@@ -513,6 +664,44 @@ class Portfolio:
         if manual_exit:
             self.logger.info("Non-systematic exit orders detected for trade " + trade_id + ". Please manually verify final pnl figure and that all orders are closed. Avoid closing positions or cancelling orders manually.")            
 
+    def find_trade_executions(self, trade, entry_oid, exit_oid):
+        """
+        Return (entry executions, exit executions, manual exit) for the given
+        trade from the execution ledger.
+        """
+
+        # Entry executions will match direction of trade and bear the entry order id.
+        entries = [i for i in self.ledger.get_by_order(entry_oid) if i['direction'] == trade['direction']]
+
+        # API-submitted exit executions should be the reverse
+        exits = [i for i in self.ledger.get_by_order(exit_oid) if i['direction'] != trade['direction']]
+        manual_exit = False
+
+        # Exit orders placed manually wont bear the order id and cant be evaluated with certainty
+        # if there were multiple trades with executions in the same period as the current trade.
+        # If manual exit, notify user if the exit total is differnt to entry total.
+        if not exits:
+            execs = self.ledger.get_range(
+                trade['venue'], trade['symbol'], trade['signal_timestamp'])
+            exits = [i for i in execs if i['direction'] != trade['direction']]
+            manual_exit = True if exits else None
+
+        return entries, exits, manual_exit
+
+    def sync_executions(self, venue, symbol, start_ts=None):
+        """
+        Add executions missing from the execution ledger for the given
+        instrument from venue execution history.
+        """
+
+        try:
+            self.ledger.sync(self.exchanges[venue], symbol, start_ts)
+
+        except Exception:
+            self.logger.info(
+                "Failed to fetch " + venue + " " + symbol + " executions.")
+            traceback.print_exc()
+
     def post_trade_analysis(self, trade_id):
         """
         Conduct post-trade portfolio analytics.
@@ -530,44 +719,105 @@ class Portfolio:
             self.pf['low_balance'] = self.pf['current_balance']
             self.logger.info("New portfolio value all-time-low: " + str(self.pf['current_balance']))        
 
-        balance_history = [i for i in list(self.pf['balance_history'].values())[1:]]
-
-        if len(balance_history) > 1:
-
-            # 'total_consecutive_wins'
-            # 'total_consecutive_losses'
-            if balance_history[-1]['amt'] > 0 and balance_history[-2]['amt'] > 0:
-                self.pf['total_consecutive_wins'] += 1
-            elif balance_history[-1]['amt'] < 0 and balance_history[-2]['amt'] < 0:
-                self.pf['total_consecutive_losses'] += 1
-
-            # 'avg_r_per_trade'
-            # 'avg_r_per_winner'
-            # 'avg_r_per_loser'
-            winners_r, losers_r, total_r = [], [], []
-            for transaction in balance_history:
-                trade = self.pf['trades'][transaction['trade_id']]
-                entry = trade['position']['avg_entry_price']
-                stop = list(trade['orders'].values())[-1]['price']
-                exit = trade["exit_price"]
-                rr = (exit - entry) / (entry - stop)
-                total_r.append(rr)
-
-                if transaction['amt'] > 0:
-                    winners_r.append(rr)
-
-                elif transaction['amt'] < 0:
-                    losers_r.append(rr)
-
-            self.pf['avg_r_per_trade'] = round(sum(total_r) / len(total_r), 2)
-            self.pf['avg_r_per_winner'] = round(sum(winners_r) / len(winners_r), 2)
-            self.pf['avg_r_per_loser'] = round(sum(losers_r) / len(losers_r), 2)
-
-            # 'win_loss_ratio'
-            if self.pf['total_winning_trades'] and self.pf['total_losing_trades']:
-                self.pf['win_loss_ratio'] = self.pf['total_winning_trades'] / self.pf['total_losing_trades']
-            elif self.pf['total_winning_trades'] and not self.pf['total_losing_trades']:
-                self.pf['win_loss_ratio'] = self.pf['total_winning_trades']
+        trade = self.pf['trades'][trade_id]
+        self.stats.update(
+            trade['r_pnl'], self.calculate_r(trade), self.pf['current_balance'])
+        self.apply_stats()
+
+    def calculate_r(self, trade):
+        """
+        Return R multiple of the given closed trade, or None if the trade has
+        no entry, exit or stop price.
+        """
+
+        stops = [
+            o['price'] for o in trade['orders'].values() if
+            o['metatype'] == "STOP"]
+
+        if not stops or not trade['position'] or trade['exit_price'] is None:
+            return None
+
+        entry = trade['position']['avg_entry_price']
+        stop = stops[-1]
+
+        if entry == stop:
+            return None
+
+        return (trade['exit_price'] - entry) / (entry - stop)
+
+    def apply_stats(self):
+        """
+        Copy running statistics to portfolio metrics.
+        """
+
+        self.pf['stats'] = self.stats.to_dict()
+
+        self.pf['total_consecutive_wins'] = self.stats.consecutive_wins
+        self.pf['total_consecutive_losses'] = self.stats.consecutive_losses
+        self.pf['avg_r_per_trade'] = round(self.stats.r_all.mean, 2)
+        self.pf['avg_r_per_winner'] = round(self.stats.r_winners.mean, 2)
+        self.pf['avg_r_per_loser'] = round(self.stats.r_losers.mean, 2)
+
+        # 'win_loss_ratio'
+        if self.pf['total_winning_trades'] and self.pf['total_losing_trades']:
+            self.pf['win_loss_ratio'] = self.pf['total_winning_trades'] / self.pf['total_losing_trades']
+        elif self.pf['total_winning_trades'] and not self.pf['total_losing_trades']:
+            self.pf['win_loss_ratio'] = self.pf['total_winning_trades']
+
+    def rebuild_stats(self):
+        """
+        Recalculate running statistics from balance history and the trade
+        archive, e.g if stored statistics are missing or suspect.
+        """
+
+        history = [
+            i for i in Performance.sorted_history(self.pf['balance_history'])
+            if i[2] != "initial_deposit"]
+
+        trades = self.store.read_trades([i[2] for i in history])
+
+        self.stats = TradeStats(self.pf['starting_balance'])
+        balance = self.pf['starting_balance']
+        for _, amount, trade_id in history:
+            trade = trades.get(str(trade_id))
+            balance += amount
+            self.stats.update(
+                amount, self.calculate_r(trade) if trade else None, balance)
+
+        self.apply_stats()
+        self.logger.info(
+            "Rebuilt portfolio statistics from " + str(len(history)) +
+            " closed trades.")
+
+    def performance(self, period=Performance.DAY):
+        """
+        Return vectorised performance statistics for the portfolio.
+        """
+
+        trade_ids = [
+            i['trade_id'] for i in self.pf['balance_history'].values() if
+            i['trade_id'] != "initial_deposit"]
+
+        trades = self.store.read_trades(
+            trade_ids, ['model', 'position.opening_timestamp'])
+
+        return Performance.from_portfolio(self.pf, trades, period)
+
+    def add_balance_history(self, amount, trade_id, timestamp):
+        """
+        Record a change in balance in balance history, dated by the given
+        epoch timestamp, e.g the closing execution of a trade.
+
+        Keys are unique, several changes may share a timestamp in backtests.
+        """
+
+        key = str(int(timestamp)) + "_" + str(
+            len(self.pf['balance_history']))
+        self.pf['balance_history'][key] = {
+            'amt': amount,
+            'trade_id': trade_id,
+            'timestamp': int(timestamp)}
+        self.store.mark_changed('balance_history', key)
 
     def verify_portfolio_state(self, portfolio):
         """
@@ -577,6 +827,7 @@ class Portfolio:
         # TODO.
 
         self.save_portfolio(portfolio)
+        self.flush_portfolio()
         self.logger.info("Portfolio verification complete.")
 
     def load_portfolio(self, ID=1):
@@ -584,56 +835,64 @@ class Portfolio:
         Load portfolio matching ID from database or return empty portfolio.
         """
 
-        portfolio = self.db_other['portfolio'].find_one({"id": ID}, {"_id": 0})
+        portfolio = PortfolioStore(self.logger, self.db_other, ID).read()
 
         if portfolio:
             return portfolio
 
         else:
-            default_portfolio = {
-                'id': ID,
-                'balance_history': {
-                    str(int(time.time())): {
-                        'amt': self.DEFAULT_START,
-                        'trade_id': "initial_deposit"}},
-                'current_balance': self.DEFAULT_START,
-                'starting_balance': self.DEFAULT_START,
-                'peak_balance': self.DEFAULT_START,
-                'low_balance': self.DEFAULT_START,
-                'total_trades': 0,
-                'total_winning_trades': 0,
-                'total_losing_trades': 0,
-                'total_consecutive_wins': 0,
-                'total_consecutive_losses': 0,
-                'avg_r_per_winner': 0,
-                'avg_r_per_loser': 0,
-                'avg_r_per_trade': 0,
-                'win_loss_ratio': 0,
-                'risk_per_trade': self.RISK_PER_TRADE,
-                'max_simultaneous_positions': self.MAX_SIMULTANEOUS_POSITIONS,
-                'max_correlated_positions': self.MAX_CORRELATED_POSITIONS,
-                'max_accepted_drawdown': self.MAX_ACCEPTED_DRAWDOWN,
-                'default_stop': self.DEFAULT_STOP,
-                'model_allocations': {  # Equal allocation by default.
-                    i.get_name(): (100 / len(self.models)) for i in self.models},
-                'total_active_trades': 0,
-                'trades': {}}
-
-            return default_portfolio
+            return self.default_portfolio(ID)
+
+    def default_portfolio(self, ID=1):
+        """
+        Return a new, empty portfolio.
+        """
+
+        return {
+            'id': ID,
+            'balance_history': {
+                str(int(time.time())) + "_0": {
+                    'amt': self.DEFAULT_START,
+                    'trade_id': "initial_deposit",
+                    'timestamp': int(time.time())}},
+            'current_balance': self.DEFAULT_START,
+            'starting_balance': self.DEFAULT_START,
+            'peak_balance': self.DEFAULT_START,
+            'low_balance': self.DEFAULT_START,
+            'total_trades': 0,
+            'total_winning_trades': 0,
+            'total_losing_trades': 0,
+            'total_consecutive_wins': 0,
+            'total_consecutive_losses': 0,
+            'avg_r_per_winner': 0,
+            'avg_r_per_loser': 0,
+            'avg_r_per_trade': 0,
+            'win_loss_ratio': 0,
+            'risk_per_trade': self.RISK_PER_TRADE,
+            'max_simultaneous_positions': self.MAX_SIMULTANEOUS_POSITIONS,
+            'max_correlated_positions': self.MAX_CORRELATED_POSITIONS,
+            'max_accepted_drawdown': self.MAX_ACCEPTED_DRAWDOWN,
+            'default_stop': self.DEFAULT_STOP,
+            'model_allocations': {  # Equal allocation by default.
+                i.get_name(): (100 / len(self.models)) for i in self.models},
+            'total_active_trades': 0,
+            'stats': TradeStats(self.DEFAULT_START).to_dict(),
+            'trades': {}}
 
     def save_portfolio(self, portfolio, output=True):
         """
-        Save portfolio state to DB.
+        Stage changes to portfolio state for the next DB write. Changes are
+        coalesced and written once per cycle by flush_portfolio().
         """
 
-        result = self.db_other['portfolio'].replace_one(
-            {"id": portfolio['id']}, portfolio, upsert=True)
+        self.store.stage(portfolio)
 
-        if result.acknowledged and output:
-            self.logger.info("Portfolio save successful.")
+    def flush_portfolio(self):
+        """
+        Write all staged portfolio and trade changes to DB.
+        """
 
-        else:
-            self.logger.info("Portfolio save unsuccessful.")
+        self.store.flush()
 
     def within_risk_limits(self, signal):
         """
@@ -650,9 +909,9 @@ class Portfolio:
                 if not self.correlated(signal):
 
                     # Same-asset, same-venue trade conflict checks.
-                    trades = [t for t in self.pf['trades'].values()]
-                    conflicted_active_trades = [t for t in trades if t['active'] and t['symbol'] == signal['symbol'] and t['venue'] == signal['venue']]
-                    conflicted_pending_trades = [t for t in trades if not t['active'] and not t['position'] and t['consent'] != "SUPERCEEDED" and t['symbol'] == signal['symbol'] and t['venue'] == signal['venue']]
+                    trades = self.open_trades(signal['venue'], signal['symbol'])
+                    conflicted_active_trades = [t for t in trades if t['active']]
+                    conflicted_pending_trades = [t for t in trades if self.is_pending(t)]
 
                     if conflicted_active_trades:
 
@@ -705,6 +964,119 @@ class Portfolio:
             self.logger.info("New trade skipped. Position limit reached.")
             return False, "Position limit reached."
 
+    def index_open_trades(self):
+        """
+        Build open trade indexes. Completed trades loaded from DB (saved
+        before trades were archived) are archived.
+        """
+
+        self.trades_by_instrument = {}
+        self.trades_by_venue_id = {}
+
+        for t_id, trade in list(self.pf['trades'].items()):
+            if trade['active'] or (
+                    self.is_pending(trade) and trade['consent'] is not False):
+                self.index_trade(trade)
+
+            else:
+                self.archive_trade(t_id)
+
+    def index_trade(self, trade):
+        """
+        Add the given open trade and its placed orders to open trade indexes.
+        """
+
+        t_id = str(trade['trade_id'])
+
+        self.trades_by_instrument.setdefault(
+            (trade['venue'], trade['symbol']), set()).add(t_id)
+
+        for o_id, order in trade['orders'].items():
+            if order['venue_id'] is not None:
+                self.trades_by_venue_id[order['venue_id']] = (t_id, o_id)
+
+    def unindex_trade(self, trade):
+        """
+        Remove the given trade and its orders from open trade indexes.
+        """
+
+        t_id = str(trade['trade_id'])
+        key = (trade['venue'], trade['symbol'])
+
+        self.trades_by_instrument.get(key, set()).discard(t_id)
+        if not self.trades_by_instrument.get(key, True):
+            del self.trades_by_instrument[key]
+
+        for order in trade['orders'].values():
+            self.trades_by_venue_id.pop(order['venue_id'], None)
+
+    def open_trades(self, venue, symbol):
+        """
+        Return list of active and pending trades for the given instrument.
+        """
+
+        return [
+            self.pf['trades'][t_id] for t_id in
+            self.trades_by_instrument.get((venue, symbol), ())]
+
+    def is_pending(self, trade):
+        """
+        Return true if trade is awaiting user consent or entry.
+        """
+
+        return (
+            not trade['active'] and not trade['position'] and
+            trade['consent'] != "SUPERCEEDED")
+
+    def get_trade(self, trade_id):
+        """
+        Return trade matching trade_id. Open trades are held in memory,
+        archived trades are loaded from DB.
+        """
+
+        trade = self.pf['trades'].get(str(trade_id))
+
+        if trade is None:
+            trade = self.store.read_trade(trade_id)
+
+        return trade
+
+    def get_trade_by_venue_id(self, venue_id):
+        """
+        Return (trade, order ID) for the open trade owning the order with the
+        given venue order ID, or (None, None) if not found.
+        """
+
+        try:
+            t_id, o_id = self.trades_by_venue_id[venue_id]
+
+        except KeyError:
+            return None, None
+
+        return self.pf['trades'][t_id], o_id
+
+    def archive_trade(self, trade_id):
+        """
+        Mark trade complete, stage its final state and drop it from open
+        trades.
+        """
+
+        trade = self.pf['trades'].pop(str(trade_id))
+        trade['complete'] = True
+        self.unindex_trade(trade)
+        self.store.archive_trade(trade)
+
+        # Venue IDs of archived trades no longer resolve, drop fill history.
+        if self.broker is not None:
+            self.broker.clear_fills(trade_id)
+
+        # Keep only executions open trades may need.
+        open_trades = self.open_trades(trade['venue'], trade['symbol'])
+        self.ledger.prune(
+            trade['venue'], trade['symbol'],
+            min(t['signal_timestamp'] for t in open_trades)
+            if open_trades else None)
+
     def superceed_older_signals(self, signal, conflicted_pending_trades: list):
         """
         Remove pending, unactioned trades that conflict with the given signal.
@@ -720,14 +1092,14 @@ class Portfolio:
 
                     self.pf['trades'][t_id]['consent'] = "SUPERCEEDED"
 
-                    del self.broker.orders[trade['trade_id']]
+                    self.broker.remove_pending(trade['trade_id'])
                     self.trade_complete(t_id)
                     self.logger.info("New signal superceeds a pending trade. Trade " + t_id + " cancelled.")
 
                 except:
                     traceback.print_exc()
-                    print("orders:", type(self.broker.orders))
-                    print(json.dumps(self.broker.orders, indent=2))
+                    print("pending:", type(self.broker.pending))
+                    print(json.dumps(self.broker.pending, indent=2))
 
                     print("conflicted trade")
                     print(json.dumps(trade, indent=2))
@@ -792,11 +1164,14 @@ class Portfolio:
 
     def update_price(self, events, market_event):
         """
-        Check price and time updates against existing positions.
+        Update unrealised pnl of open positions with the newest close price
+        of their instrument. A market batch event updates all open positions
+        on its venue in one pass, using the newest close of each symbol.
 
         Args:
             events: event queue object.
-            event: new market event.
+            event: new market event, or market batch event holding all new
+                bars for a venue, check all symbols in one pass.
 
         Returns:
            None.
@@ -805,147 +1180,65 @@ class Portfolio:
             None.
         """
 
-        # TODO.
+        venue = market_event.get_exchange().get_name()
 
-    def update_trades_db(self, trade_id):
-        """
-        Update trade DB to reflect trade state of local portfolio
-        """
-
-    def save_new_trades_to_db(self):
-        """
-        Save trades in save-later queue to database.
-
-        Args:
-            None.
-        Returns:
-            None.
-        Raises:
-            pymongo.errors.DuplicateKeyError.
-        """
+        # Newest close for each symbol, later bars overwrite earlier ones.
+        if market_event.type == "MARKET_BATCH":
+            cols = market_event.get_columns()
+            order = cols['timestamp'].argsort(kind="mergesort")
+            closes = dict(zip(
+                cols['symbol'][order].tolist(),
+                cols['close'][order].tolist()))
 
-        count = 0
-        while True:
+        else:
+            bar = market_event.get_bar()
+            closes = {bar['symbol']: bar['close']}
 
-            try:
-                trade = self.trades_save_to_db.get(False)
+        for (t_venue, symbol), t_ids in self.trades_by_instrument.items():
+            close = closes.get(symbol)
 
-            except queue.Empty:
-                if count:
-                    self.logger.info(
-                        "Wrote " + str(count) + " new trades to database " +
-                        str(self.db_other.name) + ".")
-                break
+            # Skip other venues, symbols without bars, and null bars.
+            if t_venue != venue or close is None or close != close:
+                continue
 
-            else:
-                if trade is not None:
-                    count += 1
-                    # Store signal in relevant db collection.
-                    try:
-                        self.db_other['trades'].insert_one(trade)
-                    # Skip duplicates if they exist.
-                    except pymongo.errors.DuplicateKeyError:
-                        continue
+            for t_id in t_ids:
+                trade = self.pf['trades'][t_id]
+                position = trade['position']
 
-                self.trades_save_to_db.task_done()
+                if (position and position['status'] == "OPEN" and
+                        position['avg_entry_price']):
+                    trade['u_pnl'] = self.calculate_u_pnl(
+                        trade['direction'], position, close)
 
-    def generate_trade_setup_image(self, trade, op_data, within_risk_limits: bool, msg: str):
+    def calculate_u_pnl(self, direction, position, price):
         """
-        Create a snapshot image of trade setup and send to user.
+        Return unrealised pnl of the given position at the given price, in
+        the same terms as calculate_pnl_by_trade, before fees.
         """
 
-        self.logger.info("Creating signal snapshot image")
-
-        # Create image directory if it doesnt exist
-        if not os.path.exists("setup_images"):
-            os.mkdir("setup_images")
-
-        # Dump trade data to file for ease of testing next stage
-        # Remove from production
-        # op_data.to_csv('op_data.csv')
-        # with open('trade.json', 'w') as outfile:
-        #     json.dump(trade, outfile)
-
-        # Reformat dataframe for mplfinance compatibility
-        df = op_data.copy(deep=True)
-        df.rename(
-            {'open': 'Open', 'high': 'High', 'low': 'Low',
-             'close': 'Close', 'volume': 'Volume'}, axis=1,
-            inplace=True)
-        df = df.tail(self.SNAPSHOT_SIZE)
-
-        # Get markers for trades triggered by the current bar
-        entry_marker = [np.nan for i in range(self.SNAPSHOT_SIZE)]
-        entry_marker[-1] = trade['entry_price']
-        stop = None
-        stop_marker = [np.nan for i in range(self.SNAPSHOT_SIZE)]
-        for order in trade['orders'].values():
-            if order['order_type'] == "STOP":
-                stop = order['price']
-                stop_marker[-1] = stop
-
-        # TODO: Trades triggered by interaction with historic bars
-
-        # Create plot figures
-        adp, hlines = self.create_addplots(df, mpl, stop, entry_marker,
-                                           stop_marker)
-        mc = mpl.make_marketcolors(up='w', down='black', wick="w", edge='w')
-        style = mpl.make_mpf_style(gridstyle='', base_mpf_style='nightclouds',
-                                   marketcolors=mc)
-        filename = "setup_images/" + str(trade['trade_id']) + "_" + str(trade['signal_timestamp']) + '_' + trade['model'] + "_" + trade['timeframe']
-
-        try:
-            plot = mpl.plot(df, type='candle', addplot=adp, style=style, hlines=hlines,
-                            title="\n" + trade['model'] + " - " + trade['timeframe'],
-                            datetime_format='%d-%m %H:%M', figscale=1, savefig=filename,
-                            tight_layout=False)
-
-        except ValueError:
-            traceback.print_exc()
-            print(df)
-            print(df['Open'])
-            sys.exit(0)
-
-        message = "Trade " + str(trade['trade_id']) + " - " + trade['model'] + " " + trade['timeframe'] + "\n\nEntry: " + str(trade['entry_price']) + " \nStop: " + str(stop) + "\n"
-        options = [[str(trade['trade_id']) + " - Accept", str(trade['trade_id']) + " - Veto"]]
+        entry = position['avg_entry_price']
+        percent_change = abs((entry - price) / entry) * 100
+        pnl = (position['size'] / 100) * percent_change
 
-        try:
-            self.telegram.send_image(filename + ".png", message)
-            if within_risk_limits is True:
-                self.telegram.send_option_keyboard(options)
-            else:
-                self.telegram.send_message("Trade would exceed risk limits. " + msg)
-
-        except Exception as ex:
-            self.logger.info("Failed to send setup image via telegram.")
-            print(ex)
-            traceback.print_exc()
+        if direction == "LONG":
+            return pnl if price > entry else -pnl
+        elif direction == "SHORT":
+            return pnl if price < entry else -pnl
 
-    def create_addplots(self, df, mpl, stop, entry_marker, stop_marker):
+    def update_trades_db(self, trade_id):
         """
-        Helper method for generate_trade_setup_image.
-        Formats plot artifacts for mplfinance.
+        Update trade DB to reflect trade state of local portfolio
         """
 
-        adps, hlines = [], {'hlines': [], 'colors': [], 'linestyle': '--',
-                            'linewidths': 0.5}
+        self.store.stage_trade(self.pf['trades'][str(trade_id)])
 
-        # Add technical feature data (indicator values, etc).
-        for col in list(df):
-            if (
-                col != "Open" and col != "High" and col != "Low"
-                    and col != "Close" and col != "Volume"):
-                adps.append(mpl.make_addplot(df[col]))
-
-        # Add entry marker
-        adps.append(mpl.make_addplot(
-            entry_marker, type='scatter', markersize=500, marker="_",
-            color='limegreen'))
+    def generate_trade_setup_image(self, trade, op_data, within_risk_limits: bool, msg: str):
+        """
+        Queue a snapshot image of trade setup for rendering and sending to
+        user. Returns without waiting for the image.
+        """
 
-        # Add stop marker
-        if stop:
-            adps.append(mpl.make_addplot(
-                stop_marker, type='scatter', markersize=500, marker='_',
-                color='crimson'))
+        self.logger.info("Creating signal snapshot image")
 
-        return adps, hlines
+        self.renderer.submit(
+            trade, op_data, self.SNAPSHOT_SIZE, within_risk_limits, msg)
@@ -0,0 +1,384 @@
+"""
+trading-server is a multi-asset, multi-strategy, event-driven execution
+and backtesting platform (OEMS) for trading common markets.
+
+Copyright (C) 2020  Sam Breznikar <sam@sdbgroup.io>
+
+Licensed under GNU General Public License 3.0 or later.
+
+Some rights reserved. See LICENSE.md, AUTHORS.md.
+"""
+
+from pymongo import UpdateOne
+from threading import RLock
+import copy
+
+
+class PortfolioStore:
+    """
+    Persists portfolio state with targeted $set/$unset updates instead of
+    replacing the whole portfolio document.
+
+    Trades are stored as their own documents in the trades collection, tagged
+    with the owning portfolio ID, rather than embedded in the portfolio doc.
+    Only open trades are loaded and tracked. Completed trades are archived
+    and read from DB on demand.
+
+    Changes are found by comparing staged state against a copy of the last
+    staged state, field by field and trade by trade. Mapped fields like
+    balance_history grow without bound, so instead of being compared, keys
+    changed in them are marked with mark_changed(). Staged changes are
+    coalesced and written once per cycle by flush(), as one update to the
+    portfolio doc and one bulk write to the trades collection.
+    """
+
+    # Portfolio fields persisted key by key rather than as a single value.
+    MAPPED_FIELDS = ['balance_history']
+
+    # Matches trades not yet archived, including those saved before trades
+    # were marked complete.
+    OPEN_TRADES = {"complete": {"$in": [False, None]}}
+
+    def __init__(self, logger, db, portfolio_id=1):
+        self.logger = logger
+        self.db = db
+        self.portfolio_id = portfolio_id
+        self.lock = RLock()
+
+        # Copies of last staged state.
+        self.shadow = {}
+        self.trade_shadow = {}
+
+        # Changes not yet written to DB.
+        self.pending_set = {}
+        self.pending_unset = set()
+        self.pending_trades = {}
+
+        # Changed keys of mapped fields {field: {key}}, not yet staged.
+        self.changed_keys = {}
+
+    def read(self):
+        """
+        Return the stored portfolio with its open trades, or None if there is
+        no stored portfolio. Does not change tracked state.
+
+        Args:
+            None.
+
+        Returns:
+            portfolio: portfolio dict, or None.
+
+        Raises:
+            None.
+        """
+
+        portfolio = self.db['portfolio'].find_one(
+            {"id": self.portfolio_id}, {"_id": 0})
+
+        if not portfolio:
+            return None
+
+        # Trades embedded by older versions are used until migrated.
+        trades = portfolio.pop('trades', None) or {}
+
+        query = {"portfolio_id": self.portfolio_id}
+        query.update(self.OPEN_TRADES)
+
+        for trade in self.db['trades'].find(
+                query, {"_id": 0, "portfolio_id": 0}):
+            trades[str(trade['trade_id'])] = trade
+
+        portfolio['trades'] = trades
+
+        return portfolio
+
+    def read_trade(self, trade_id):
+        """
+        Return the stored trade matching trade_id, or None if not found.
+        """
+
+        return self.db['trades'].find_one(
+            {"trade_id": int(trade_id)}, {"_id": 0, "portfolio_id": 0})
+
+    def read_trades(self, trade_ids, fields=None):
+        """
+        Return stored trades matching the given trade IDs as a dict
+        {trade_id: trade}, optionally limited to the given fields.
+        """
+
+        if fields:
+            projection = {i: 1 for i in fields}
+            projection.update({"_id": 0, "trade_id": 1})
+        else:
+            projection = {"_id": 0, "portfolio_id": 0}
+
+        return {
+            str(t['trade_id']): t for t in self.db['trades'].find(
+                {"trade_id": {"$in": [int(i) for i in trade_ids]}},
+                projection)}
+
+    def load(self, default):
+        """
+        Return the stored portfolio, or default if none is stored, and track
+        changes to it from that point on.
+
+        Portfolios with embedded trades are migrated on the next flush.
+
+        Args:
+            default: portfolio dict to use if none is stored.
+
+        Returns:
+            portfolio: portfolio dict.
+
+        Raises:
+            None.
+        """
+
+        with self.lock:
+            portfolio = self.read()
+
+            self.shadow = {}
+            self.trade_shadow = {}
+            self.changed_keys = {}
+
+            if portfolio is None:
+                portfolio = default
+                for field in self.MAPPED_FIELDS:
+                    self.changed_keys[field] = set(portfolio.get(field, {}))
+
+            else:
+                embedded = self.db['portfolio'].find_one(
+                    {"id": self.portfolio_id, "trades": {"$exists": True}},
+                    {"_id": 1})
+
+                for field, value in portfolio.items():
+                    if field != 'trades' and field not in self.MAPPED_FIELDS:
+                        self.shadow[field] = copy.deepcopy(value)
+
+                if embedded:
+                    self.logger.info(
+                        "Migrating embedded portfolio trades to trades " +
+                        "collection.")
+                    self.pending_unset.add('trades')
+
+                else:
+                    self.trade_shadow = {
+                        t_id: copy.deepcopy(trade) for t_id, trade in
+                        portfolio['trades'].items()}
+
+            self.stage(portfolio)
+
+        return portfolio
+
+    def stage(self, portfolio):
+        """
+        Record changes made to portfolio since it was last staged.
+
+        Args:
+            portfolio: portfolio dict.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        with self.lock:
+            for field, value in portfolio.items():
+                if field == 'trades':
+                    continue
+
+                elif field in self.MAPPED_FIELDS:
+                    self.stage_mapped_field(field, value)
+
+                elif field not in self.shadow or self.shadow[field] != value:
+                    self.set_field(field, copy.deepcopy(value))
+                    self.shadow[field] = copy.deepcopy(value)
+
+            for field in [
+                    i for i in self.shadow if i not in portfolio and
+                    i not in self.MAPPED_FIELDS]:
+                self.unset_field(field)
+                del self.shadow[field]
+
+            for trade in portfolio.get('trades', {}).values():
+                self.stage_trade(trade)
+
+    def stage_mapped_field(self, field, value):
+        """
+        Record keys of a mapped field marked as changed since it was last
+        staged as individual field paths. Keys no longer present are unset.
+        """
+
+        for key in self.changed_keys.pop(field, ()):
+            if key in value:
+                self.set_field(field + "." + key, copy.deepcopy(value[key]))
+            else:
+                self.unset_field(field + "." + key)
+
+    def mark_changed(self, field, key):
+        """
+        Mark a key of a mapped field as added, changed or removed, to be
+        written on the next stage and flush.
+
+        Args:
+            field: mapped field name, see MAPPED_FIELDS.
+            key: changed key (string).
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        with self.lock:
+            self.changed_keys.setdefault(field, set()).add(key)
+
+    def stage_trade(self, trade):
+        """
+        Record changes to a single trade since it was last staged.
+
+        Args:
+            trade: trade dict.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        with self.lock:
+            t_id = str(trade['trade_id'])
+            shadow = self.trade_shadow.setdefault(t_id, {})
+
+            changed = [
+                i for i in trade if i not in shadow or shadow[i] != trade[i]]
+            removed = [i for i in shadow if i not in trade]
+
+            if not changed and not removed:
+                return
+
+            to_set, to_unset = self.pending_trades.setdefault(
+                t_id, (
+                    {'trade_id': trade['trade_id'],
+                     'portfolio_id': self.portfolio_id}, set()))
+
+            for field in changed:
+                to_set[field] = copy.deepcopy(trade[field])
+                to_unset.discard(field)
+                shadow[field] = copy.deepcopy(trade[field])
+
+            for field in removed:
+                to_unset.add(field)
+                to_set.pop(field, None)
+                del shadow[field]
+
+    def archive_trade(self, trade):
+        """
+        Stage the final state of a completed trade and stop tracking it.
+
+        Args:
+            trade: trade dict.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        with self.lock:
+            self.stage_trade(trade)
+            self.trade_shadow.pop(str(trade['trade_id']), None)
+
+    def set_field(self, path, value):
+        self.pending_set[path] = value
+        self.pending_unset.discard(path)
+
+    def unset_field(self, path):
+        self.pending_unset.add(path)
+        self.pending_set.pop(path, None)
+
+    def pending(self):
+        """
+        Return True if there are staged changes not yet written.
+        """
+
+        return bool(
+            self.pending_set or self.pending_unset or self.pending_trades)
+
+    def flush(self):
+        """
+        Write all staged changes to DB.
+
+        Args:
+            None.
+
+        Returns:
+            True if changes were written, False if there was nothing to write.
+
+        Raises:
+            pymongo errors if the write fails. Unwritten changes are kept.
+        """
+
+        with self.lock:
+            to_set, self.pending_set = self.pending_set, {}
+            to_unset, self.pending_unset = self.pending_unset, set()
+            trades, self.pending_trades = self.pending_trades, {}
+
+        if not (to_set or to_unset or trades):
+            return False
+
+        try:
+            if to_set or to_unset:
+                update = {}
+                if to_set:
+                    update['$set'] = to_set
+                if to_unset:
+                    update['$unset'] = {i: "" for i in to_unset}
+
+                self.db['portfolio'].update_one(
+                    {"id": self.portfolio_id}, update, upsert=True)
+
+            if trades:
+                operations = []
+                for t_set, t_unset in trades.values():
+                    update = {'$set': t_set}
+                    if t_unset:
+                        update['$unset'] = {i: "" for i in t_unset}
+                    operations.append(UpdateOne(
+                        {"trade_id": t_set['trade_id']}, update, upsert=True))
+
+                self.db['trades'].bulk_write(operations, ordered=False)
+
+        # Keep unwritten changes for the next flush, newer changes first.
+        except Exception:
+            with self.lock:
+                for path, value in to_set.items():
+                    if path not in self.pending_unset:
+                        self.pending_set.setdefault(path, value)
+                for path in to_unset:
+                    if path not in self.pending_set:
+                        self.pending_unset.add(path)
+                for t_id, (t_set, t_unset) in trades.items():
+                    new_set, new_unset = self.pending_trades.setdefault(
+                        t_id, (t_set, t_unset))
+                    if new_set is not t_set:
+                        for field, value in t_set.items():
+                            if field not in new_unset:
+                                new_set.setdefault(field, value)
+                        for field in t_unset:
+                            if field not in new_set:
+                                new_unset.add(field)
+
+            self.logger.info("Portfolio save unsuccessful.")
+            raise
+
+        self.logger.info(
+            "Portfolio save successful. " + str(len(to_set) + len(to_unset)) +
+            " portfolio fields and " + str(len(trades)) + " trades updated.")
+
+        return True
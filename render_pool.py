@@ -0,0 +1,273 @@
+"""
+trading-server is a multi-asset, multi-strategy, event-driven execution
+and backtesting platform (OEMS) for trading common markets.
+
+Copyright (C) 2020  Sam Breznikar <sam@sdbgroup.io>
+
+Licensed under GNU General Public License 3.0 or later.
+
+Some rights reserved. See LICENSE.md, AUTHORS.md.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from threading import BoundedSemaphore
+from analytics import RunningStats
+import numpy as np
+import traceback
+import time
+import os
+
+# Render headless, no display needed in worker processes.
+import matplotlib
+matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt
+import mplfinance as mpl
+
+
+class RenderPool:
+    """
+    Renders trade setup images in a pool of worker processes, off the event
+    loop. Finished images are queued for sending via telegram.
+
+    At most MAX_PENDING jobs are queued or rendering at once. Trades
+    submitted while the pool is full are delivered as text only.
+    """
+
+    WORKERS = 2
+    MAX_PENDING = 16
+    IMAGE_DIR = "setup_images"
+
+    def __init__(self, logger, telegram, workers=WORKERS,
+                 max_pending=MAX_PENDING):
+        self.logger = logger
+        self.telegram = telegram
+        self.workers = workers
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.slots = BoundedSemaphore(max_pending)
+
+        # Render latency in seconds, from submission and in worker.
+        self.latency = RunningStats()
+        self.render_time = RunningStats()
+
+        if not os.path.exists(self.IMAGE_DIR):
+            os.mkdir(self.IMAGE_DIR)
+
+    def submit(self, trade, op_data, snapshot_size, within_risk_limits: bool,
+               msg: str):
+        """
+        Queue a trade setup image for rendering and delivery.
+
+        Args:
+            trade: trade dict.
+            op_data: DatasetSnapshot of bars and features used by the signal.
+            snapshot_size: number of bars to plot.
+            within_risk_limits: True if trade was accepted by risk checks.
+            msg: risk check message.
+
+        Returns:
+            True if the job was queued, False if the pool was full.
+
+        Raises:
+            None.
+        """
+
+        job = self.create_job(trade, op_data, snapshot_size)
+        job['within_risk_limits'] = within_risk_limits
+        job['msg'] = msg
+        job['submitted'] = time.time()
+
+        if not self.slots.acquire(blocking=False):
+            self.logger.info(
+                "Render queue full, sending trade " + str(trade['trade_id']) +
+                " setup without image.")
+            job['filename'] = None
+            self.deliver(job)
+            return False
+
+        # Pool is broken if a worker died, send text only and replace it.
+        try:
+            future = self.pool.submit(
+                render_trade_setup, job['df'], job['stop'],
+                job['entry_marker'], job['stop_marker'], job['title'],
+                job['filename'])
+
+        except Exception:
+            self.slots.release()
+            self.logger.info(
+                "Render pool failed, sending trade " + str(trade['trade_id']) +
+                " setup without image and restarting pool.")
+            traceback.print_exc()
+            self.restart()
+            job['filename'] = None
+            self.deliver(job)
+            return False
+
+        future.add_done_callback(lambda f: self.finished(f, job))
+
+        return True
+
+    def restart(self):
+        """
+        Replace the worker pool, e.g after a worker process died. Jobs left
+        in the old pool fail and are delivered as text only.
+        """
+
+        try:
+            self.pool.shutdown(wait=False)
+        except Exception:
+            traceback.print_exc()
+
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    def create_job(self, trade, op_data, snapshot_size):
+        """
+        Return a dict containing everything needed to render and deliver the
+        given trades setup image.
+        """
+
+        # Reformat dataframe for mplfinance compatibility
+        df = op_data.tail(snapshot_size).to_frame().rename(
+            {'open': 'Open', 'high': 'High', 'low': 'Low',
+             'close': 'Close', 'volume': 'Volume'}, axis=1)
+
+        # Get markers for trades triggered by the current bar
+        entry_marker = [np.nan for i in range(len(df))]
+        entry_marker[-1] = trade['entry_price']
+        stop = None
+        stop_marker = [np.nan for i in range(len(df))]
+        for order in trade['orders'].values():
+            if order['order_type'] == "STOP":
+                stop = order['price']
+                stop_marker[-1] = stop
+
+        # TODO: Trades triggered by interaction with historic bars
+
+        filename = self.IMAGE_DIR + "/" + str(trade['trade_id']) + "_" + str(trade['signal_timestamp']) + '_' + trade['model'] + "_" + trade['timeframe']
+
+        return {
+            'trade_id': trade['trade_id'],
+            'message': "Trade " + str(trade['trade_id']) + " - " + trade['model'] + " " + trade['timeframe'] + "\n\nEntry: " + str(trade['entry_price']) + " \nStop: " + str(stop) + "\n",
+            'options': [[str(trade['trade_id']) + " - Accept", str(trade['trade_id']) + " - Veto"]],
+            'title': "\n" + trade['model'] + " - " + trade['timeframe'],
+            'filename': filename,
+            'df': df,
+            'stop': stop,
+            'entry_marker': entry_marker,
+            'stop_marker': stop_marker}
+
+    def finished(self, future, job):
+        """
+        Record render outcome and latency, then deliver job.
+        Called from the pool's result thread.
+        """
+
+        self.slots.release()
+
+        try:
+            job['render_time'] = future.result()
+            latency = time.time() - job['submitted']
+            self.latency.update(latency)
+            self.render_time.update(job['render_time'])
+            self.logger.info(
+                "Rendered trade " + str(job['trade_id']) + " setup image in " +
+                str(round(job['render_time'], 3)) + "s (" +
+                str(round(latency, 3)) + "s since signal).")
+
+        except Exception:
+            self.logger.info(
+                "Failed to render trade " + str(job['trade_id']) +
+                " setup image.")
+            traceback.print_exc()
+            job['filename'] = None
+
+        self.deliver(job)
+
+    def deliver(self, job):
+        """
+        Queue finished trade setup for sending to the user.
+        """
+
+        if job['filename']:
+            self.telegram.send_image(job['filename'] + ".png", job['message'])
+        else:
+            self.telegram.send_message(job['message'])
+
+        if job['within_risk_limits'] is True:
+            self.telegram.send_option_keyboard(job['options'])
+        else:
+            self.telegram.send_message(
+                "Trade would exceed risk limits. " + job['msg'])
+
+    def stats(self):
+        """
+        Return render latency statistics as a dict.
+        """
+
+        return {
+            'renders': self.render_time.count,
+            'avg_render_time': self.render_time.mean,
+            'avg_latency': self.latency.mean,
+            'latency_std': self.latency.std()}
+
+    def close(self):
+        """
+        Wait for queued renders to finish and stop worker processes.
+        """
+
+        self.pool.shutdown(wait=True)
+
+
+def render_trade_setup(df, stop, entry_marker, stop_marker, title, filename):
+    """
+    Render a trade setup image to filename.png. Runs in a worker process.
+
+    Returns:
+        Render duration in seconds (float).
+    """
+
+    start = time.time()
+
+    # Create plot figures
+    adp, hlines = create_addplots(df, stop, entry_marker, stop_marker)
+    mc = mpl.make_marketcolors(up='w', down='black', wick="w", edge='w')
+    style = mpl.make_mpf_style(gridstyle='', base_mpf_style='nightclouds',
+                               marketcolors=mc)
+
+    mpl.plot(df, type='candle', addplot=adp, style=style, hlines=hlines,
+             title=title, datetime_format='%d-%m %H:%M', figscale=1,
+             savefig=filename, tight_layout=False)
+
+    # Release figures, workers are long lived.
+    plt.close('all')
+
+    return time.time() - start
+
+
+def create_addplots(df, stop, entry_marker, stop_marker):
+    """
+    Helper for render_trade_setup. Formats plot artifacts for mplfinance.
+    """
+
+    adps, hlines = [], {'hlines': [], 'colors': [], 'linestyle': '--',
+                        'linewidths': 0.5}
+
+    # Add technical feature data (indicator values, etc).
+    for col in list(df):
+        if (
+            col != "Open" and col != "High" and col != "Low"
+                and col != "Close" and col != "Volume"):
+            adps.append(mpl.make_addplot(df[col]))
+
+    # Add entry marker
+    adps.append(mpl.make_addplot(
+        entry_marker, type='scatter', markersize=500, marker="_",
+        color='limegreen'))
+
+    # Add stop marker
+    if stop:
+        adps.append(mpl.make_addplot(
+            stop_marker, type='scatter', markersize=500, marker='_',
+            color='crimson'))
+
+    return adps, hlines
@@ -14,16 +14,23 @@ from threading import Thread
 from time import sleep
 import subprocess
 import datetime
+import json
 
 import logging
 import time
 import queue
 
 from messaging_clients import Telegram
+from db_indexes import IndexManager
+from event_types import MarketEvent
+from tick_archive import TickArchive
+from bar_builder import BarBuilder
+from bar_cache import BarCache
 from portfolio import Portfolio
 from strategy import Strategy
 from data import Datahandler
 from broker import Broker
+from simulated_exchange import SimulatedExchange
 from bitmex import Bitmex
 
 
@@ -52,11 +59,19 @@ class Server:
     DB_TIMEOUT_MS = 10
 
     VENUES = ["Binance", "BitMEX"]
-    DB_OTHER_COLLS = ['trades', 'portfolio', 'signals']
 
     # Mins between recurring data diagnostics.
     DIAG_DELAY = 45
 
+    # Trade ID's reserved per counter update when backtesting.
+    BACKTEST_ID_BLOCK = 1000
+
+    # Set False to skip archiving raw ticks locally when live.
+    ARCHIVE_TICKS = True
+
+    # Max seconds between time bar flushes while waiting for bar events.
+    BAR_FLUSH_INTERVAL = 1
+
     def __init__(self):
 
         # Set False for forward testing.
@@ -73,29 +88,53 @@ class Server:
         self.db_other = self.db_client[self.DB_OTHER]
         self.check_db_status(self.VENUES)
 
+        # Local append-only store of raw ticks from venue websockets.
+        self.tick_archive = TickArchive(self.logger) if (
+            self.live_trading and self.ARCHIVE_TICKS) else None
+
         self.exchanges = self.exchange_wrappers(self.logger, self.VENUES)
         self.telegram = Telegram(self.logger)
 
         # Main event queue.
         self.events = queue.Queue(0)
 
+        # Local columnar copy of stored bars for fast reads.
+        self.bar_cache = BarCache(self.logger)
+
         # Producer/consumer worker classes.
         self.data = Datahandler(self.exchanges, self.logger, self.db_prices,
-                                self.db_client)
+                                self.db_client, self.bar_cache)
 
         self.strategy = Strategy(self.exchanges, self.logger, self.db_prices,
-                                 self.db_other, self.db_client)
+                                 self.db_other, self.db_client,
+                                 self.bar_cache)
 
         self.portfolio = Portfolio(self.exchanges, self.logger, self.db_other,
                                    self.db_client, self.strategy.models,
                                    self.telegram)
 
+        # Backtests create trades fast, avoid a DB round trip per trade ID.
+        if not self.live_trading:
+            self.portfolio.id_gen.block_size = self.BACKTEST_ID_BLOCK
+
         self.broker = Broker(self.exchanges, self.logger, self.portfolio,
                              self.db_other, self.db_client, self.live_trading,
-                             self.telegram)
+                             self.telegram, self.events)
 
         self.portfolio.broker = self.broker
 
+        # Aggregate live trades into bar types subscribed to by models.
+        self.bar_events = queue.Queue(0)
+        self.bar_builders = []
+        bar_types = self.strategy.get_bar_types()
+        if self.live_trading and bar_types:
+            for exc in self.exchanges:
+                builder = BarBuilder(
+                    self.logger, exc, bar_types, self.bar_events)
+                exc.register_trade_callback(builder.add_ticks)
+                self.bar_builders.append(builder)
+            self.logger.info("Building bar types " + str(bar_types) + ".")
+
         # Start flask api in separate process
         # p = subprocess.Popen(["python", "api.py"])
         # self.logger.info("Started flask API.")
@@ -133,10 +172,14 @@ class Server:
                 if self.cycle_count >= 1 and self.data.ready:
                     self.start_processing = time.time()
 
-                    # Fetch and queue events for processing.
-                    self.events = self.broker.check_fills(self.events)
+                    # Fetch and queue events for processing. Fill events
+                    # are queued by the broker as venues report them.
                     self.events = self.data.update_market_data(self.events)
-                    self.clear_event_queue()
+
+                    # Hold broker lock so consent decisions received
+                    # mid-cycle are actioned after the cycle completes.
+                    with self.broker.lock:
+                        self.clear_event_queue()
 
                     # Run diagnostics at 3 and 7 mins to be sure missed
                     # bars are rectified before ongoing system operation.
@@ -153,14 +196,71 @@ class Server:
                     #     thread.daemon = True
                     #     thread.start()
 
-                # Sleep til the next minute begins.
-                sleep(self.seconds_til_next_minute())
+                # Process bar type events til the next minute begins.
+                self.process_bar_events(self.seconds_til_next_minute())
                 self.cycle_count += 1
 
             # Update data w/o delay when backtesting, no diagnostics.
             elif not self.live_trading:
+                self.start_processing = time.time()
                 self.events = self.data.update_market_data(self.events)
                 self.clear_event_queue()
+                self.cycle_count += 1
+
+                # Stop once all locally cached bars have been replayed.
+                if self.data.replay_complete:
+                    self.logger.info("Stored data replay complete.")
+                    self.portfolio.flush_portfolio()
+                    self.logger.info(
+                        "Backtest performance: " + json.dumps(
+                            self.portfolio.performance().summary()))
+                    break
+
+    def process_bar_events(self, duration):
+        """
+        Process alternative bar type market events as bars complete, until
+        duration seconds have elapsed. Sleeps if no bar types are in use.
+
+        Args:
+            duration: seconds to process for.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        if not self.bar_builders:
+            sleep(duration)
+            return
+
+        end = time.time() + duration
+        while True:
+            remaining = end - time.time()
+            if remaining <= 0:
+                break
+
+            # Close time bars in quiet markets.
+            for builder in self.bar_builders:
+                builder.flush()
+
+            try:
+                event = self.bar_events.get(
+                    timeout=min(remaining, self.BAR_FLUSH_INTERVAL))
+            except queue.Empty:
+                continue
+
+            self.start_processing = time.time()
+            self.events.put(event)
+            while True:
+                try:
+                    self.events.put(self.bar_events.get(False))
+                except queue.Empty:
+                    break
+
+            with self.broker.lock:
+                self.clear_event_queue()
 
     def clear_event_queue(self):
         """
@@ -191,8 +291,8 @@ class Server:
                 self.data.save_new_bars_to_db()
                 self.strategy.trim_datasets()
                 self.strategy.save_new_signals_to_db()
-                # self.portfolio.save_new_trades_to_db()
                 self.broker.check_consent(self.events)
+                self.portfolio.flush_portfolio()
 
                 break
 
@@ -201,11 +301,33 @@ class Server:
                     count += 1
 
                     # Signal Event generation.
-                    if event.type == "MARKET":
+                    if event.type == "MARKET" and (
+                            event.get_bar_type() != MarketEvent.MINUTE):
+                        self.strategy.new_bar(self.events, event)
+
+                    elif event.type == "MARKET":
+
+                        # Fill simulated orders before new signals are made.
+                        if not self.live_trading:
+                            event.get_exchange().new_bar(event.get_bar())
+
                         self.strategy.new_data(
                             self.events, event, self.cycle_count)
                         self.portfolio.update_price(self.events, event)
 
+                    # Batched new bars, all symbols for one venue.
+                    elif event.type == "MARKET_BATCH":
+
+                        # Fill simulated orders before new signals are made.
+                        if not self.live_trading:
+                            exchange = event.get_exchange()
+                            for bar in event.get_bars():
+                                exchange.new_bar(bar)
+
+                        self.strategy.new_batch(
+                            self.events, event, self.cycle_count)
+                        self.portfolio.update_price(self.events, event)
+
                     # Order Event generation.
                     elif event.type == "SIGNAL":
                         self.logger.info("Processing signal event.")
@@ -265,7 +387,11 @@ class Server:
 
         # TODO: load exchange wrappers from 'op_venues' list param
 
-        venues = [Bitmex(logger)]
+        # Backtests execute against a simulated venue, no network needed.
+        if self.live_trading:
+            venues = [Bitmex(logger, tick_archive=self.tick_archive)]
+        else:
+            venues = [SimulatedExchange(logger)]
         self.logger.info("Initialised exchange connectors.")
 
         return venues
@@ -307,30 +433,11 @@ class Server:
             self.db_client.server_info()
             self.logger.info("Connected to DB client at " + self.DB_URL + ".")
 
-            price_colls = self.db_prices.list_collection_names()
-            other_colls = self.db_other.list_collection_names()
-
-            # Check price DB collections and indexing
-            for venue_name in op_venues:
-                if venue_name not in price_colls:
-
-                    self.logger.info("Creating indexing for " + venue_name +
-                                      " in " + self.DB_PRICES + ".")
-
-                    self.db_prices[venue_name].create_index(
-                        [('timestamp', 1), ('symbol', 1)],
-                        name='timestamp_1_symbol_1',
-                        **{'unique': True, 'background': False})
-
-            # Check other DB collections and indexing
-            for coll_name in self.DB_OTHER_COLLS:
-                if coll_name not in other_colls:
-
-                    self.logger.info("Creating indexing for " + coll_name +
-                                      " in " + self.DB_OTHER + ".")
-
-                    # No indexing required for other DB categories (yet)
-                    # Add here if required later
+            # Create or migrate indexing, check hot queries use it.
+            self.indexes = IndexManager(
+                self.logger, self.db_prices, self.db_other, op_venues)
+            self.indexes.ensure_indexes()
+            self.indexes.verify()
 
         except errors.ServerSelectionTimeoutError as e:
             self.logger.info("Failed to connect to " + self.DB_PRICES +
@@ -343,23 +450,4 @@ class Server:
 
         """
 
-        indices = []
-        for venue_name in self.VENUES:
-            for name, index_info in self.db_prices[venue_name].index_information().items():
-                keys = index_info['key']
-                del(index_info['ns'])
-                del(index_info['v'])
-                del(index_info['key'])
-                indices.append({'db': self.DB_PRICES, 'collection': venue_name,
-                                'keys': keys, 'info': index_info})
-
-        for coll_name in self.DB_OTHER_COLLS:
-            for name, index_info in self.db_prices[coll_name].index_information().items():
-                keys = index_info['key']
-                del(index_info['ns'])
-                del(index_info['v'])
-                del(index_info['key'])
-                indices.append({'db': self.DB_OTHER, 'collection': coll_name,
-                                'keys': keys, 'info': index_info})
-
-        return indices
+        return self.indexes.index_report()
@@ -0,0 +1,514 @@
+"""
+trading-server is a multi-asset, multi-strategy, event-driven execution
+and backtesting platform (OEMS) for trading common markets.
+
+Copyright (C) 2020  Sam Breznikar <sam@sdbgroup.io>
+
+Licensed under GNU General Public License 3.0 or later.
+
+Some rights reserved. See LICENSE.md, AUTHORS.md.
+"""
+
+from bisect import bisect_left, bisect_right
+from collections import deque
+from exchange import Exchange
+
+
+class SimulatedExchange(Exchange):
+    """
+    Paper trading venue for backtests. Orders are held in a local order book
+    and filled against the replayed bar stream, no network or disk I/O.
+
+    Fill model, per bar, for orders placed at least LATENCY seconds before
+    the bar opened:
+        MARKET:     filled at bar open, plus slippage.
+        LIMIT:      filled at limit price when touched, maker fee. If already
+                    marketable at bar open, filled at open, taker fee.
+        STOP:       triggered when touched, filled at the worse of stop price
+                    and bar open, plus slippage, taker fee.
+        STOP_LIMIT: triggered as STOP, filled at limit price, maker fee.
+
+    Slippage is a fraction of fill price, always against the order. Orders
+    fill in full. Reduce-only orders are capped to the open position size
+    and cancelled if there is no position to reduce.
+
+    Fills and cancellations are reported to the registered fill callback,
+    executions to the registered execution callback, both synchronously.
+
+    Execution fees use the same units as Bitmex.format_execution, so
+    backtest and live pnl are comparable. Contracts are inverse, so the
+    venue commission (execComm) is size / price * fee rate in satoshis, and
+    total_fee is that commission divided by fill price.
+    """
+
+    MAX_BARS_PER_REQUEST = 750
+
+    # Default fill model.
+    SLIPPAGE = 0.0005
+    MAKER_FEE = -0.00025
+    TAKER_FEE = 0.00075
+    LATENCY = 0
+
+    # Recent bars kept per symbol for get_recent_bars/get_bars_in_period.
+    MAX_HISTORY = 10000
+
+    # Bar timestamps mark bar close, see Exchange.build_OHLCV.
+    BAR_LENGTH = 60
+
+    # Satoshis per XBT, unit of venue commissions.
+    SATOSHIS = 10 ** 8
+
+    def __init__(self, logger, name="BitMEX", symbols=["XBTUSD"],
+                 symbol_min_increment={'XBTUSD': 0.5}, currency="USD",
+                 slippage=SLIPPAGE, maker_fee=MAKER_FEE, taker_fee=TAKER_FEE,
+                 latency=LATENCY):
+        super().__init__()
+        self.logger = logger
+        self.name = name
+        self.symbols = list(symbols)
+        self.symbol_min_increment = dict(symbol_min_increment)
+        self.currency = currency
+
+        self.slippage = slippage
+        self.maker_fee = maker_fee
+        self.taker_fee = taker_fee
+        self.latency = latency
+
+        self.fill_callback = None
+        self.execution_callback = None
+        self.trade_callback = None
+
+        # Simulated clock, timestamp of the most recent bar.
+        self.now = None
+
+        # Last traded price per symbol.
+        self.last_price = {i: None for i in self.symbols}
+
+        # All orders {venue_id: order}, open orders {symbol: {venue_id: order}}.
+        self.orders = {}
+        self.open_orders = {i: {} for i in self.symbols}
+        self.venue_id_count = 0
+
+        # Executions per symbol, in time order ([timestamps], [executions]).
+        self.executions = {i: ([], []) for i in self.symbols}
+        self.exec_count = 0
+
+        # Signed position size and average entry price per symbol.
+        self.positions = {
+            i: {'size': 0, 'avg_entry_price': None, 'opening_timestamp': None,
+                'opening_size': 0} for i in self.symbols}
+
+        self.history = {i: deque(maxlen=self.MAX_HISTORY) for i in self.symbols}
+        self.origin_tss = {i: None for i in self.symbols}
+
+        # Not used, no live data feed.
+        self.bars = {}
+        self.ticks = {}
+
+        self.logger.info(
+            "Initialised simulated " + self.name + " venue (slippage " +
+            str(self.slippage) + ", maker fee " + str(self.maker_fee) +
+            ", taker fee " + str(self.taker_fee) + ", latency " +
+            str(self.latency) + "s).")
+
+    def new_bar(self, bar):
+        """
+        Advance the simulated clock and fill open orders against the given
+        bar. Call with each replayed bar, before the bar is used to generate
+        new signals.
+
+        Args:
+            bar: 1 min OHLCV bar dict.
+
+        Returns:
+            Number of orders filled or cancelled (int).
+
+        Raises:
+            None.
+        """
+
+        symbol = bar['symbol']
+        self.now = bar['timestamp']
+
+        if bar['open'] is None:
+            return 0
+
+        if self.origin_tss[symbol] is None:
+            self.origin_tss[symbol] = bar['timestamp']
+        self.history[symbol].append(bar)
+
+        count = 0
+        book = self.open_orders[symbol]
+        if book:
+            bar_open_ts = bar['timestamp'] - self.BAR_LENGTH
+            for order in list(book.values()):
+                if order['timestamp'] + self.latency <= bar_open_ts:
+                    if self.match_order(order, bar):
+                        count += 1
+
+        self.last_price[symbol] = bar['close']
+
+        return count
+
+    def match_order(self, order, bar):
+        """
+        Fill the given order if the bar trades through its price.
+
+        Returns:
+            True if the order was filled or cancelled, otherwise False.
+        """
+
+        long = order['direction'] == "LONG"
+        order_type = order['order_type']
+        price = order['price']
+
+        if order_type == "MARKET":
+            fill_price = self.slip(bar['open'], long)
+            taker = True
+
+        elif order_type == "LIMIT":
+            if (bar['open'] <= price) if long else (bar['open'] >= price):
+                fill_price, taker = bar['open'], True
+            elif (bar['low'] <= price) if long else (bar['high'] >= price):
+                fill_price, taker = price, False
+            else:
+                return False
+
+        elif order_type == "STOP":
+            if long and bar['high'] >= price:
+                fill_price = self.slip(max(price, bar['open']), long)
+            elif not long and bar['low'] <= price:
+                fill_price = self.slip(min(price, bar['open']), long)
+            else:
+                return False
+            taker = True
+
+        elif order_type == "STOP_LIMIT":
+            if (bar['high'] >= price) if long else (bar['low'] <= price):
+                fill_price, taker = price, False
+            else:
+                return False
+
+        else:
+            raise Exception("Unknown order type:", order_type)
+
+        self.fill(order, fill_price, taker, bar['timestamp'])
+
+        return True
+
+    def slip(self, price, long):
+        """
+        Return price adjusted for slippage against the given side.
+        """
+
+        return price * (1 + self.slippage) if long else price * (1 - self.slippage)
+
+    def fill(self, order, price, taker, timestamp):
+        """
+        Fill the given order, update the position, record the execution and
+        notify callbacks.
+        """
+
+        symbol = order['symbol']
+        position = self.positions[symbol]
+        size = order['size']
+
+        # Reduce-only orders can't open or flip a position.
+        if order['reduce_only']:
+            sign = 1 if order['direction'] == "LONG" else -1
+            if position['size'] * sign >= 0:
+                self.cancel(order)
+                return
+            size = min(size, abs(position['size']))
+
+        fee_rate = self.taker_fee if taker else self.maker_fee
+        commission = size / price * fee_rate * self.SATOSHIS
+        self.update_position(symbol, order['direction'], size, price, timestamp)
+
+        order['status'] = "FILLED"
+        order['avg_fill_price'] = price
+        order['size'] = size
+        del self.open_orders[symbol][order['venue_id']]
+
+        self.exec_count += 1
+        execution = {
+            'exec_id': str(self.exec_count),
+            'order_id': order['order_id'],
+            'venue_id': order['venue_id'],
+            'venue': self.name,
+            'timestamp': timestamp,
+            'avg_exc_price': price,
+            'currency': self.currency,
+            'symbol': symbol,
+            'direction': order['direction'],
+            'size': size,
+            'order_type': order['order_type'],
+            'fee_type': "TAKER" if taker else "MAKER",
+            'fee_amt': fee_rate,
+            'total_fee': commission / price,
+            'status': "FILLED"}
+
+        timestamps, executions = self.executions[symbol]
+        timestamps.append(timestamp)
+        executions.append(execution)
+
+        if self.execution_callback:
+            self.execution_callback([execution])
+        if self.fill_callback:
+            self.fill_callback(self.format_order_conf(order))
+
+    def cancel(self, order):
+        """
+        Cancel the given open order and notify the fill callback.
+        """
+
+        order['status'] = "CANCELLED"
+        self.open_orders[order['symbol']].pop(order['venue_id'], None)
+
+        if self.fill_callback:
+            self.fill_callback(self.format_order_conf(order))
+
+    def update_position(self, symbol, direction, size, price, timestamp):
+        """
+        Apply a fill of size units at price to the symbols position.
+        """
+
+        position = self.positions[symbol]
+        signed = size if direction == "LONG" else -size
+        current = position['size']
+        new = current + signed
+
+        # Opening or adding to a position.
+        if current == 0 or (current > 0) == (signed > 0):
+            if current == 0:
+                position['opening_timestamp'] = timestamp
+                position['opening_size'] = signed
+                position['avg_entry_price'] = price
+            else:
+                position['avg_entry_price'] = (
+                    position['avg_entry_price'] * abs(current) +
+                    price * size) / abs(new)
+
+        # Position flipped, remainder opens at fill price.
+        elif new != 0 and (new > 0) != (current > 0):
+            position['opening_timestamp'] = timestamp
+            position['opening_size'] = new
+            position['avg_entry_price'] = price
+
+        elif new == 0:
+            position['avg_entry_price'] = None
+
+        position['size'] = new
+
+    async def run_async(self, method, *args, **kwargs):
+
+        # No I/O to overlap, run inline so backtests stay deterministic.
+        return method(*args, **kwargs)
+
+    def place_bulk_orders(self, orders):
+
+        return [self.place_single_order(order) for order in orders]
+
+    def place_single_order(self, order):
+
+        formatted = self.format_orders([order])[0]
+
+        self.venue_id_count += 1
+        venue_id = "SIM-" + str(self.venue_id_count)
+
+        new = {
+            'trade_id': order['trade_id'],
+            'order_id': order['order_id'],
+            'venue': self.name,
+            'symbol': order['symbol'],
+            'order_type': order['order_type'],
+            'metatype': order['metatype'],
+            'void_price': order['void_price'],
+            'direction': order['direction'],
+            'reduce_only': order['reduce_only'],
+            'post_only': order['post_only'],
+            'batch_size': order['batch_size'],
+            'size': formatted['size'],
+            'trail': order['trail'],
+            'timestamp': self.now,
+            'avg_fill_price': None,
+            'currency': self.currency,
+            'venue_id': venue_id,
+            'price': formatted['price'],
+            'status': "NEW"}
+
+        self.orders[venue_id] = new
+        self.open_orders[new['symbol']][venue_id] = new
+
+        return dict(new)
+
+    def cancel_orders(self, order_ids: list):
+
+        cancel_confs = {}
+        for venue_id in order_ids:
+            order = self.orders.get(venue_id)
+            if order is None:
+                continue
+
+            if order['status'] == "NEW":
+                self.cancel(order)
+
+            cancel_confs[venue_id] = {
+                'venue_id': venue_id,
+                'order_id': order['order_id'],
+                'status': order['status'],
+                'order_type': order['order_type'],
+                'price': order['price']}
+
+        return cancel_confs if cancel_confs else None
+
+    def close_position(self, symbol, qty=None, direction=None):
+
+        position = self.positions[symbol]
+        price = self.last_price[symbol]
+
+        if position['size'] == 0 or price is None:
+            return False
+
+        # Close qty units of a position in direction, or all units.
+        if qty and direction:
+            if direction not in ["LONG", "SHORT"]:
+                raise Exception(direction)
+            size = min(qty, abs(position['size']))
+            side = "SHORT" if direction == "LONG" else "LONG"
+        else:
+            size = abs(position['size'])
+            side = "SHORT" if position['size'] > 0 else "LONG"
+
+        self.venue_id_count += 1
+        order = {
+            'trade_id': None,
+            'order_id': None,
+            'venue': self.name,
+            'symbol': symbol,
+            'order_type': "MARKET",
+            'metatype': None,
+            'void_price': None,
+            'direction': side,
+            'reduce_only': True,
+            'post_only': False,
+            'batch_size': 0,
+            'size': size,
+            'trail': False,
+            'timestamp': self.now,
+            'avg_fill_price': None,
+            'currency': self.currency,
+            'venue_id': "SIM-" + str(self.venue_id_count),
+            'price': None,
+            'status': "NEW"}
+
+        self.orders[order['venue_id']] = order
+        self.open_orders[symbol][order['venue_id']] = order
+        self.fill(order, self.slip(price, side == "LONG"), True, self.now)
+
+        return order['status'] == "FILLED"
+
+    def format_orders(self, orders):
+
+        formatted = []
+        for order in orders:
+            price = order['price']
+            if order['order_type'] == "MARKET":
+                price = None
+            elif order['order_type'] in ["LIMIT", "STOP", "STOP_LIMIT"]:
+                price = self.round_increment(price, order['symbol'])
+            else:
+                raise Exception("Incorrect order type specified.")
+
+            formatted.append({
+                'symbol': order['symbol'],
+                'direction': order['direction'],
+                'size': self.round_increment(order['size'], order['symbol']),
+                'price': price,
+                'order_type': order['order_type']})
+
+        return formatted
+
+    def format_order_conf(self, order):
+        """
+        Return a normalised order confirmation dict for the given order.
+        """
+
+        return {
+            'order_id': order['order_id'],
+            'venue_id': order['venue_id'],
+            'timestamp': order['timestamp'],
+            'price': order['price'],
+            'avg_fill_price': order['avg_fill_price'],
+            'currency': order['currency'],
+            'venue': self.name,
+            'symbol': order['symbol'],
+            'direction': order['direction'],
+            'size': order['size'],
+            'filled': order['size'] if order['status'] == "FILLED" else 0,
+            'order_type': order['order_type'],
+            'metatype': order['metatype'],
+            'void_price': order['void_price'],
+            'status': order['status']}
+
+    def get_executions(self, symbol, start_timestamp=None, end_timestamp=None, count=500):
+
+        timestamps, executions = self.executions[symbol]
+
+        lo = 0 if start_timestamp is None else bisect_left(
+            timestamps, start_timestamp)
+        hi = len(timestamps) if end_timestamp is None else bisect_right(
+            timestamps, end_timestamp)
+
+        return executions[lo:hi][:count]
+
+    def get_orders(self, symbol=None, start_timestamp=None, count=500):
+
+        orders = [
+            self.format_order_conf(o) for o in list(self.orders.values()) if
+            o['order_id'] and (symbol is None or o['symbol'] == symbol) and
+            (start_timestamp is None or o['timestamp'] >= start_timestamp)]
+
+        return orders[-count:]
+
+    def get_position(self, symbol):
+
+        position = self.positions[symbol]
+
+        return {
+            'size': position['size'],
+            'avg_entry_price': position['avg_entry_price'],
+            'symbol': symbol,
+            'direction': "LONG" if position['size'] > 0 else "SHORT",
+            'currency': self.currency,
+            'opening_timestamp': position['opening_timestamp'],
+            'opening_size': position['opening_size'],
+            'status': "OPEN" if position['size'] != 0 else "CLOSED"}
+
+    def get_bars_in_period(self, symbol, start_time, total):
+
+        if total >= self.MAX_BARS_PER_REQUEST:
+            total = self.MAX_BARS_PER_REQUEST
+
+        return [
+            b for b in self.history[symbol] if
+            b['timestamp'] >= start_time][:total]
+
+    def get_recent_bars(self, timeframe, symbol, n=1):
+
+        # Only 1 min bars are replayed.
+        return list(reversed(self.history[symbol]))[:n]
+
+    def get_origin_timestamp(self, symbol: str):
+
+        return self.origin_tss[symbol]
+
+    def get_recent_ticks(self, symbol, n=1):
+
+        # No tick data, fills are simulated from bars.
+        return self.empty_ticks()
+
+    def parse_ticks(self):
+
+        # No live data feed, bars are supplied via new_bar().
+        pass
@@ -11,10 +11,13 @@ Some rights reserved. See LICENSE.md, AUTHORS.md.
 
 from datetime import date, datetime, timedelta
 from model import EMACrossTestingOnly
+from event_types import Bar
 from pymongo import MongoClient, errors
 from features import Features
+from collections import deque
 from dateutil import parser
 import pandas as pd
+import numpy as np
 import calendar
 import pymongo
 import queue
@@ -59,7 +62,8 @@ class Strategy:
     # Maximum lookback in use by any strategy.
     MAX_LOOKBACK = 150
 
-    def __init__(self, exchanges, logger, db_prices, db_other, db_client):
+    def __init__(self, exchanges, logger, db_prices, db_other, db_client,
+                 bar_cache=None):
         self.exchanges = exchanges
         self.logger = logger
         self.db_prices = db_prices
@@ -68,6 +72,9 @@ class Strategy:
         self.db_collections_price = {
             i.get_name(): db_prices[i.get_name()] for i in self.exchanges}
 
+        # Local columnar bar store, used in place of DB reads if present.
+        self.bar_cache = bar_cache
+
         # Save-later queue.
         self.signals_save_to_db = queue.Queue(0)
 
@@ -81,6 +88,10 @@ class Strategy:
         # Signal container: signals[exchange][symbol][timeframe].
         self.signals = {}
 
+        # Alternative bar type data, see BarBuilder. Rolling bar windows
+        # bars[exchange][symbol][bar_type] of MAX_LOOKBACK + LOOKBACK_PAD.
+        self.bars = {}
+
         # persistent reference to features library.
         self.feature_ref = Features()
 
@@ -126,13 +137,139 @@ class Strategy:
             # Run models with new data.
             self.run_models(event, op_timeframes, events)
 
-    def update_dataframes(self, event, timeframes, op_timeframes):
+    def new_batch(self, events, event, count):
+        """
+        Process a market batch event, all new bars from one venue, and
+        update all models with new data. Per timestamp, all symbols datasets
+        are resampled in one pass, then each model computes features and runs
+        once over the batch symbols it trades.
+
+        Args:
+            events: event queue object.
+            event: new market batch event.
+            count: server cycle count.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        # Wait for 1 mins of operation to clear up any null bars.
+        if count >= 1:
+            exc = event.get_exchange()
+            venue = exc.get_name()
+
+            for timestamp in event.get_timestamps():
+
+                # Get operating timeframes for the current period.
+                timeframes = self.get_relevant_timeframes(timestamp)
+                op_timeframes = copy.deepcopy(timeframes)
+
+                # Get additional timeframes required by models.
+                for model in self.models:
+                    model.get_required_timeframes(timeframes)
+
+                bars = event.get_bars(timestamp)
+                self.logger.info(
+                    "Batch timestamp just in: " + str(
+                        datetime.utcfromtimestamp(timestamp)) + ", " +
+                    str(len(bars)) + " " + venue + " bars.")
+                self.logger.info(
+                    "Operating timeframes: " + str(op_timeframes))
+                self.logger.info(
+                    "Required timeframes: " + str(timeframes))
+
+                # Update datasets for all symbols in the batch.
+                self.update_batch_dataframes(
+                    venue, bars, timeframes, op_timeframes)
+
+                # Models and the batch symbols they trade.
+                traded = self.batch_instruments(
+                    venue, [bar['symbol'] for bar in bars])
+
+                # Calculate new feature values.
+                for model, symbols in traded:
+                    for sym in symbols:
+                        for tf in timeframes:
+                            self.add_features(model, self.data[venue][sym][tf])
+
+                # Run models with new data.
+                for model, symbols in traded:
+                    self.run_batch_model(
+                        model, exc, symbols, op_timeframes, events)
+
+    def new_bar(self, events, event):
+        """
+        Process an alternative bar type market event and run models
+        subscribed to its bar type.
+
+        Args:
+            events: event queue object.
+            event: new market event, bar type other than 1 min.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        bar = event.get_bar()
+        bar_type = event.get_bar_type()
+        sym = bar['symbol']
+        exc = event.get_exchange()
+        venue = exc.get_name()
+
+        if venue not in self.bars:
+            self.bars[venue] = {}
+        if sym not in self.bars[venue]:
+            self.bars[venue][sym] = {}
+        if bar_type not in self.bars[venue][sym]:
+            self.bars[venue][sym][bar_type] = deque(
+                maxlen=self.MAX_LOOKBACK + self.LOOKBACK_PAD)
+
+        bars = self.bars[venue][sym][bar_type]
+        bars.append(bar)
+
+        for model in self.models:
+            if (bar_type in model.get_bar_types() and
+                    model.get_instruments()[venue].get(sym) == sym):
+
+                # Bar types are irregular in time, index by bar open time.
+                data = pd.DataFrame(list(bars)).drop(
+                    columns=["symbol", "bar_type"])
+                data.index = pd.to_datetime(data['start_ms'], unit="ms")
+                self.add_features(model, data)
+
+                result = model.run({bar_type: data}, [], bar_type, sym, exc)
+
+                if result:
+                    events.put(result)
+                    self.signals_save_to_db.put(result)
+
+    def get_bar_types(self):
+        """
+        Return list of alternative bar types subscribed to by any model.
+        """
+
+        bar_types = []
+        for model in self.models:
+            for bar_type in model.get_bar_types():
+                if bar_type not in bar_types:
+                    bar_types.append(bar_type)
+
+        return bar_types
+
+    def update_dataframes(self, event, timeframes, op_timeframes, log=True):
         """
         Update dataframes for the given event and list of timeframes.
 
         Args:
             event: new market event.
             timeframes: list of relevant timeframes to the just-elapsed period.
+            log: if True, log model and timeframe details.
 
         Returns:
             None.
@@ -141,8 +278,8 @@ class Strategy:
             None.
         """
 
-        sym = event.get_bar()['symbol']
-        bar = self.remove_element(event.get_bar(), "symbol")
+        bar = event.get_bar()
+        sym = bar['symbol']
         exc = event.get_exchange()
         venue = exc.get_name()
 
@@ -181,6 +318,9 @@ class Strategy:
             # data addition. Like an in-memory csv/DB, or list of dicts, etc.
 
         # Log model and timeframe details.
+        if not log:
+            return
+
         for model in self.models:
 
             venue = exc.get_name()
@@ -194,6 +334,121 @@ class Strategy:
                 self.logger.info(
                     "Required timeframes: " + str(timeframes))
 
+    def update_batch_dataframes(self, venue, bars, timeframes,
+                                op_timeframes):
+        """
+        Update dataframes for all the given bars from one venue, for the
+        given list of timeframes. New rows for populated datasets are
+        resampled in one pass per timeframe, see batch_resample.
+
+        Args:
+            venue: exchange name (string).
+            bars: list of newest 1-min Bars, one per symbol.
+            timeframes: list of relevant timeframes to the just-elapsed period.
+            op_timeframes: operating timeframes for the just-elapsed period.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        data = self.data[venue]
+
+        for tf in timeframes:
+
+            # Only update op_timeframes if appending, as required tf data
+            # will be mid-bar. Populate empty datasets.
+            appending = []
+            for bar in bars:
+                sym = bar['symbol']
+                if len(data[sym][tf].index) == 0:
+                    data[sym][tf] = self.build_dataframe(venue, sym, tf, bar)
+                    data[sym][tf].fillna(method="pad", inplace=True)
+                elif tf in op_timeframes:
+                    appending.append(bar)
+
+            if not appending:
+                continue
+
+            new_rows = self.batch_resample(venue, appending, tf)
+
+            for sym, new_row in new_rows.items():
+                data[sym][tf] = pd.concat([data[sym][tf], new_row])
+
+                # Earlier rows are already padded, pad only after null bars.
+                if new_row.isnull().values.any():
+                    data[sym][tf].fillna(method="pad", inplace=True)
+
+    def batch_resample(self, venue, bars, tf):
+        """
+        Return a single bar of timeframe "tf" for each of the given symbols
+        newest 1-min bars. Stored bars for all symbols are loaded into one
+        dataframe, then padded and resampled in one pass.
+
+        Args:
+            venue: exchange name (string).
+            bars: list of newest 1-min Bars, one per symbol.
+            tf: timeframe code (string).
+
+        Returns:
+            new_rows: {symbol: single row dataframe} dict.
+
+        Raises:
+            Resampling error.
+        """
+
+        size = self.TF_MINS[tf] - 1
+        symbols = [bar['symbol'] for bar in bars]
+
+        # Build from cache columns if all symbols are cached.
+        if self.bar_cache is not None and all(
+                self.bar_cache.total_stored(venue, sym) for sym in symbols):
+
+            parts = [
+                self.load_bar_columns(venue, sym, size, bar) for sym, bar in
+                zip(symbols, bars)]
+
+            df = pd.DataFrame(
+                {col: np.concatenate([p[col] for p in parts]) for col in
+                    self.RESAMPLE_KEY.keys()},
+                index=pd.to_datetime(np.concatenate(
+                    [p['timestamp'] for p in parts]), unit='s'))
+            df.index.name = "timestamp"
+            df['symbol'] = np.repeat(
+                symbols, [len(p['timestamp']) for p in parts])
+
+        else:
+            df = pd.concat([
+                self.load_bars(venue, sym, size, bar).assign(symbol=sym) for
+                sym, bar in zip(symbols, bars)])
+
+        # Pad any null bars forward, within each symbol.
+        cols = list(self.RESAMPLE_KEY.keys())
+        df[cols] = df.groupby("symbol")[cols].ffill().values
+
+        # Downsample 1 min data to target timeframe.
+        new_rows = {}
+        try:
+            resampled = df.groupby(
+                ["symbol", pd.Grouper(freq=tf)]).agg(self.RESAMPLE_KEY)[cols]
+
+            # Newest resampled bar for each symbol.
+            newest = resampled.groupby(level="symbol").tail(1)
+            timestamps = newest.index.get_level_values("timestamp")
+
+            for i, sym in enumerate(
+                    newest.index.get_level_values("symbol")):
+                new_rows[sym] = pd.DataFrame(
+                    newest.values[i:i + 1], columns=cols,
+                    index=timestamps[i:i + 1])
+
+        except Exception as exc:
+            print("Resampling error", exc)
+
+        return new_rows
+
     def calculate_features(self, event, timeframes):
         """
         Calculate features required for each model, append the values to each
@@ -219,39 +474,50 @@ class Strategy:
             # Check if model is applicable to the event.
             if inst == sym:
                 for tf in timeframes:
+                    self.add_features(model, self.data[venue][sym][tf])
 
-                    features = model.get_features()
-                    data = self.data[venue][sym][tf]
+    def add_features(self, model, data):
+        """
+        Calculate the models features for the given dataset, append the
+        values as new columns in-place.
+
+        Args:
+            model: strategy model.
+            data: dataframe of bars.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
 
-                    # Calculate feature data.
-                    for feature in features:
+        for feature in model.get_features():
 
-                        # f[0] is feature type
-                        # f[1] is feature function
-                        # f[2] is feature param
-                        f = feature[1](
-                                self.feature_ref,
-                                feature[2],
-                                data)
+            # f[0] is feature type
+            # f[1] is feature function
+            # f[2] is feature param
+            f = feature[1](
+                    self.feature_ref,
+                    feature[2],
+                    data)
 
-                        # Handle indicator and time-series feature data.
-                        if (f[0] == "indicator" or
-                            (type(f) == pd.core.series.Series) or
-                                (type(f) == pd.Series)):
+            # Handle indicator and time-series feature data.
+            if (f[0] == "indicator" or
+                (type(f) == pd.core.series.Series) or
+                    (type(f) == pd.Series)):
 
-                            # Use feature param as dataframe col name.
-                            ID = "" if feature[2] is None else str(feature[2])
+                # Use feature param as dataframe col name.
+                ID = "" if feature[2] is None else str(feature[2])
 
-                            # Round and append to dataframe.
-                            self.data[venue][sym][tf][
-                                feature[1].__name__ +
-                                ID] = f.round(6)
+                # Round and append to dataframe.
+                data[feature[1].__name__ + ID] = f.round(6)
 
-                        # Handle boolean feature data.
-                        elif f[0] == "boolean":
-                            pass
+            # Handle boolean feature data.
+            elif f[0] == "boolean":
+                pass
 
-                        # TODO
+            # TODO
 
     def run_models(self, event, op_timeframes: list, events):
         """
@@ -299,6 +565,64 @@ class Strategy:
                             # Put signal in separate save-later queue.
                             self.signals_save_to_db.put(result)
 
+    def batch_instruments(self, venue, symbols):
+        """
+        Return list of (model, symbols) pairs, each model with those of the
+        given symbols it trades on the given venue.
+        """
+
+        traded = []
+        for model in self.models:
+            instruments = model.get_instruments().get(venue, {})
+            model_symbols = [
+                sym for sym in symbols if instruments.get(sym) == sym]
+
+            if model_symbols:
+                traded.append((model, model_symbols))
+
+        return traded
+
+    def run_batch_model(self, model, exc, symbols, op_timeframes, events):
+        """
+        Run the given model for the just-elapsed period on each of the given
+        symbols. Required timeframes are resolved once for all symbols.
+
+        Args:
+            model: strategy model.
+            exc: exchange object.
+            symbols: list of instrument ticker codes the model trades.
+            op_timeframes: relevant timeframes to the just-elapsed period.
+            events: event queue object.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        venue = exc.get_name()
+
+        for tf in op_timeframes:
+            if tf in model.get_operating_timeframes():
+
+                # Get non-op, but still required timeframe codes.
+                req_tf = model.get_required_timeframes([tf], result=True)
+
+                for sym in symbols:
+                    data = self.data[venue][sym]
+
+                    # Get non-trigger data as list of {tf : dataframe}.
+                    req_data = [{i: data[i]} for i in req_tf]
+
+                    result = model.run(data, req_data, tf, sym, exc)
+
+                    # Put generated signal in the main event queue and the
+                    # save-later queue.
+                    if result:
+                        events.put(result)
+                        self.signals_save_to_db.put(result)
+
     def build_dataframe(self, exc, sym, tf, current_bar=None, lookback=150):
         """
         Return a dataframe of size lookback for the given symbol,
@@ -335,41 +659,11 @@ class Strategy:
             # Dont adjust lookback for single bar requests.
             size = self.TF_MINS[tf] * (lookback)
 
-        # Create Dataframe using current_bar and stored bars.
+        # Reduce size to account for current_bar.
         if current_bar:
-
-            # Reduce size to account for current_bar.
             size = size - 1
 
-            # Use a projection to remove mongo "_id" field and symbol.
-            result = self.db_collections_price[exc].find(
-                {"symbol": sym}, {
-                    "_id": 0, "symbol": 0}).limit(
-                        size).sort([("timestamp", -1)])
-
-            # Add current_bar and DB results to a list.
-            rows = [current_bar]
-            for doc in result:
-                rows.append(doc)
-
-        # Create Dataframe using only stored bars
-        if not current_bar:
-
-            # Use a projection to remove mongo "_id" field and symbol.
-            rows = self.db_collections_price[exc].find(
-                {"symbol": sym}, {
-                    "_id": 0, "symbol": 0}).limit(
-                        size).sort([("timestamp", -1)])
-
-        # Pass cursor to DataFrame constructor.
-        df = pd.DataFrame(rows)
-
-        # Format time column.
-        df['timestamp'] = df['timestamp'].apply(
-            lambda x: datetime.utcfromtimestamp(x))
-
-        # Set index.
-        df.set_index("timestamp", inplace=True)
+        df = self.load_bars(exc, sym, size, current_bar)
 
         # Pad any null bars forward.
         df.fillna(method="pad", inplace=True)
@@ -401,26 +695,75 @@ class Strategy:
             Resampling error.
         """
 
-        if tf == "1Min":
-            # Don't need to do any resampling for 1 min bars.
-            rows = [bar]
+        # Don't need to fetch stored bars for 1 min bars, only the new one.
+        size = self.TF_MINS[tf] - 1
 
-        else:
-            # Determine how many bars to fetch for resampling.
-            size = self.TF_MINS[tf] - 1
+        df = self.load_bars(venue, sym, size, bar)
+
+        # Pad any null bars forward.
+        df.fillna(method="pad", inplace=True)
+
+        # Downsample 1 min data to target timeframe.
+        resampled = pd.DataFrame()
+        try:
+            resampled = (df.resample(tf).agg(self.RESAMPLE_KEY))
+        except Exception as exc:
+            print("Resampling error", exc)
+
+        # Must be ascending=True to grab the first value with iloc[].
+        resampled.sort_values(by="timestamp", ascending=False, inplace=True)
+
+        new_row = resampled.iloc[0]
+
+        return new_row
+
+    def load_bars(self, exc, sym, size, current_bar=None):
+        """
+        Return a dataframe of the newest "size" stored 1 min bars for the
+        given venue and symbol, plus current_bar if given, indexed by
+        timestamp. Reads from the local bar cache where it holds bars for the
+        symbol, otherwise from the database.
+
+        Args:
+            exc: exchange name (string).
+            sym: instrument ticker code (string)
+            size: number of stored bars to fetch (int).
+            current_bar: newest bar, not yet stored.
+
+        Returns:
+            df: dataframe containing 1 min bars.
+
+        Raises:
+            None.
+        """
 
-            # Use a projection to remove mongo "_id" field and symbol.
+        venue = exc if isinstance(exc, str) else exc.get_name()
+
+        if (self.bar_cache is not None and
+                self.bar_cache.total_stored(venue, sym)):
+
+            cols = self.load_bar_columns(venue, sym, size, current_bar)
+
+            df = pd.DataFrame(
+                {col: cols[col] for col in self.RESAMPLE_KEY.keys()},
+                index=pd.to_datetime(cols['timestamp'], unit='s'))
+            df.index.name = "timestamp"
+
+            return df
+
+        # Use a projection to remove mongo "_id" field and symbol.
+        rows = [Bar.from_dict(current_bar).to_dict(
+            symbol=False)] if current_bar else []
+        if size > 0:
             result = self.db_collections_price[venue].find(
                 {"symbol": sym}, {
                     "_id": 0, "symbol": 0}).limit(
                         size).sort([("timestamp", -1)])
 
-            # Add current_bar and DB results to a list.
-            rows = [bar]
             for doc in result:
                 rows.append(doc)
 
-        # Pass cursor to DataFrame constructor.
+        # Pass rows to DataFrame constructor.
         df = pd.DataFrame(rows)
 
         # Format time column.
@@ -430,22 +773,25 @@ class Strategy:
         # Set index.
         df.set_index("timestamp", inplace=True)
 
-        # Pad any null bars forward.
-        df.fillna(method="pad", inplace=True)
+        return df
 
-        # Downsample 1 min data to target timeframe.
-        resampled = pd.DataFrame()
-        try:
-            resampled = (df.resample(tf).agg(self.RESAMPLE_KEY))
-        except Exception as exc:
-            print("Resampling error", exc)
+    def load_bar_columns(self, venue, sym, size, current_bar=None):
+        """
+        Return {column: np.ndarray} of the newest "size" 1 min bars held in
+        the local bar cache for the given venue and symbol, plus current_bar
+        if given. Null values in current_bar become NaN.
+        """
 
-        # Must be ascending=True to grab the first value with iloc[].
-        resampled.sort_values(by="timestamp", ascending=False, inplace=True)
+        before_ts = current_bar['timestamp'] if current_bar else None
+        cols = self.bar_cache.get_last(venue, sym, size, before_ts)
 
-        new_row = resampled.iloc[0]
+        # Add current_bar as the final row.
+        if current_bar:
+            cols = {col: np.append(values, np.nan if current_bar[
+                col] is None else current_bar[col]) for col, values in
+                    cols.items()}
 
-        return new_row
+        return cols
 
     def remove_element(self, dictionary, element):
         """
@@ -688,8 +1034,10 @@ class Strategy:
                     count += 1
                     # Store signal in relevant db collection.
                     try:
-                        self.db_other['signals'].insert_one(
-                            self.remove_element(signal.get_signal_dict(), "op_data"))
+                        doc = signal.get_signal_dict()
+                        if doc['op_data'] is not None:
+                            doc['op_data'] = doc['op_data'].to_dict()
+                        self.db_other['signals'].insert_one(doc)
 
                     # Skip duplicates if they exist.
                     except pymongo.errors.DuplicateKeyError:
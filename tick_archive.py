@@ -0,0 +1,591 @@
+"""
+trading-server is a multi-asset, multi-strategy, event-driven execution
+and backtesting platform (OEMS) for trading common markets.
+
+Copyright (C) 2020  Sam Breznikar <sam@sdbgroup.io>
+
+Licensed under GNU General Public License 3.0 or later.
+
+Some rights reserved. See LICENSE.md, AUTHORS.md.
+"""
+
+from threading import Thread, Lock, Event
+from datetime import datetime, timezone
+import numpy as np
+import traceback
+import zipfile
+import shutil
+import queue
+import os
+
+
+class TickArchive:
+    """
+    Append-only local archive of raw ticks, one columnar log per venue,
+    symbol and UTC day.
+
+    Ticks are queued by add(), usually from a venue websocket thread, and
+    written by a background writer thread every FLUSH_INTERVAL seconds.
+
+    The current day is stored uncompressed, one file per column, so it can
+    be appended to and memory-mapped for range scans. Days older than
+    COMPRESS_AFTER_DAYS are compacted into a single compressed file with
+    delta-encoded timestamps, which is decompressed in full when read.
+
+    Trade IDs are UUIDs (BitMEX trdMatchID), stored as 16 raw bytes rather
+    than their 36 character text form, and returned as text by get_range.
+
+    Layout: <path>/<venue>/<symbol>/<YYYY-MM-DD>/<column>.bin, or
+    <path>/<venue>/<symbol>/<YYYY-MM-DD>.npz once compressed.
+    """
+
+    DEFAULT_DIR = "tick_archive"
+    FLUSH_INTERVAL = 1
+    COMPRESS_AFTER_DAYS = 1
+
+    COLUMNS = ["timestamp", "price", "size", "side", "trade_id"]
+    DTYPES = {
+        'timestamp': np.int64,      # Epoch nanoseconds.
+        'price': np.float64,
+        'size': np.float64,
+        'side': np.int8,            # 1 buy, -1 sell.
+        'trade_id': 'V16'}          # Raw UUID bytes.
+
+    # Text UUID "xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx", hex digit positions.
+    TRADE_ID_DTYPE = 'S36'
+    TRADE_ID_HEX = np.array(
+        [i for i in range(36) if i not in (8, 13, 18, 23)])
+    HEX_DIGITS = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+
+    DAY_NS = 86400 * 10 ** 9
+
+    def __init__(self, logger, path=DEFAULT_DIR,
+                 flush_interval=FLUSH_INTERVAL,
+                 compress_after_days=COMPRESS_AFTER_DAYS):
+        self.logger = logger
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compress_after_days = compress_after_days
+
+        # Queued (venue, rows, formatter) tuples awaiting write.
+        self.queue = queue.Queue()
+
+        # Open day logs {(venue, symbol, day): TickDay}.
+        self.days = {}
+        self.lock = Lock()
+
+        self.stopped = Event()
+        self.last_compress_day = None
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        self.writer = Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def add(self, venue, rows, formatter):
+        """
+        Queue ticks for writing. Cheap enough to call from a websocket
+        thread, formatting happens on the writer thread.
+
+        Args:
+            venue: venue name (string).
+            rows: list of venue-format tick dicts, each with a 'symbol' key.
+            formatter: function converting a list of rows for one symbol
+                into a dict of tick columns, see Exchange.TICK_DTYPES.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        if rows:
+            self.queue.put((venue, rows, formatter))
+
+    def run(self):
+        """
+        Writer thread, write queued ticks every flush_interval seconds.
+        """
+
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+                self.compress_old_days()
+
+            except Exception:
+                self.logger.info("Tick archive write failed.")
+                traceback.print_exc()
+
+    def flush(self):
+        """
+        Write all queued ticks.
+
+        Returns:
+            Number of ticks written (int).
+        """
+
+        # Group queued rows by venue and symbol.
+        batches = {}
+        while True:
+            try:
+                venue, rows, formatter = self.queue.get(False)
+            except queue.Empty:
+                break
+
+            for row in rows:
+                key = (venue, row['symbol'])
+                if key not in batches:
+                    batches[key] = ([], formatter)
+                batches[key][0].append(row)
+
+        # A failed batch must not lose other symbols ticks.
+        count = 0
+        for (venue, symbol), (rows, formatter) in batches.items():
+            try:
+                count += self.write(venue, symbol, formatter(rows))
+
+            except Exception:
+                self.logger.info(
+                    "Discarded " + str(len(rows)) + " " + venue + " " +
+                    symbol + " ticks, write failed.")
+                traceback.print_exc()
+
+        return count
+
+    def write(self, venue, symbol, cols):
+        """
+        Append tick columns (Exchange.TICK_DTYPES, millisecond timestamps)
+        to the relevant day logs.
+
+        Returns:
+            Number of ticks written (int).
+        """
+
+        count = 0
+        if not len(cols['timestamp']):
+            return count
+
+        cols = dict(cols)
+
+        # Drop ticks with malformed trade IDs, keep the rest.
+        digits, valid = self.parse_trade_ids(cols['trade_id'])
+        if not valid.all():
+            self.logger.info(
+                "Discarded " + str(int((~valid).sum())) + " " + venue + " " +
+                symbol + " ticks with invalid trade IDs.")
+            cols = {col: values[valid] for col, values in cols.items()}
+            digits = digits[valid]
+            if not len(cols['timestamp']):
+                return count
+
+        cols['timestamp'] = cols['timestamp'].astype(np.int64) * 10 ** 6
+        cols['trade_id'] = self.pack_trade_ids(digits)
+
+        # Split on UTC day boundaries.
+        days = cols['timestamp'] // self.DAY_NS
+        bounds = np.flatnonzero(np.diff(days)) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(days)]))
+
+        with self.lock:
+            for lo, hi in zip(starts, ends):
+                day = self.day_string(int(days[lo]))
+                log = self.get_day(venue, symbol, day)
+
+                # Closed days are immutable, drop late ticks.
+                if log.compressed:
+                    self.logger.info(
+                        "Dropped " + str(hi - lo) + " late " + symbol +
+                        " ticks for compressed day " + day + ".")
+                    continue
+
+                log.append({col: cols[col][lo:hi] for col in self.COLUMNS})
+                count += hi - lo
+
+        return int(count)
+
+    def encode_trade_ids(self, trade_ids):
+        """
+        Return text UUID trade IDs as 16 byte raw values.
+
+        Raises:
+            Exception if a trade ID is not a UUID.
+        """
+
+        digits, valid = self.parse_trade_ids(trade_ids)
+        if not valid.all():
+            raise Exception("Trade IDs must be UUIDs.")
+
+        return self.pack_trade_ids(digits)
+
+    def parse_trade_ids(self, trade_ids):
+        """
+        Return (hex digit values, valid row mask) for text UUID trade IDs.
+        """
+
+        text = np.ascontiguousarray(trade_ids, dtype=self.TRADE_ID_DTYPE)
+        chars = text.view(np.uint8).reshape(len(text), 36)
+
+        digits = chars[:, self.TRADE_ID_HEX].astype(np.int16)
+        digits = np.where(digits <= ord("9"), digits - ord("0"),
+                          (digits | 0x20) - ord("a") + 10)
+
+        valid = ((digits >= 0) & (digits <= 15)).all(axis=1) & (
+            chars[:, [8, 13, 18, 23]] == ord("-")).all(axis=1)
+
+        return digits, valid
+
+    def pack_trade_ids(self, digits):
+        """
+        Return hex digit values from parse_trade_ids as 16 byte raw values.
+        """
+
+        raw = np.ascontiguousarray(
+            digits[:, ::2] << 4 | digits[:, 1::2], dtype=np.uint8)
+        return raw.view(self.DTYPES['trade_id']).ravel()
+
+    def decode_trade_ids(self, raw):
+        """
+        Return 16 byte raw trade IDs as text UUIDs.
+        """
+
+        raw = np.ascontiguousarray(raw).view(np.uint8).reshape(len(raw), 16)
+
+        chars = np.full((len(raw), 36), ord("-"), dtype=np.uint8)
+        chars[:, self.TRADE_ID_HEX[::2]] = self.HEX_DIGITS[raw >> 4]
+        chars[:, self.TRADE_ID_HEX[1::2]] = self.HEX_DIGITS[raw & 0xf]
+
+        return chars.view(self.TRADE_ID_DTYPE).ravel()
+
+    def day_string(self, day):
+        return datetime.fromtimestamp(
+            day * 86400, tz=timezone.utc).strftime("%Y-%m-%d")
+
+    def day_path(self, venue, symbol, day):
+        return os.path.join(self.path, venue, symbol, day)
+
+    def get_day(self, venue, symbol, day):
+        """
+        Return the TickDay log for the given venue, symbol and day.
+        """
+
+        key = (venue, symbol, day)
+        if key not in self.days:
+            self.days[key] = TickDay(self.day_path(venue, symbol, day))
+
+        return self.days[key]
+
+    def get_range(self, venue, symbol, start_ns=None, end_ns=None):
+        """
+        Return ticks for start_ns <= timestamp < end_ns as a dict of column
+        arrays. Single uncompressed days are returned as read-only views of
+        the memory-mapped columns, except trade IDs which are decoded.
+
+        Args:
+            venue: venue name (string).
+            symbol: instrument ticker code (string).
+            start_ns: epoch nanosecond timestamp, None for oldest.
+            end_ns: epoch nanosecond timestamp, None for newest.
+
+        Returns:
+            {column name: np.ndarray} dict.
+
+        Raises:
+            None.
+        """
+
+        parts = []
+        for day in self.stored_days(venue, symbol):
+            day_start = int(np.datetime64(day, 'ns').astype(np.int64))
+            if start_ns is not None and day_start + self.DAY_NS <= start_ns:
+                continue
+            if end_ns is not None and day_start >= end_ns:
+                continue
+
+            with self.lock:
+                log = self.get_day(venue, symbol, day)
+                parts.append(log.get_range(start_ns, end_ns))
+
+        if len(parts) == 1:
+            cols = dict(parts[0])
+        elif not parts:
+            cols = {
+                col: np.empty(0, dtype=dtype) for col, dtype in
+                self.DTYPES.items()}
+        else:
+            cols = {
+                col: np.concatenate([p[col] for p in parts])
+                for col in self.COLUMNS}
+
+        cols['trade_id'] = self.decode_trade_ids(cols['trade_id'])
+
+        return cols
+
+    def stored_days(self, venue, symbol):
+        """
+        Return sorted list of day strings stored for venue and symbol.
+        """
+
+        path = os.path.join(self.path, venue, symbol)
+        if not os.path.exists(path):
+            return []
+
+        return sorted(set(
+            i[:-len(TickDay.COMPRESSED)] if i.endswith(TickDay.COMPRESSED)
+            else i for i in os.listdir(path) if not i.endswith(".tmp")))
+
+    def compress_old_days(self, now=None):
+        """
+        Compress uncompressed day logs older than COMPRESS_AFTER_DAYS. Runs
+        at most once per day unless now is given.
+
+        Returns:
+            Number of days compressed (int).
+        """
+
+        today = int(now if now is not None else
+                    datetime.now(timezone.utc).timestamp()) // 86400
+        if now is None and today == self.last_compress_day:
+            return 0
+        self.last_compress_day = today
+
+        count = 0
+        for venue in os.listdir(self.path):
+            for symbol in os.listdir(os.path.join(self.path, venue)):
+                for day in self.stored_days(venue, symbol):
+                    age = today - int(np.datetime64(day, 'D').astype(np.int64))
+                    if age < self.compress_after_days:
+                        continue
+
+                    with self.lock:
+                        log = self.get_day(venue, symbol, day)
+                        if not log.compressed:
+                            log.compress()
+                            count += 1
+
+        if count:
+            self.logger.info(
+                "Compressed " + str(count) + " tick archive day logs.")
+
+        return count
+
+    def disk_usage(self):
+        """
+        Return tick count, bytes on disk and bytes per million ticks for
+        uncompressed and compressed day logs, per venue and symbol.
+
+        Returns:
+            {venue: {symbol: {'raw': {...}, 'compressed': {...}}}} dict.
+
+        Raises:
+            None.
+        """
+
+        report = {}
+        for venue in os.listdir(self.path):
+            report[venue] = {}
+            for symbol in os.listdir(os.path.join(self.path, venue)):
+                usage = {
+                    'raw': {'days': 0, 'ticks': 0, 'bytes': 0},
+                    'compressed': {'days': 0, 'ticks': 0, 'bytes': 0}}
+
+                for day in self.stored_days(venue, symbol):
+                    with self.lock:
+                        # Dont keep logs opened only to be measured.
+                        log = self.days.get((venue, symbol, day)) or TickDay(
+                            self.day_path(venue, symbol, day))
+                        kind = 'compressed' if log.compressed else 'raw'
+                        usage[kind]['days'] += 1
+                        usage[kind]['ticks'] += len(log)
+                        usage[kind]['bytes'] += log.disk_usage()
+
+                for kind in usage.values():
+                    kind['bytes_per_million_ticks'] = int(
+                        kind['bytes'] / kind['ticks'] * 10 ** 6) if \
+                        kind['ticks'] else None
+
+                report[venue][symbol] = usage
+
+        return report
+
+    def close(self):
+        """
+        Stop the writer thread, write remaining ticks and close logs.
+        """
+
+        self.stopped.set()
+        self.writer.join()
+        self.flush()
+
+        with self.lock:
+            for log in self.days.values():
+                log.close()
+            self.days = {}
+
+
+class TickDay:
+    """
+    Columnar tick log for one venue, symbol and day.
+    """
+
+    COMPRESSED = ".npz"
+
+    def __init__(self, path):
+        self.path = path
+        self.compressed = os.path.exists(path + self.COMPRESSED)
+
+        # Memory maps of uncompressed columns, reopened after appends.
+        self.maps = None
+
+        # Decompressed columns.
+        self.data = None
+
+    def filename(self, col):
+        return os.path.join(self.path, col + ".bin")
+
+    def __len__(self):
+        if self.compressed:
+            return self.compressed_rows()
+        return self.stored_rows()
+
+    def compressed_rows(self):
+        """
+        Return number of rows of a compressed log, read from the timestamp
+        array header without decompressing the log.
+        """
+
+        with zipfile.ZipFile(self.path + self.COMPRESSED) as z:
+            with z.open("timestamp.npy") as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape = np.lib.format.read_array_header_1_0(f)[0]
+                else:
+                    shape = np.lib.format.read_array_header_2_0(f)[0]
+
+        return shape[0]
+
+    def stored_rows(self):
+        """
+        Return number of complete rows, columns may differ in length if
+        a write was interrupted.
+        """
+
+        if not os.path.exists(self.path):
+            return 0
+
+        return min(
+            os.path.getsize(self.filename(col)) //
+            np.dtype(TickArchive.DTYPES[col]).itemsize
+            for col in TickArchive.COLUMNS)
+
+    def append(self, cols):
+        """
+        Append tick columns to the log.
+        """
+
+        if self.compressed:
+            raise Exception("Cant append to compressed tick log " + self.path)
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+            for col in TickArchive.COLUMNS:
+                open(self.filename(col), "wb").close()
+
+        # Truncate partial rows left by an interrupted write.
+        length = self.stored_rows()
+        for col in TickArchive.COLUMNS:
+            values = np.ascontiguousarray(
+                cols[col], dtype=TickArchive.DTYPES[col])
+            with open(self.filename(col), "r+b") as f:
+                f.truncate(length * values.itemsize)
+                f.seek(0, 2)
+                f.write(values.tobytes())
+
+        self.maps = None
+
+    def columns(self):
+        """
+        Return full columns, memory-mapped or decompressed.
+        """
+
+        if self.compressed:
+            return self.load()
+
+        if self.maps is None:
+            length = self.stored_rows()
+            self.maps = {
+                col: np.memmap(
+                    self.filename(col), dtype=TickArchive.DTYPES[col],
+                    mode="r", shape=(length,)) if length else
+                np.empty(0, dtype=TickArchive.DTYPES[col])
+                for col in TickArchive.COLUMNS}
+
+        return self.maps
+
+    def get_range(self, start_ns=None, end_ns=None):
+        """
+        Return read-only column views for start_ns <= timestamp < end_ns.
+        """
+
+        cols = self.columns()
+        timestamps = cols['timestamp']
+
+        lo = 0 if start_ns is None else int(
+            np.searchsorted(timestamps, start_ns, side="left"))
+        hi = len(timestamps) if end_ns is None else int(
+            np.searchsorted(timestamps, end_ns, side="left"))
+
+        views = {}
+        for col in TickArchive.COLUMNS:
+            view = cols[col][lo:max(lo, hi)].view()
+            view.flags.writeable = False
+            views[col] = view
+
+        return views
+
+    def load(self):
+        """
+        Return decompressed columns of a compressed log.
+        """
+
+        if self.data is None:
+            with np.load(self.path + self.COMPRESSED) as f:
+                data = {col: f[col] for col in TickArchive.COLUMNS}
+            data['timestamp'] = np.cumsum(data['timestamp'])
+            self.data = data
+
+        return self.data
+
+    def compress(self):
+        """
+        Replace column files with a single compressed file. Timestamps are
+        delta-encoded first, they compress far better as small intervals.
+        """
+
+        cols = {
+            col: np.array(values) for col, values in self.columns().items()}
+        cols['timestamp'] = np.diff(cols['timestamp'], prepend=0)
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez_compressed(f, **cols)
+        os.replace(tmp, self.path + self.COMPRESSED)
+
+        self.close()
+        shutil.rmtree(self.path)
+        self.compressed = True
+
+    def disk_usage(self):
+        if self.compressed:
+            return os.path.getsize(self.path + self.COMPRESSED)
+
+        return sum(
+            os.path.getsize(self.filename(col))
+            for col in TickArchive.COLUMNS) if os.path.exists(self.path) \
+            else 0
+
+    def close(self):
+        self.maps = None
+        self.data = None
@@ -9,6 +9,7 @@ Licensed under GNU General Public License 3.0 or later.
 Some rights reserved. See LICENSE.md, AUTHORS.md.
 """
 
+from pymongo import ReturnDocument
 from abc import ABC, abstractmethod
 
 
@@ -37,6 +38,7 @@ class Trade(ABC):
         self.exposure = None            # Percentage of possible loss remaining at risk.
         self.consent = None             # If or not user consents to trade.
         self.systematic_close = None    # If or not trade was closed properly.
+        self.complete = False           # True once trade is archived.
 
     @abstractmethod
     def get_trade_dict(self):
@@ -102,6 +104,7 @@ class SingleInstrumentTrade(Trade):
             'symbol': self.symbol,
             'position': self.position,
             'consent': self.consent,
+            'complete': self.complete,
             'order_count': self.order_count,
             'orders': self.orders}
 
@@ -111,6 +114,8 @@ class Position:
     Models a single active position, as part of a parent trade.
     """
 
+    __slots__ = ('fill_conf', 'fees')
+
     def __init__(self, fill_conf):
         self.fill_conf = fill_conf
 
@@ -141,6 +146,12 @@ class Order:
     Models a single order, as part of parent trade.
     """
 
+    __slots__ = (
+        'logger', 'trade_id', 'order_id', 'timestamp', 'avg_fill_price',
+        'currency', 'venue_id', 'symbol', 'venue', 'direction', 'size',
+        'price', 'order_type', 'metatype', 'void_price', 'trail',
+        'reduce_only', 'post_only', 'batch_size', 'status')
+
     def __init__(self, logger, trade_id, order_id, symbol, venue,
                  direction, size, price, order_type, metatype, void_price,
                  trail, reduce_only, post_only, status="UNFILLED"):
@@ -165,6 +176,30 @@ class Order:
         self.batch_size = 0             # Batch size for all related orders.
         self.status = status            # FILLED, NEW, PARTIAL.
 
+    @classmethod
+    def from_dict(cls, logger, order_dict):
+        """
+        Create an Order from an order dict, e.g as stored in the DB.
+        """
+
+        order = cls(
+            logger, order_dict['trade_id'], order_dict['order_id'],
+            order_dict['symbol'], order_dict['venue'],
+            order_dict['direction'], order_dict['size'],
+            order_dict['price'], order_dict['order_type'],
+            order_dict['metatype'], order_dict['void_price'],
+            order_dict['trail'], order_dict['reduce_only'],
+            order_dict['post_only'], order_dict['status'])
+
+        order.order_id = order_dict['order_id']
+        order.timestamp = order_dict['timestamp']
+        order.avg_fill_price = order_dict['avg_fill_price']
+        order.currency = order_dict['currency']
+        order.venue_id = order_dict['venue_id']
+        order.batch_size = order_dict['batch_size']
+
+        return order
+
     def get_order_dict(self):
         """
         Return all order variables as a dict for DB storage.
@@ -194,11 +229,67 @@ class Order:
 class TradeID():
     """
     Utility class for generating sequential trade ID's from database.
+
+    ID's are allocated from an atomic counter document, seeded once from the
+    highest stored trade ID. ID's can be reserved in blocks to avoid a DB
+    round trip per trade, e.g when backtesting. Unused ID's in a reserved
+    block are skipped if the server restarts.
     """
 
-    def __init__(self, db):
+    COUNTER = "trade_id"
+
+    def __init__(self, db, block_size=1):
         self.db = db
+        self.block_size = block_size   # ID's to reserve per counter update.
+        self.next = None                # Next unused ID in current block.
+        self.last = None                # Final ID in current block.
+        self.seed()
+
+    def seed(self):
+        """
+        Create the counter document from the highest stored trade ID, or
+        raise it to that ID if trades were stored without using the counter.
+        """
+
+        newest = self.db['trades'].find_one(
+            {}, {"_id": 0, "trade_id": 1}, sort=[("trade_id", -1)])
+        start = int(newest['trade_id']) if newest else 0
+
+        # $max only ever raises the counter, so repeat seeding is safe.
+        self.db['counters'].update_one(
+            {"_id": self.COUNTER}, {"$max": {"seq": start}}, upsert=True)
 
     def new_id(self):
-        result = list(self.db['trades'].find({}).sort([("trade_id", -1)]))
-        return (int(result[0]['trade_id']) + 1) if result else 1
+        """
+        Return the next sequential trade ID.
+        """
+
+        if self.next is None or self.next > self.last:
+            self.next, self.last = self.reserve(self.block_size)
+
+        trade_id = self.next
+        self.next += 1
+
+        return trade_id
+
+    def reserve(self, n):
+        """
+        Atomically reserve n sequential ID's.
+
+        Args:
+            n: number of ID's to reserve (int).
+
+        Returns:
+            first, last: first and last reserved ID's (int).
+
+        Raises:
+            None.
+        """
+
+        result = self.db['counters'].find_one_and_update(
+            {"_id": self.COUNTER}, {"$inc": {"seq": n}}, upsert=True,
+            return_document=ReturnDocument.AFTER)
+
+        last = int(result['seq'])
+
+        return last - n + 1, last
@@ -0,0 +1,237 @@
+"""
+trading-server is a multi-asset, multi-strategy, event-driven execution
+and backtesting platform (OEMS) for trading common markets.
+
+Copyright (C) 2020  Sam Breznikar <sam@sdbgroup.io>
+
+Licensed under GNU General Public License 3.0 or later.
+
+Some rights reserved. See LICENSE.md, AUTHORS.md.
+"""
+
+from threading import Lock
+import statistics
+import argparse
+import logging
+import struct
+import gzip
+import time
+import sys
+
+
+class FrameRecorder:
+    """
+    Write raw websocket frames and their receive timestamps to a gzipped
+    capture file, for deterministic replay with FrameReplayer.
+
+    Each record is an 8 byte epoch nanosecond receive timestamp and a
+    4 byte frame length, little endian, followed by the UTF-8 frame.
+    """
+
+    MAGIC = b"WSCAP1\n"
+    RECORD = struct.Struct("<qI")
+    COMPRESS_LEVEL = 6
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, "wb", compresslevel=self.COMPRESS_LEVEL)
+        self.file.write(self.MAGIC)
+        self.lock = Lock()
+        self.frames = 0
+        self.bytes = 0
+
+    def record(self, frame, timestamp=None):
+        """
+        Append a frame to the capture.
+
+        Args:
+            frame: raw websocket message (string or bytes).
+            timestamp: epoch ns receive time, None for now.
+
+        Returns:
+            None.
+
+        Raises:
+            None.
+        """
+
+        if timestamp is None:
+            timestamp = time.time_ns()
+        if isinstance(frame, str):
+            frame = frame.encode()
+
+        with self.lock:
+            if self.file:
+                self.file.write(self.RECORD.pack(timestamp, len(frame)))
+                self.file.write(frame)
+                self.frames += 1
+                self.bytes += len(frame)
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+
+def read_frames(path):
+    """
+    Yield (epoch ns receive timestamp, frame string) tuples from a capture
+    file written by FrameRecorder.
+    """
+
+    with gzip.open(path, "rb") as f:
+        if f.read(len(FrameRecorder.MAGIC)) != FrameRecorder.MAGIC:
+            raise Exception(path + " is not a websocket capture file.")
+
+        size = FrameRecorder.RECORD.size
+        while True:
+            header = f.read(size)
+            if len(header) < size:
+                return
+            timestamp, length = FrameRecorder.RECORD.unpack(header)
+            frame = f.read(length)
+            if len(frame) < length:
+                return
+            yield timestamp, frame.decode()
+
+
+class FrameReplayer:
+    """
+    Feed captured websocket frames into a websocket client, e.g Bitmex_WS
+    created with connect=False, at original speed, N times original speed
+    or as fast as possible. No network access needed.
+
+    Latency is measured per frame from the time it was due, per the
+    capture timing and replay speed, to the time the client finished
+    handling it. At max speed every frame is due on arrival, so latency
+    is handling time only.
+    """
+
+    def __init__(self, logger, path):
+        self.logger = logger
+        self.path = path
+
+        # Frames are loaded up front so file reads dont skew timing.
+        self.frames = list(read_frames(path))
+
+    def replay(self, client, speed=1, on_minute=None):
+        """
+        Replay the capture into client.on_message.
+
+        Args:
+            client: object with an on_message(ws, msg) method.
+            speed: replay speed multiple, None for as fast as possible.
+            on_minute: called with the epoch second timestamp of each
+                minute boundary crossed in capture time, after the last
+                frame of the minute. Use to drive minute-based processing,
+                e.g tick parsing and strategy runs, from capture time.
+
+        Returns:
+            report: dict of frame count, bytes, duration, throughput and
+                latency statistics.
+
+        Raises:
+            None.
+        """
+
+        if not self.frames:
+            return None
+
+        first = self.frames[0][0]
+        minute = first // 10 ** 9 // 60
+        latencies = []
+        start = time.perf_counter_ns()
+
+        for timestamp, frame in self.frames:
+
+            # Minute boundaries crossed in capture time.
+            if on_minute:
+                while timestamp // 10 ** 9 // 60 > minute:
+                    minute += 1
+                    on_minute(minute * 60)
+
+            if speed:
+                due = start + int((timestamp - first) / speed)
+                wait = due - time.perf_counter_ns()
+                if wait > 0:
+                    time.sleep(wait / 10 ** 9)
+            else:
+                due = time.perf_counter_ns()
+
+            client.on_message(None, frame)
+            latencies.append(time.perf_counter_ns() - due)
+
+        duration = (time.perf_counter_ns() - start) / 10 ** 9
+        latencies.sort()
+        n = len(latencies)
+
+        report = {
+            'frames': n,
+            'bytes': sum(len(f) for ts, f in self.frames),
+            'capture_seconds': (self.frames[-1][0] - first) / 10 ** 9,
+            'replay_seconds': duration,
+            'speed': speed,
+            'frames_per_second': n / duration if duration else None,
+            'latency_mean_us': statistics.mean(latencies) / 1000,
+            'latency_p50_us': latencies[n // 2] / 1000,
+            'latency_p99_us': latencies[min(n - 1, int(n * 0.99))] / 1000,
+            'latency_max_us': latencies[-1] / 1000}
+
+        self.logger.info(
+            "Replayed " + str(n) + " frames in " + str(round(duration, 3)) +
+            "s (" + str(int(report['frames_per_second'] or 0)) +
+            " frames/s), latency p50 " +
+            str(round(report['latency_p50_us'], 1)) + "us, p99 " +
+            str(round(report['latency_p99_us'], 1)) + "us.")
+
+        return report
+
+
+def main(argv=None):
+    """
+    Record: python ws_capture.py record <file> --seconds 60 [--url URL]
+    Replay: python ws_capture.py replay <file> [--speed N | --speed max]
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Capture and replay BitMEX websocket frames.")
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("path")
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--url", default=None)
+    parser.add_argument("--symbols", default="XBTUSD")
+    parser.add_argument("--speed", default="1")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger()
+
+    from bitmex_ws import Bitmex_WS
+    from bitmex import Bitmex
+
+    symbols = args.symbols.split(",")
+
+    if args.mode == "record":
+        recorder = FrameRecorder(args.path)
+        ws = Bitmex_WS(
+            logger, symbols, ["trade"], args.url or Bitmex.WS_URL, None,
+            None, recorder=recorder)
+        time.sleep(args.seconds)
+        ws.exit()
+        recorder.close()
+        logger.info(
+            "Recorded " + str(recorder.frames) + " frames, " +
+            str(recorder.bytes) + " bytes to " + args.path + ".")
+
+    else:
+        speed = None if args.speed == "max" else float(args.speed)
+        ws = Bitmex_WS(
+            logger, symbols, ["trade"], None, None, None, connect=False)
+        report = FrameReplayer(logger, args.path).replay(ws, speed)
+        for key, value in (report or {}).items():
+            print(key + ":", value)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])